@@ -1,6 +1,24 @@
+import ast
+import hashlib
+import io
 import json
+import keyword
+import math
+import multiprocessing
+import multiprocessing.connection
+import os
+import re
+import sqlite3
+import struct
+import time
+import tokenize
+import zlib
 import libcst as cst
-from libcst import FunctionDef, ClassDef, Module, parse_module, Call, Comment
+from libcst import FunctionDef, ClassDef, Module, parse_module, Call, Comment, Lambda, Name, Attribute, ParserSyntaxError
+from libcst._nodes.internal import CodegenState
+from array import array
+from bisect import bisect_left
+from collections import deque
 from typing import Dict, Union
 import pprint
 
@@ -149,7 +167,1014 @@ class CallSetVisitor(cst.CSTTransformer):
 
         return updated
 
-def extract_code_elements(code: str) -> Dict[
+
+class _CallSite:
+    __slots__ = ("start", "end", "depth", "owner", "caller", "callee", "children", "tagged", "matched", "head")
+
+    def __init__(self, start, depth, owner, caller, callee):
+        self.start = start
+        self.end = start
+        self.depth = depth
+        self.owner = owner
+        self.caller = caller
+        self.callee = callee
+        self.children = []
+        self.tagged = []
+        self.matched = False
+        self.head = ""
+
+
+class _SpanRenderer:
+    """
+        Renders node text from source spans, the way module.code_for_node would.
+
+        _dedent cuts the indentation a node inherits from enclosing blocks using the
+        indent runs, and _splice also swaps every matched call for its #<call> tag
+        using the tag tables SpanExtractor._link fills in. Tag text is rendered the
+        first time it is needed.
+    """
+
+    max_body_chars = None
+
+    def _dedent(self, start, end, depth, limit=None):
+        # With a limit, rendering stops once at least that many characters are out.
+        if depth == 0:
+            return self.source[start:end if limit is None else min(end, start + limit)]
+
+        parts = []
+        size = 0
+        pos = start
+        i = bisect_left(self._run_offsets, start)
+        while i < len(self._run_offsets) and self._run_offsets[i] < end:
+            offset = self._run_offsets[i]
+            parts.append(self.source[pos:offset])
+            pos = offset + self._run_widths[i][depth - 1]
+            i += 1
+
+            if limit is not None:
+                size += len(parts[-1])
+                if size >= limit:
+                    return "".join(parts)
+
+        parts.append(self.source[pos:end])
+        return "".join(parts)
+
+    def _tag(self, i, limit=None):
+        """
+            The #<call> comment CallSetVisitor.leave_Call puts in place of the i-th
+            matched call that is not itself inside a matched call.
+
+            Matched calls nested in it are flattened into sorted open/close events,
+            so the tag comes out of a single pass over the call's span, rendered at
+            the call's depth. Nested tags are never rendered on their own or copied
+            into their parents, and newlines are dropped as each piece is cut.
+        """
+        start = self._tag_starts[i]
+        end = self._tag_ends[i]
+        depth = self._tag_depths[i]
+
+        parts = []
+        size = 0
+        pos = start
+        j = bisect_left(self._tag_offsets, start)
+        while j < len(self._tag_offsets) and self._tag_offsets[j] <= end:
+            offset = self._tag_offsets[j]
+            parts.append(self._dedent(pos, offset, depth).replace("\n", ""))
+            parts.append("</call>" if self._tag_closing[j] else "#<call>")
+            pos = offset
+            j += 1
+
+            # a limit stops the sweep early; the tag is then only a prefix
+            if limit is not None:
+                size += len(parts[-2]) + len(parts[-1])
+                if size > limit:
+                    break
+
+        return "".join(parts)
+
+    def _splice(self, start, end, depth, limit=None):
+        # Text of [start, end) as code_for_node would render it at depth after
+        # CallSetVisitor swapped every matched call for a #<call> comment.
+        parts = []
+        size = 0
+        pos = start
+        i = bisect_left(self._tag_starts, start)
+        while i < len(self._tag_starts) and self._tag_starts[i] < end:
+            parts.append(self._dedent(pos, self._tag_starts[i], depth, limit))
+            text = self._tag_text.get(i)
+            if text is None:
+                if limit is None or self._tag_ends[i] - self._tag_starts[i] <= limit:
+                    text = self._tag_text[i] = self._tag(i)
+                else:
+                    text = self._tag(i, limit)
+            parts.append(text)
+            pos = self._tag_ends[i]
+            i += 1
+
+            if limit is not None:
+                size += len(parts[-2]) + len(text)
+                if size > limit:
+                    return "".join(parts)
+
+        parts.append(self._dedent(pos, end, depth, limit))
+        return "".join(parts)
+
+    def _render(self, start, end, depth, splice=False):
+        # (text, truncated), text cut to max_body_chars if that is set
+        render = self._splice if splice else self._dedent
+        limit = self.max_body_chars
+        if limit is None:
+            return render(start, end, depth), False
+
+        text = render(start, end, depth, limit + 1)
+        return text[:limit], len(text) > limit
+
+
+class ParseLimitExceeded(Exception):
+    """
+        Raised by SpanExtractor when a file goes over max_nodes or max_depth.
+        reason is "too_many_nodes" or "too_deep".
+    """
+
+    def __init__(self, reason, detail):
+        Exception.__init__(self, detail)
+        self.reason = reason
+
+
+class SpanExtractor(_SpanRenderer):
+    """
+        Builds parse_code output from source spans.
+
+        A backend walks the file once in source order and reports every FunctionDef,
+        Lambda and Call through the _open_*/_close_* methods as (start, end) offsets
+        into self.source plus the indentation depth the node sits at. It also records
+        indent runs: the offsets of line-leading indentation that libcst emits from
+        its indent stack, with the cumulative width of each level.
+
+        Bodies are sliced out of the source instead of being regenerated with
+        module.code_for_node. Indentation inherited from enclosing blocks is cut from
+        the slices so they match what code_for_node would return for the node.
+
+        Call edges and #<call> tags need the full set of function names in the file,
+        so call sites are only recorded during the walk and resolved afterwards by
+        resolve().
+
+        Every def gets an integer id in the symbols table under its qualified name
+        (Class.method, outer.inner), and call_edges counts (caller, callee) id pairs.
+        The callee name comes from the call's func node (a Name, or the attr of an
+        Attribute) as reported by the backend and resolves to the last def with that
+        name, like node_set. The string keyed call_tree and call_set are derived
+        from call_edges under the defs' names, and a call is tagged in emb_repr when
+        it has a callee.
+
+        With legacy_calls, call_tree, call_set and the tags follow the two visitor
+        implementation instead, which takes the last dotted name before the first
+        "(" of the rendered call. The two disagree on calls of a call or of a
+        subscript: make()(x) counts make twice under legacy_calls and not at all
+        from the edges, obj.c(z)[0].b(z) counts c twice, against c and b once.
+
+        max_nodes and max_depth bound the walk: the backend is stopped with
+        ParseLimitExceeded as soon as the file has more defs, lambdas and calls
+        than max_nodes, or a def or lambda nested deeper than max_depth. With
+        max_body_chars, body and emb_repr are cut to that many characters while
+        they are rendered, and every node gets a truncated flag.
+    """
+
+    max_nodes = None
+    max_depth = None
+    legacy_calls = False
+
+    def __init__(self):
+        self.code_elements = {"__data__": {"name": "root"}, "__children__": []}
+        self.ancestor_stack = []
+        self.callSet = {}
+        self.nodeSet = {}
+        self.callTree = {}
+        self.source = ""
+
+        self._run_offsets = []
+        self._run_widths = []
+        self._nodes = []
+        self._parents = []
+        self._node_stack = []
+        self._funcs = []
+        self._lambda_stack = []
+        self._def_stack = []
+        self._scope = []
+        self._def_symbols = []
+        self._last_symbol = {}
+        self.symbols = []
+        self._symbol_ids = {}
+        self._symbol_names = []
+        self.callEdges = {}
+        self._calls = []
+        self._call_stack = []
+        self._root_calls = []
+        self._emb_spans = {}
+        self._tag_starts = []
+        self._tag_ends = []
+        self._tag_depths = []
+        self._tag_text = {}
+        self._tag_offsets = []
+        self._tag_closing = []
+        self._size = 0
+
+    # -- traversal events -----------------------------------------------------
+
+    def _count_node(self):
+        self._size += 1
+        if self.max_nodes is not None and self._size > self.max_nodes:
+            raise ParseLimitExceeded("too_many_nodes", f"more than {self.max_nodes} defs, lambdas and calls")
+
+    def _add_tree_node(self, treeNode, record):
+        self._count_node()
+        if self.max_depth is not None and len(self.ancestor_stack) >= self.max_depth:
+            raise ParseLimitExceeded("too_deep", f"defs nested deeper than {self.max_depth}")
+
+        if len(self.ancestor_stack) == 0:
+            self.code_elements["__children__"].append(treeNode)
+        else:
+            self.ancestor_stack[-1]["__children__"].append(treeNode)
+
+        self.ancestor_stack.append(treeNode)
+
+        # span records in pre-order, with the index of their parent
+        self._parents.append(self._node_stack[-1] if self._node_stack else -1)
+        self._node_stack.append(len(self._nodes))
+        self._nodes.append(record)
+
+    def _pop_tree_node(self):
+        self.ancestor_stack.pop()
+        self._node_stack.pop()
+
+    def _open_function(self, func_name, params, start, depth):
+        treeNode = {"__data__": {"name": func_name, "params": params, "body": None, "type": "func"}, "__children__": []}
+
+        # [start, end, depth, name, data]
+        record = [start, start, depth, func_name, treeNode["__data__"]]
+        self._add_tree_node(treeNode, record)
+        self._def_stack.append(record)
+
+        self.callSet[func_name] = 0
+        self.nodeSet[func_name] = treeNode["__data__"]
+
+        self._scope.append(func_name)
+        symbol = self._symbol(".".join(self._scope), func_name)
+        self._def_symbols.append(symbol)
+        self._last_symbol[func_name] = symbol
+
+    def _close_function(self, end):
+        record = self._def_stack.pop()
+        record[1] = end
+        self._funcs.append(record)
+        self._pop_tree_node()
+        self._scope.pop()
+        self._def_symbols.pop()
+
+    def _open_class(self, class_name):
+        self._scope.append(class_name)
+
+    def _close_class(self):
+        self._scope.pop()
+
+    def _symbol(self, qualname, name):
+        if qualname not in self._symbol_ids:
+            self._symbol_ids[qualname] = len(self.symbols)
+            self.symbols.append(qualname)
+            self._symbol_names.append(name)
+        return self._symbol_ids[qualname]
+
+    def _open_lambda(self, params, start, depth):
+        treeNode = {"__data__": {"params": params, "body": None, "type": "lambda"}, "__children__": []}
+
+        # [start, end, depth, data]
+        record = [start, start, depth, treeNode["__data__"]]
+        self._add_tree_node(treeNode, record)
+        self._lambda_stack.append(record)
+
+    def _close_lambda(self, end):
+        self._lambda_stack.pop()[1] = end
+        self._pop_tree_node()
+
+    def _open_call(self, start, depth, callee=None):
+        self._count_node()
+        owner = self._def_stack[-1] if self._def_stack else None
+        call = _CallSite(start, depth, owner, self._def_symbols[-1] if self._def_symbols else None, callee)
+
+        if self._call_stack:
+            self._call_stack[-1].children.append(call)
+        else:
+            self._root_calls.append(call)
+
+        self._calls.append(call)
+        self._call_stack.append(call)
+
+    def _close_call(self, end):
+        self._call_stack.pop().end = end
+
+    def _replay(self, events, run_offsets, run_widths, shift):
+        # Feeds traversal events logged by _EventRecorder back in, moved by shift.
+        for event in events:
+            kind = event[0]
+            if kind == "def":
+                self._open_function(event[3], event[4], event[1] + shift, event[2])
+            elif kind == "lambda":
+                self._open_lambda(event[3], event[1] + shift, event[2])
+            elif kind == "call":
+                self._open_call(event[1] + shift, event[2], event[3])
+            elif kind == "class":
+                self._open_class(event[1])
+            elif kind == "/class":
+                self._close_class()
+            elif kind == "/def":
+                self._close_function(event[1] + shift)
+            elif kind == "/lambda":
+                self._close_lambda(event[1] + shift)
+            else:
+                self._close_call(event[1] + shift)
+
+        self._run_offsets.extend(offset + shift for offset in run_offsets)
+        self._run_widths.extend(run_widths)
+
+    # -- rendering ------------------------------------------------------------
+
+    def _call_name(self, call):
+        end = self.source.find("(", call.start, call.end)
+        return self._dedent(call.start, end, call.depth).lstrip().split(".")[-1]
+
+    def _resolve_head(self, call):
+        # Text of the call up to its first "(" after its nested matched calls were
+        # swapped for tags, which is all CallSetVisitor.leave_Call looks at.
+        first = call.tagged[0] if call.tagged else None
+        end = self.source.find("(", call.start, first.start if first is not None else call.end)
+        if end >= 0 or first is None:
+            call.head = self._dedent(call.start, end, call.depth)
+        else:
+            call.head = self._dedent(call.start, first.start, call.depth) + "#<call>" + first.head.replace("\n", "")
+
+    def _add_count(self, funcName, callName, count=1):
+        if funcName not in self.callTree:
+            self.callTree[funcName] = {}
+
+        if callName not in self.callTree:
+            self.callTree[callName] = {}
+
+        if callName not in self.callTree[funcName]:
+            self.callTree[funcName][callName] = 0
+
+        self.callTree[funcName][callName] += count
+        self.callSet[callName] += count
+
+    def _resolve_tags(self, call):
+        for child in call.children:
+            self._resolve_tags(child)
+            if child.matched:
+                call.tagged.append(child)
+            else:
+                call.tagged.extend(child.tagged)
+
+        if self.legacy_calls:
+            self._resolve_head(call)
+            call.matched = call.head.lstrip().split(".")[-1] in self.callSet
+        else:
+            call.matched = call.callee in self._last_symbol
+
+    def _add_tag_events(self, call):
+        self._tag_offsets.append(call.start)
+        self._tag_closing.append(False)
+        for child in call.tagged:
+            self._add_tag_events(child)
+        self._tag_offsets.append(call.end)
+        self._tag_closing.append(True)
+
+    def _link(self):
+        """
+            Counts call edges and finds the calls to tag once the walk is complete.
+        """
+        for call in self._calls:
+            if call.owner is None:
+                continue
+            if self.legacy_calls:
+                name = self._call_name(call)
+                if name in self.callSet:
+                    self._add_count(call.owner[3], name)
+
+            callee = self._last_symbol.get(call.callee)
+            if callee is not None:
+                edge = (call.caller, callee)
+                self.callEdges[edge] = self.callEdges.get(edge, 0) + 1
+
+        if not self.legacy_calls:
+            names = self._symbol_names
+            for (caller, callee), count in self.callEdges.items():
+                self._add_count(names[caller], names[callee], count)
+
+        for call in self._root_calls:
+            self._resolve_tags(call)
+            for tag in ([call] if call.matched else call.tagged):
+                self._tag_starts.append(tag.start)
+                self._tag_ends.append(tag.end)
+                self._tag_depths.append(tag.depth)
+                self._add_tag_events(tag)
+
+        # emb_repr is stored on nodeSet[name] in leave order, so the last def to be left wins
+        for start, end, depth, name, _ in self._funcs:
+            self._emb_spans[name] = (start, end, depth)
+
+        return self
+
+    def resolve(self):
+        """
+            Fills in bodies, call counts and emb_repr once the walk is complete.
+        """
+        self._link()
+
+        limited = self.max_body_chars is not None
+        for record in self._nodes:
+            data = record[-1]
+            data["body"], truncated = self._render(record[0], record[1], record[2])
+            if limited:
+                data["truncated"] = truncated
+
+        for name, (start, end, depth) in self._emb_spans.items():
+            data = self.nodeSet[name]
+            data["emb_repr"], truncated = self._render(start, end, depth, splice=True)
+            if truncated:
+                data["truncated"] = True
+
+        return self
+
+
+class CodeElementExtractor(SpanExtractor, CodegenState):
+    """
+        libcst backend for SpanExtractor, replacing CodeExtractorVisitor + CallSetVisitor.
+
+        The module is rendered exactly once through this codegen state. The codegen
+        hooks double as the traversal, and the rendered tokens become self.source.
+    """
+
+    def __init__(self, module):
+        CodegenState.__init__(self, default_indent=module.default_indent, default_newline=module.default_newline)
+        SpanExtractor.__init__(self)
+        self._offset = 0
+        self._indent_widths = []
+        self._open = []
+
+    def increase_indent(self, value: str) -> None:
+        self.indent_tokens.append(value)
+        self._indent_widths.append(len(value) + (self._indent_widths[-1] if self._indent_widths else 0))
+
+    def decrease_indent(self) -> None:
+        self.indent_tokens.pop()
+        self._indent_widths.pop()
+
+    def add_indent_tokens(self) -> None:
+        if self.indent_tokens:
+            self._run_offsets.append(self._offset)
+            self._run_widths.append(tuple(self._indent_widths))
+            self.tokens.extend(self.indent_tokens)
+            self._offset += self._indent_widths[-1]
+
+    def add_token(self, value: str) -> None:
+        self.tokens.append(value)
+        self._offset += len(value)
+
+    def pop_trailing_newline(self) -> None:
+        # Keep the final newline so the last definition renders like code_for_node.
+        pass
+
+    def before_codegen(self, node) -> None:
+        if isinstance(node, FunctionDef):
+            params = [param.name.value for param in node.params.params]
+            self._open_function(node.name.value, params, self._offset, len(self.indent_tokens))
+        elif isinstance(node, Lambda):
+            params = [param.name.value for param in node.params.params]
+            self._open_lambda(params, self._offset, len(self.indent_tokens))
+        elif isinstance(node, Call):
+            func = node.func
+            if isinstance(func, Name):
+                callee = func.value
+            elif isinstance(func, Attribute):
+                callee = func.attr.value
+            else:
+                callee = None
+            self._open_call(self._offset, len(self.indent_tokens), callee)
+        elif isinstance(node, ClassDef):
+            self._open_class(node.name.value)
+        else:
+            return
+
+        self._open.append(node)
+
+    def after_codegen(self, node) -> None:
+        if self._open and self._open[-1] is node:
+            self._open.pop()
+            if isinstance(node, FunctionDef):
+                self._close_function(self._offset)
+            elif isinstance(node, Lambda):
+                self._close_lambda(self._offset)
+            elif isinstance(node, ClassDef):
+                self._close_class()
+            else:
+                self._close_call(self._offset)
+
+_LINE_RE = re.compile(r"[^\r\n]*(?:\r\n|\r|\n)?")
+
+
+class AstElementExtractor(SpanExtractor):
+    """
+        Stdlib ast backend for SpanExtractor.
+
+        Names, params and node spans come from ast (end_lineno/end_col_offset). The
+        indentation libcst would manage is reconstructed from one tokenize pass:
+        each physical line is assigned to the block it belongs to (including the
+        footer/leading-line split of comments around a dedent), and parentheses that
+        libcst attaches to a Lambda or Call are found from the token stream. Call
+        tags are spliced into the sliced source, so libcst is never involved.
+    """
+
+    def __init__(self, code):
+        SpanExtractor.__init__(self)
+        if code and code[-1] not in "\r\n":
+            newline = re.search(r"\r\n|\r|\n", code)
+            code += newline.group(0) if newline is not None else "\n"
+
+        self.source = code
+        self._lines = _LINE_RE.findall(code)[:-1] or [""]
+        self._line_starts = [0]
+        for line in self._lines:
+            self._line_starts.append(self._line_starts[-1] + len(line))
+
+        rows = len(self._lines) + 2
+        # per physical row: indent stack of the block it belongs to, and of its logical line
+        self._row_context = [None] * rows
+        self._row_stack = [()] * rows
+        self._footer_level = [0] * rows
+        self._lead_start = {}
+
+        self._tok_starts = []
+        self._tok_ends = []
+        self._tok_strings = []
+        self._tok_types = []
+        self._paren_match = {}
+
+    def _offset(self, row, col):
+        line = self._lines[row - 1]
+        if not line.isascii():
+            col = len(line.encode("utf-8")[:col].decode("utf-8", errors="replace"))
+        return self._line_starts[row - 1] + col
+
+    # -- line classification --------------------------------------------------
+
+    def _assign_empty_lines(self, pending, old_stack, new_stack, next_row):
+        i = 0
+        if len(new_stack) <= len(old_stack):
+            # Blocks closed here own, as their footer, every line up to the last one
+            # indented at their level; the rest lead into the next statement.
+            for level in range(len(old_stack), len(new_stack), -1):
+                indent = old_stack[level - 1]
+                last = -1
+                for j in range(i, len(pending)):
+                    if self._lines[pending[j] - 1].startswith(indent):
+                        last = j
+
+                for j in range(i, last + 1):
+                    self._row_context[pending[j]] = old_stack[:level]
+                    self._footer_level[pending[j]] = level
+                i = max(i, last + 1)
+
+        for j in range(i, len(pending)):
+            self._row_context[pending[j]] = new_stack
+
+        if next_row is not None and i < len(pending):
+            self._lead_start[next_row] = pending[i]
+
+    def _scan(self):
+        stack = []
+        prev_stack = ()
+        pending = []
+        depth = 0
+        string_rows = set()
+        ended = set()
+        logical_start = True
+        seen_statement = False
+        logical_stack = ()
+        open_parens = []
+
+        readline = io.StringIO(self.source, newline="").readline
+        for tok in tokenize.generate_tokens(readline):
+            tok_type = tok.type
+            row = tok.start[0]
+
+            if tok_type == tokenize.INDENT:
+                stack.append(tok.string)
+                continue
+            if tok_type == tokenize.DEDENT:
+                stack.pop()
+                continue
+            if tok_type == tokenize.NEWLINE:
+                ended.add(row)
+                prev_stack = tuple(stack)
+                logical_start = True
+                continue
+            if tok_type == tokenize.NL:
+                ended.add(row)
+                if depth == 0 and logical_start:
+                    pending.append(row)
+                else:
+                    self._row_stack[row] = logical_stack
+                continue
+            if tok_type == tokenize.COMMENT:
+                continue
+            if tok_type == tokenize.ENDMARKER:
+                self._assign_empty_lines(pending, prev_stack, (), None)
+                break
+
+            if logical_start:
+                logical_start = False
+                logical_stack = tuple(stack)
+                if seen_statement:
+                    self._assign_empty_lines(pending, prev_stack, logical_stack, row)
+                seen_statement = True
+                pending = []
+                self._row_context[row] = logical_stack
+
+            for r in range(row, tok.end[0] + 1):
+                self._row_stack[r] = logical_stack
+            if tok.end[0] > row:
+                string_rows.update(range(row + 1, tok.end[0] + 1))
+
+            start = self._line_starts[row - 1] + tok.start[1]
+            if tok_type == tokenize.OP:
+                if tok.string in "([{":
+                    depth += 1
+                    if tok.string == "(":
+                        open_parens.append(start)
+                elif tok.string in ")]}":
+                    depth -= 1
+                    if tok.string == ")" and open_parens:
+                        self._paren_match[open_parens.pop()] = start
+
+            self._tok_starts.append(start)
+            self._tok_ends.append(self._line_starts[tok.end[0] - 1] + tok.end[1])
+            self._tok_strings.append(tok.string)
+            self._tok_types.append(tok_type)
+
+        widths = {}
+        for row in range(1, len(self._lines) + 1):
+            if row in string_rows or (row > 1 and row - 1 not in ended):
+                # inside a multi line string or after a backslash continuation: verbatim
+                continue
+
+            context = self._row_context[row]
+            if context is None:
+                # continuation line inside brackets
+                context = self._row_stack[row]
+
+            if context and self._lines[row - 1].startswith(context[-1]):
+                if context not in widths:
+                    widths[context] = tuple(len(indent) for indent in context)
+                self._run_offsets.append(self._line_starts[row - 1])
+                self._run_widths.append(widths[context])
+
+    # -- node spans -----------------------------------------------------------
+
+    def _expression_span(self, node):
+        start = self._offset(node.lineno, node.col_offset)
+        end = self._offset(node.end_lineno, node.end_col_offset)
+
+        # libcst keeps the parentheses wrapping an expression on the node itself,
+        # unless they are the argument list of an enclosing call (or class bases).
+        i = bisect_left(self._tok_starts, start)
+        j = bisect_left(self._tok_starts, end)
+        if i == len(self._tok_starts) or self._tok_starts[i] != start or self._tok_ends[j - 1] != end:
+            return start, end
+
+        while i > 0 and j < len(self._tok_starts):
+            open_start = self._tok_starts[i - 1]
+            if self._paren_match.get(open_start) != self._tok_starts[j] or self._tok_strings[j] != ")":
+                break
+            if i > 1:
+                before_type = self._tok_types[i - 2]
+                before = self._tok_strings[i - 2]
+                if (before_type == tokenize.NAME and not keyword.iskeyword(before)) or before in (")", "]") \
+                        or before_type == tokenize.STRING:
+                    break
+
+            i -= 1
+            j += 1
+            start = open_start
+            end = self._tok_ends[j - 1]
+
+        return start, end
+
+    def _function_span(self, node):
+        first_row = min([node.lineno] + [decorator.lineno for decorator in node.decorator_list])
+        stack = self._row_stack[first_row]
+        depth = len(stack)
+
+        end_row = node.end_lineno
+        while end_row < len(self._lines) and self._footer_level[end_row + 1] > depth:
+            end_row += 1
+
+        start_row = self._lead_start.get(first_row, first_row)
+        return self._line_starts[start_row - 1], self._line_starts[end_row], depth
+
+    def extract(self, tree):
+        self._scan()
+
+        items = []
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                start, end, depth = self._function_span(node)
+                items.append((start, -end, 0, depth, node))
+            elif isinstance(node, ast.ClassDef):
+                start, end, depth = self._function_span(node)
+                items.append((start, -end, 3, depth, node))
+            elif isinstance(node, (ast.Lambda, ast.Call)):
+                start, end = self._expression_span(node)
+                depth = len(self._row_stack[node.lineno])
+                items.append((start, -end, 1 if isinstance(node, ast.Lambda) else 2, depth, node))
+
+        items.sort(key=lambda item: item[:3])
+
+        open_items = []
+        for start, neg_end, kind, depth, node in items:
+            while open_items and open_items[-1][0] <= start:
+                self._close(*open_items.pop())
+
+            if kind == 0:
+                self._open_function(node.name, [arg.arg for arg in node.args.args], start, depth)
+            elif kind == 1:
+                self._open_lambda([arg.arg for arg in node.args.args], start, depth)
+            elif kind == 3:
+                self._open_class(node.name)
+            else:
+                func = node.func
+                if isinstance(func, ast.Name):
+                    callee = func.id
+                elif isinstance(func, ast.Attribute):
+                    callee = func.attr
+                else:
+                    callee = None
+                self._open_call(start, depth, callee)
+            open_items.append((-neg_end, kind))
+
+        while open_items:
+            self._close(*open_items.pop())
+
+        return self
+
+    def _close(self, end, kind):
+        if kind == 0:
+            self._close_function(end)
+        elif kind == 1:
+            self._close_lambda(end)
+        elif kind == 3:
+            self._close_class()
+        else:
+            self._close_call(end)
+
+
+_LIMITS = ("max_body_chars", "max_nodes", "max_depth")
+
+
+def _check_limits(limits):
+    unknown = set(limits or ()) - set(_LIMITS)
+    if unknown:
+        raise ValueError(f"unknown parse limits {sorted(unknown)}, expected some of {list(_LIMITS)}")
+
+
+def _set_limits(extractor, limits):
+    for key, value in (limits or {}).items():
+        setattr(extractor, key, value)
+    return extractor
+
+
+def _libcst_extractor(code, extractor_class=CodeElementExtractor, metrics=None, limits=None):
+    start = time.perf_counter()
+    module = cst.parse_module(code)
+    parsed = time.perf_counter()
+
+    extractor = _set_limits(extractor_class(module), limits)
+    module._codegen(extractor)
+    extractor.source = "".join(extractor.tokens)
+
+    if metrics is not None:
+        metrics["parse_seconds"] = parsed - start
+        metrics["extract_seconds"] = time.perf_counter() - parsed
+    return extractor
+
+
+def _ast_extractor(code, extractor_class=AstElementExtractor, metrics=None, limits=None):
+    if isinstance(code, bytes):
+        encoding, _ = tokenize.detect_encoding(io.BytesIO(code).readline)
+        code = code.decode(encoding)
+
+    start = time.perf_counter()
+    extractor = _set_limits(extractor_class(code), limits)
+    tree = ast.parse(extractor.source)
+    parsed = time.perf_counter()
+
+    extractor.extract(tree)
+
+    if metrics is not None:
+        metrics["parse_seconds"] = parsed - start
+        metrics["extract_seconds"] = time.perf_counter() - parsed
+    return extractor
+
+
+def _link_extractor(extractor, render=True, metrics=None, legacy_calls=False):
+    # the call pass: call edges and tags, plus bodies and emb_repr when rendering
+    start = time.perf_counter()
+    extractor.legacy_calls = legacy_calls
+    if render:
+        extractor.resolve()
+    else:
+        extractor._link()
+
+    if metrics is not None:
+        metrics["call_pass_seconds"] = time.perf_counter() - start
+        metrics["nodes"] = len(extractor._nodes)
+        metrics["calls"] = len(extractor._calls)
+    return extractor
+
+
+class _EventRecorder:
+    """
+        Mixin for a SpanExtractor backend that only logs its traversal events, so
+        they can be replayed into another SpanExtractor with SpanExtractor._replay.
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.events = []
+
+    def _open_function(self, func_name, params, start, depth):
+        self.events.append(("def", start, depth, func_name, params))
+
+    def _close_function(self, end):
+        self.events.append(("/def", end))
+
+    def _open_lambda(self, params, start, depth):
+        self.events.append(("lambda", start, depth, params))
+
+    def _close_lambda(self, end):
+        self.events.append(("/lambda", end))
+
+    def _open_call(self, start, depth, callee=None):
+        self.events.append(("call", start, depth, callee))
+
+    def _close_call(self, end):
+        self.events.append(("/call", end))
+
+    def _open_class(self, class_name):
+        self.events.append(("class", class_name))
+
+    def _close_class(self):
+        self.events.append(("/class",))
+
+
+class _RecordingCodeElementExtractor(_EventRecorder, CodeElementExtractor):
+    pass
+
+
+class _RecordingAstElementExtractor(_EventRecorder, AstElementExtractor):
+    pass
+
+
+class _Chunk:
+    __slots__ = ("text", "events", "run_offsets", "run_widths", "base")
+
+    def __init__(self, text, events, run_offsets, run_widths, base):
+        self.text = text
+        self.events = events
+        self.run_offsets = run_offsets
+        self.run_widths = run_widths
+        self.base = base
+
+
+_BLOCK_CONTINUATIONS = frozenset(("else", "elif", "except", "finally"))
+
+# The tokens that decide where logical lines start: strings, comments, backslash
+# continuations, brackets and newlines. A quote that starts no string is an error.
+_CHUNK_TOKEN_RE = re.compile(r"""
+    '''[^'\\]*(?:(?:\\.|'(?!''))[^'\\]*)*'''
+  | \"\"\"[^"\\]*(?:(?:\\.|"(?!""))[^"\\]*)*\"\"\"
+  | '[^'\\\r\n]*(?:\\(?:\r\n|.)[^'\\\r\n]*)*'
+  | "[^"\\\r\n]*(?:\\(?:\r\n|.)[^"\\\r\n]*)*"
+  | (?P<quote>['"])
+  | \#[^\r\n]*
+  | \\(?:\r\n|\r|\n)
+  | (?P<open>[(\[{])
+  | (?P<close>[)\]}])
+  | (?P<newline>\r\n|\r|\n)
+""", re.S | re.X)
+_LINE_INDENT_RE = re.compile(r"[ \t\f]*")
+_LINE_WORD_RE = re.compile(r"\w*")
+
+
+def _top_level_chunks(code):
+    """
+        Offsets at which code splits into top-level statements.
+
+        Each chunk starts with the comments and blank lines that libcst attaches to
+        the statement as leading lines, and ends with the footer of its last block.
+        Decorators stay with their definition and else/elif/except/finally with
+        their statement. This is a single regex scan, several times cheaper than
+        tokenize; on malformed input the whole file is one chunk and the backend
+        reports the error.
+    """
+    starts = [0]
+    pending = []
+    outer_indent = None
+    seen_statement = False
+    decorator = False
+    paren_depth = 0
+
+    pos = 0
+    matches = _CHUNK_TOKEN_RE.finditer(code)
+    while True:
+        if pos is not None:
+            indent = _LINE_INDENT_RE.match(code, pos).group()
+            first = code[pos + len(indent):pos + len(indent) + 1]
+            if first in ("#", "\r", "\n", ""):
+                pending.append(pos)
+            elif indent:
+                if outer_indent is None:
+                    outer_indent = indent
+                pending = []
+            else:
+                if seen_statement and not decorator \
+                        and _LINE_WORD_RE.match(code, pos).group() not in _BLOCK_CONTINUATIONS:
+                    # lines up to the last one indented like the closed block are its footer
+                    lead = pending
+                    if outer_indent is not None:
+                        for i in range(len(pending) - 1, -1, -1):
+                            if code.startswith(outer_indent, pending[i]):
+                                lead = pending[i + 1:]
+                                break
+                    starts.append(lead[0] if lead else pos)
+
+                seen_statement = True
+                decorator = first == "@"
+                outer_indent = None
+                pending = []
+            pos = None
+
+        m = next(matches, None)
+        if m is None:
+            break
+
+        kind = m.lastgroup
+        if kind == "newline":
+            if paren_depth == 0:
+                pos = m.end()
+        elif kind == "open":
+            paren_depth += 1
+        elif kind == "close":
+            paren_depth -= 1
+            if paren_depth < 0:
+                return [0]
+        elif kind == "quote":
+            return [0]
+
+    return starts
+
+
+def _extract_chunk(text, backend, first, last, newline):
+    # Parsed behind/ahead of a "pass" statement, a chunk is split into leading lines,
+    # footers and indent runs exactly as it is inside the whole file.
+    prefix = "" if first else "pass" + newline
+    suffix = "" if last else "pass" + newline
+    code = prefix + text + suffix
+
+    if backend == "libcst":
+        extractor = _libcst_extractor(code, _RecordingCodeElementExtractor)
+    else:
+        extractor = _ast_extractor(code, _RecordingAstElementExtractor)
+
+    # the ast backend may have added a final newline to the last chunk
+    text = extractor.source[len(prefix):len(extractor.source) - len(suffix)]
+    return _Chunk(text, extractor.events, extractor._run_offsets, extractor._run_widths, len(prefix))
+
+
+def extract_code_elements(code: str, metrics=None, legacy_calls=False) -> Dict[
+    str, Union[cst.BaseCompoundStatement, Dict[str, cst.BaseCompoundStatement]]]:
+
+    # legacy_calls=True matches legacy_extract_code_elements (see SpanExtractor)
+    extractor = _link_extractor(_libcst_extractor(code, metrics=metrics), metrics=metrics, legacy_calls=legacy_calls)
+    return extractor.code_elements, extractor.callTree, extractor.nodeSet, extractor.callSet
+
+
+def extract_code_elements_ast(code: str, metrics=None, legacy_calls=False) -> Dict[
+    str, Union[cst.BaseCompoundStatement, Dict[str, cst.BaseCompoundStatement]]]:
+
+    extractor = _link_extractor(_ast_extractor(code, metrics=metrics), metrics=metrics, legacy_calls=legacy_calls)
+    return extractor.code_elements, extractor.callTree, extractor.nodeSet, extractor.callSet
+
+
+def legacy_extract_code_elements(code: str) -> Dict[
     str, Union[cst.BaseCompoundStatement, Dict[str, cst.BaseCompoundStatement]]]:
 
     module = cst.parse_module(code)
@@ -168,10 +1193,1425 @@ def stringify_code_elements(
     return result
 
 
-def parse_code(code):
+# Bump whenever parse_code output changes, so cached results from older parsers are not reused.
+PARSER_VERSION = "4"
+
+
+class ParseCache:
+    """
+        Content addressed on-disk cache of parse_code results.
+
+        Entries are keyed by a hash of the source bytes, PARSER_VERSION and the
+        backend, and stored zlib compressed in a sqlite database. When the stored
+        bytes grow past max_bytes the least recently used entries are evicted.
+        A CompactParseResult is stored in its columnar form, without rendering
+        its strings, and get() returns it as one.
+
+        Hit/miss counters, evictions and the parse time spent on misses and saved on
+        hits are kept in the database, so they add up across worker processes and
+        runs (see stats()). Each process opens its own connection on first use.
+
+        get() only reads, so processes sharing the cache do not queue for the write
+        lock on hits. The last_used times and hit counters of a process are written
+        flush_hits hits at a time, with its next put(), or by flush(), close() and
+        stats(). Until then other processes evict by older last_used times.
+    """
+
+    def __init__(self, path, max_bytes=1 << 30, flush_hits=256):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.flush_hits = flush_hits
+        self._conn = None
+        self._pid = None
+        self._used = {}
+        self._hits = 0
+        self._saved = 0.0
+
+    def __getstate__(self):
+        return {"path": self.path, "max_bytes": self.max_bytes, "flush_hits": self.flush_hits}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["max_bytes"], state["flush_hits"])
+
+    def _connect(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._pid = os.getpid()
+            # hits counted before a fork are written by the parent
+            self._used = {}
+            self._hits = 0
+            self._saved = 0.0
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key BLOB PRIMARY KEY, value BLOB, size INTEGER, seconds REAL, last_used REAL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS stats ("
+                "id INTEGER PRIMARY KEY CHECK (id = 0), hits INTEGER, misses INTEGER, evictions INTEGER, "
+                "bytes INTEGER, parse_seconds REAL, saved_seconds REAL)")
+            self._conn.execute("INSERT OR IGNORE INTO stats VALUES (0, 0, 0, 0, 0, 0.0, 0.0)")
+
+        return self._conn
+
+    def key(self, code, backend):
+        if isinstance(code, str):
+            code = code.encode("utf-8", errors="surrogatepass")
+
+        digest = hashlib.sha256(f"{PARSER_VERSION}\0{backend}\0".encode())
+        digest.update(code)
+        return digest.digest()
+
+    def get(self, code, backend):
+        conn = self._connect()
+        key = self.key(code, backend)
+        row = conn.execute("SELECT value, seconds FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        self._used[key] = time.time()
+        self._hits += 1
+        self._saved += row[1]
+        if self._hits >= self.flush_hits:
+            self.flush()
+
+        return _unpack_parse_result(row[0])
+
+    def _write_hits(self, conn):
+        conn.executemany("UPDATE entries SET last_used = ? WHERE key = ?",
+                         [(used, key) for key, used in self._used.items()])
+        conn.execute("UPDATE stats SET hits = hits + ?, saved_seconds = saved_seconds + ?", (self._hits, self._saved))
+        self._used = {}
+        self._hits = 0
+        self._saved = 0.0
+
+    def flush(self):
+        """
+            Writes the last_used times and hit counters of the hits since the last write.
+        """
+        if self._hits:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            self._write_hits(conn)
+            conn.execute("COMMIT")
+
+    def close(self):
+        self.flush()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def put(self, code, backend, result, seconds):
+        conn = self._connect()
+        value = _pack_parse_result(result)
+
+        conn.execute("BEGIN IMMEDIATE")
+        if self._hits:
+            self._write_hits(conn)
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?)",
+            (self.key(code, backend), value, len(value), seconds, time.time()))
+        stored = len(value) if cursor.rowcount == 1 else 0
+        conn.execute(
+            "UPDATE stats SET misses = misses + 1, bytes = bytes + ?, parse_seconds = parse_seconds + ?",
+            (stored, seconds))
+        total = conn.execute("SELECT bytes FROM stats").fetchone()[0]
+        if total > self.max_bytes:
+            self._evict(conn, total)
+        conn.execute("COMMIT")
+
+    def _evict(self, conn, total):
+        # evict down to 90% of the budget so eviction does not run on every insert
+        target = self.max_bytes * 0.9
+        freed = 0
+        evicted = 0
+        for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_used").fetchall():
+            if total - freed <= target:
+                break
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            freed += size
+            evicted += 1
+
+        conn.execute("UPDATE stats SET bytes = bytes - ?, evictions = evictions + ?", (freed, evicted))
+
+    def stats(self):
+        self.flush()
+        conn = self._connect()
+        hits, misses, evictions, size, parse_seconds, saved_seconds = conn.execute(
+            "SELECT hits, misses, evictions, bytes, parse_seconds, saved_seconds FROM stats").fetchone()
+        entries = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "entries": entries,
+            "bytes": size,
+            "evictions": evictions,
+            "parse_seconds": parse_seconds,
+            "saved_seconds": saved_seconds,
+        }
+
+
+_COMPACT_MAGIC = b"CTCR"
+
+# the array columns of a CompactParseResult, with its render tables
+_COMPACT_ARRAYS = ("kind", "name", "parent", "depth", "start", "end", "indent", "param_ptr", "param_ids", "defs",
+                   "def_rows", "def_calls", "emb_start", "emb_end", "emb_indent", "call_keys", "call_ptr", "call_ids",
+                   "call_counts", "qualnames", "edge_callers", "edge_callees", "edge_counts", "_run_offsets",
+                   "_tag_starts", "_tag_ends", "_tag_depths", "_tag_offsets", "_tag_closing", "truncated_rows")
+
+
+def _pack_compact_result(result):
+    # JSON metadata, then the arrays back to back in the machine's byte order
+    columns = [(name, getattr(result, name)) for name in _COMPACT_ARRAYS if getattr(result, name) is not None]
+    meta = json.dumps({"source": result.source, "symbols": result.symbols, "max_body_chars": result.max_body_chars,
+                       "run_widths": result._run_widths,
+                       "arrays": [[name, values.typecode, len(values)] for name, values in columns]}).encode("utf-8")
+    return b"".join([_COMPACT_MAGIC, struct.pack("<Q", len(meta)), meta, *(values.tobytes() for _, values in columns)])
+
+
+def _unpack_compact_result(data):
+    (meta_size,) = struct.unpack_from("<Q", data, len(_COMPACT_MAGIC))
+    start = len(_COMPACT_MAGIC) + 8 + meta_size
+    meta = json.loads(data[start - meta_size:start])
+
+    result = CompactParseResult(meta["source"], meta["symbols"])
+    result.max_body_chars = meta["max_body_chars"]
+    result._run_widths = [tuple(widths) for widths in meta["run_widths"]]
+    for name, typecode, count in meta["arrays"]:
+        values = array(typecode)
+        values.frombytes(data[start:start + count * values.itemsize])
+        setattr(result, name, values)
+        start += count * values.itemsize
+    return result
+
+
+def _pack_parse_result(result):
+    if isinstance(result, CompactParseResult):
+        return zlib.compress(_pack_compact_result(result))
+
+    # node_set only holds references to data dicts of the tree, it is rebuilt on load
+    stored = {key: value for key, value in result.items() if key != "node_set"}
+    return zlib.compress(json.dumps(stored).encode("utf-8"))
+
+
+def _unpack_parse_result(value):
+    data = zlib.decompress(value)
+    if data.startswith(_COMPACT_MAGIC):
+        return _unpack_compact_result(data)
+
+    result = json.loads(data)
+
+    # nodeSet[name] is the data of the last def with that name in pre order
+    nodes = {}
+    stack = [result["code"]]
+    while stack:
+        treeNode = stack.pop()
+        data = treeNode["__data__"]
+        if data.get("type") == "func":
+            nodes[data["name"]] = data
+        stack.extend(reversed(treeNode["__children__"]))
+
+    return {"code": result.pop("code"), "call_tree": result.pop("call_tree"), "node_set": nodes, **result}
+
+
+_parse_cache = None
+
+
+def set_parse_cache(cache):
+    """
+        Enables a ParseCache (or a path to one) for every parse_code call in this
+        process, including parse_code_batch workers. None disables caching.
+    """
+    global _parse_cache
+    _parse_cache = ParseCache(cache) if isinstance(cache, str) else cache
+
+
+def get_parse_cache():
+    return _parse_cache
+
+
+if os.environ.get("CODETREE_PARSE_CACHE"):
+    set_parse_cache(ParseCache(os.environ["CODETREE_PARSE_CACHE"], int(os.environ.get("CODETREE_PARSE_CACHE_BYTES", 1 << 30))))
+
+
+_BACKENDS = {
+    "libcst": extract_code_elements,
+    "ast": extract_code_elements_ast,
+}
+
+_EXTRACTORS = {
+    "libcst": _libcst_extractor,
+    "ast": _ast_extractor,
+}
+
+
+def _result_dict(extractor):
+    # call_edges: [caller, callee, count] with ids into symbols, in first seen order
+    return {"code": extractor.code_elements, "call_tree": extractor.callTree, "node_set": extractor.nodeSet,
+            "call_set": extractor.callSet, "symbols": extractor.symbols,
+            "call_edges": [[caller, callee, count] for (caller, callee), count in extractor.callEdges.items()]}
+
+
+RESULT_FORMAT_VERSION = 1
+
+
+def _node_table(result, string=None):
+    # The tables of dump_parse_result. string maps body and emb_repr to what is
+    # stored in their place, the text itself by default.
+    nodes = []
+    rows = {}
+    stack = [(child, -1) for child in reversed(result["code"]["__children__"])]
+    while stack:
+        treeNode, parent = stack.pop()
+        data = treeNode["__data__"]
+        rows[id(data)] = len(nodes)
+        stack.extend((child, len(nodes)) for child in reversed(treeNode["__children__"]))
+
+        body, emb_repr = data["body"], data.get("emb_repr")
+        if string is not None:
+            body, emb_repr = string(body), None if emb_repr is None else string(emb_repr)
+        nodes.append([parent, data["type"], data.get("name"), data["params"], body, emb_repr, data.get("truncated")])
+
+    node_set = result["node_set"]
+    def_rows = {name: rows[id(data)] for name, data in node_set.items()}
+
+    return {
+        "version": RESULT_FORMAT_VERSION,
+        "nodes": nodes,
+        "node_set": list(def_rows.values()),
+        "call_set": [result["call_set"][name] for name in node_set],
+        "call_tree": [[def_rows[caller], [field for callee, count in callees.items() for field in (def_rows[callee], count)]]
+                      for caller, callees in result["call_tree"].items()],
+        "symbols": result["symbols"],
+        "call_edges": result["call_edges"],
+    }
+
+
+def _check_format(stored):
+    if stored["version"] > RESULT_FORMAT_VERSION:
+        raise ValueError(f"parse result format {stored['version']} is newer than {RESULT_FORMAT_VERSION}")
+
+
+def _call_tree(stored, name):
+    call_tree = {}
+    for caller, callees in stored["call_tree"]:
+        call_tree[name(caller)] = {name(callees[i]): callees[i + 1] for i in range(0, len(callees), 2)}
+    return call_tree
+
+
+def _from_node_table(stored, string=None):
+    root = {"__data__": {"name": "root"}, "__children__": []}
+    nodes = []
+    for parent, kind, name, params, body, emb_repr, truncated in stored["nodes"]:
+        if string is not None:
+            body, emb_repr = string(body), None if emb_repr is None else string(emb_repr)
+
+        data = {"name": name, "params": params, "body": body, "type": kind} if kind == "func" else \
+            {"params": params, "body": body, "type": kind}
+        if truncated is not None:
+            data["truncated"] = truncated
+        if emb_repr is not None:
+            data["emb_repr"] = emb_repr
+
+        treeNode = {"__data__": data, "__children__": []}
+        (root if parent < 0 else nodes[parent])["__children__"].append(treeNode)
+        nodes.append(treeNode)
+
+    def name(row):
+        return nodes[row]["__data__"]["name"]
+
+    return {"code": root, "call_tree": _call_tree(stored, name),
+            "node_set": {name(row): nodes[row]["__data__"] for row in stored["node_set"]},
+            "call_set": {name(row): count for row, count in zip(stored["node_set"], stored["call_set"])},
+            "symbols": stored["symbols"], "call_edges": stored["call_edges"]}
+
+
+def dump_parse_result(result):
+    """
+        Serializes a parse_code dict to a JSON string that holds every node once.
+
+        json.dumps(result) writes each def twice, in code and again in node_set.
+        Here nodes are rows of a table in tree pre-order:
+        [parent, type, name, params, body, emb_repr, truncated], with parent the row
+        of the enclosing def or lambda (-1 under the root) and None for absent
+        fields. node_set is the list of rows it points at, call_set the counts in
+        the same order, and call_tree is [caller_row, [callee_row, count, ...]]
+        pairs. symbols and call_edges are kept as they are. load_parse_result
+        reverses it.
+    """
+    return json.dumps(_node_table(result))
+
+
+def load_parse_result(text):
+    """
+        Rebuilds the parse_code dict from dump_parse_result output. Plain
+        json.dumps of a parse_code dict, as stored before, is loaded as is.
+    """
+    stored = json.loads(text)
+    if "version" not in stored:
+        return stored
+    _check_format(stored)
+    return _from_node_table(stored)
+
+
+_RECORD_MAGIC = b"CTPR"
+
+# magic, format version, metadata bytes, number of strings
+_RECORD_HEADER = struct.Struct("<4sIQQ")
+
+
+def encode_parse_record(result):
+    """
+        Serializes a parse_code dict to a binary record whose strings can be
+        decoded one at a time (see ParseRecord).
+
+        The record is a header, the dump_parse_result tables as JSON with every
+        body and emb_repr replaced by a string id, an offset table of
+        little-endian uint64 (the start of every string plus the end of the last)
+        and the UTF-8 strings one after another.
+    """
+    strings = []
+
+    def string(text):
+        strings.append(text.encode("utf-8", errors="surrogatepass"))
+        return len(strings) - 1
+
+    meta = json.dumps(_node_table(result, string)).encode("utf-8")
+
+    offsets = [0]
+    for data in strings:
+        offsets.append(offsets[-1] + len(data))
+
+    return b"".join([_RECORD_HEADER.pack(_RECORD_MAGIC, RESULT_FORMAT_VERSION, len(meta), len(strings)), meta,
+                     struct.pack(f"<{len(offsets)}Q", *offsets), *strings])
+
+
+class ParseRecord:
+    """
+        Read access to an encode_parse_record record that only decodes what is used.
+
+        The call tree, node_set, call_set, symbols and call_edges and the node
+        metadata (parent, type, name, params, truncated) are decoded up front.
+        body() and emb_repr() decode a single string from the record when called.
+        Nodes are rows in tree pre-order, like in dump_parse_result.
+    """
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        magic, version, meta_size, count = _RECORD_HEADER.unpack_from(self.data)
+        if magic != _RECORD_MAGIC:
+            raise ValueError("not a parse record")
+
+        start = _RECORD_HEADER.size
+        self._meta = json.loads(bytes(self.data[start:start + meta_size]))
+        self._meta["version"] = version
+        _check_format(self._meta)
+
+        self._offsets = start + meta_size
+        self._strings = self._offsets + 8 * (count + 1)
+        self.nodes = self._meta["nodes"]
+        self.node_set = {self.nodes[row][2]: row for row in self._meta["node_set"]}
+        self.call_set = dict(zip(self.node_set, self._meta["call_set"]))
+        self.call_tree = _call_tree(self._meta, self.node_name)
+        self.symbols = self._meta["symbols"]
+        self.call_edges = self._meta["call_edges"]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _string(self, i):
+        start, end = struct.unpack_from("<QQ", self.data, self._offsets + 8 * i)
+        return str(self.data[self._strings + start:self._strings + end], "utf-8", "surrogatepass")
+
+    def parent(self, row):
+        return self.nodes[row][0]
+
+    def node_type(self, row):
+        return self.nodes[row][1]
+
+    def node_name(self, row):
+        return self.nodes[row][2]
+
+    def params(self, row):
+        return self.nodes[row][3]
+
+    def truncated(self, row):
+        return bool(self.nodes[row][6])
+
+    def body(self, row):
+        return self._string(self.nodes[row][4])
+
+    def emb_repr(self, name):
+        return self._string(self.nodes[self.node_set[name]][5])
+
+    def to_dict(self):
+        """
+            The parse_code dict for this record, decoding every string.
+        """
+        return _from_node_table(self._meta, self._string)
+
+
+def read_parse_record(value):
+    """
+        Reads a stored parse result: a ParseRecord for encode_parse_record output,
+        or the parse_code dict for JSON (dump_parse_result or plain json.dumps).
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)) and bytes(value[:4]) == _RECORD_MAGIC:
+        return ParseRecord(value)
+    return load_parse_result(value)
+
+def _arrow_row(stored, string=None):
+    nodes = []
+    depth = []
+    body_bytes = 0
+    for parent, kind, name, params, body, emb_repr, truncated in stored["nodes"]:
+        if string is not None:
+            body, emb_repr = string(body), None if emb_repr is None else string(emb_repr)
+        nodes.append({"parent": parent, "type": kind, "name": name, "params": params, "body": body,
+                      "emb_repr": emb_repr, "truncated": truncated})
+        depth.append(1 if parent < 0 else depth[parent] + 1)
+        body_bytes += len(body.encode("utf-8", errors="surrogatepass"))
+
+    return {
+        "version": stored["version"],
+        "nodes": nodes,
+        "node_set": stored["node_set"],
+        "call_set": stored["call_set"],
+        "call_tree": [{"caller": caller, "callees": callees[0::2], "counts": callees[1::2]}
+                      for caller, callees in stored["call_tree"]],
+        "symbols": stored["symbols"],
+        "call_edges": [{"caller": caller, "callee": callee, "count": count}
+                       for caller, callee, count in stored["call_edges"]],
+        "node_count": len(nodes),
+        "def_count": len(stored["node_set"]),
+        "edge_count": len(stored["call_edges"]),
+        "max_depth": max(depth, default=0),
+        "body_bytes": body_bytes,
+    }
+
+
+def parse_result_row(result):
+    """
+        One row of the arrow_schema() table for a parse_code dict or a
+        ParseRecord, as a dict of plain Python values.
+
+        The columns are the dump_parse_result tables as nested structs (nodes,
+        node_set, call_set, call_tree with callees and counts as separate
+        lists, symbols, call_edges), plus per-file stats to filter on without
+        reading them: node_count, def_count, edge_count, max_depth (1 for a
+        file with only top level defs, 0 without defs) and body_bytes, the
+        UTF-8 size of all node bodies.
+    """
+    if isinstance(result, ParseRecord):
+        return _arrow_row(result._meta, result._string)
+    return _arrow_row(_node_table(result))
+
+
+def parse_result_from_row(row):
+    """
+        Rebuilds the parse_code dict from a parse_result_row, or a row read back
+        from Arrow or Parquet with at least the nodes, node_set, call_set,
+        call_tree, symbols and call_edges columns.
+    """
+    stored = {
+        "version": row.get("version", RESULT_FORMAT_VERSION),
+        "nodes": [[node["parent"], node["type"], node["name"], node["params"], node["body"], node["emb_repr"],
+                   node["truncated"]] for node in row["nodes"]],
+        "node_set": row["node_set"],
+        "call_set": row["call_set"],
+        "call_tree": [[call["caller"], [field for pair in zip(call["callees"], call["counts"]) for field in pair]]
+                      for call in row["call_tree"]],
+        "symbols": row["symbols"],
+        "call_edges": [[edge["caller"], edge["callee"], edge["count"]] for edge in row["call_edges"]],
+    }
+    _check_format(stored)
+    return _from_node_table(stored)
+
+
+def arrow_schema():
+    """
+        The pyarrow schema of parse_result_row rows. parent, node_set and the
+        call_tree callers and callees are rows of nodes, the call_edges caller
+        and callee index symbols.
+    """
+    import pyarrow as pa
+
+    return pa.schema([
+        ("version", pa.int32()),
+        ("nodes", pa.list_(pa.struct([
+            ("parent", pa.int32()),
+            ("type", pa.string()),
+            ("name", pa.string()),
+            ("params", pa.list_(pa.string())),
+            ("body", pa.string()),
+            ("emb_repr", pa.string()),
+            ("truncated", pa.bool_()),
+        ]))),
+        ("node_set", pa.list_(pa.int32())),
+        ("call_set", pa.list_(pa.int64())),
+        ("call_tree", pa.list_(pa.struct([
+            ("caller", pa.int32()),
+            ("callees", pa.list_(pa.int32())),
+            ("counts", pa.list_(pa.int64())),
+        ]))),
+        ("symbols", pa.list_(pa.string())),
+        ("call_edges", pa.list_(pa.struct([
+            ("caller", pa.int32()),
+            ("callee", pa.int32()),
+            ("count", pa.int64()),
+        ]))),
+        ("node_count", pa.int32()),
+        ("def_count", pa.int32()),
+        ("edge_count", pa.int32()),
+        ("max_depth", pa.int32()),
+        ("body_bytes", pa.int64()),
+    ])
+
+
+def read_parse_table(source, columns=None, filters=None):
+    """
+        Reads Parquet files of parse_result_row rows (a path, a list of paths or
+        a prep output directory, for all its .parquet files) as a pyarrow Table
+        with only the given columns.
+
+        filters are pyarrow.parquet filters on the stats columns, e.g.
+        [("node_count", ">=", 4), ("max_depth", "<=", 8)]. Row groups whose
+        statistics rule them out are skipped without being read.
+    """
+    import pyarrow.parquet as pq
+
+    if isinstance(source, str) and os.path.isdir(source):
+        source = [os.path.join(source, name) for name in sorted(os.listdir(source)) if name.endswith(".parquet")]
+    return pq.read_table(source, columns=columns, filters=filters)
+
+
+FUNC, LAMBDA = 0, 1
+
+
+class CompactParseResult(_SpanRenderer):
+    """
+        Columnar form of a parse_code result that keeps a single copy of the source.
+
+        The nodes of the code tree are rows in pre-order, held in parallel arrays:
+        kind (FUNC or LAMBDA), name (id into symbols, -1 for lambdas), parent (row,
+        -1 under the root), depth in the tree, and start/end offsets into source
+        with the indentation depth (indent) the node sits at. Params are stored as
+        CSR arrays (param_ptr, param_ids) of symbol ids.
+
+        defs lists the node_set/call_set names in order, with the row node_set
+        points at, the call_set counts and the span emb_repr is rendered from.
+        call_tree is CSR as well: callees of symbols[call_keys[i]] are
+        call_ids[call_ptr[i]:call_ptr[i + 1]], with their counts in call_counts.
+        The qualified names of the parse_code symbols table are ids in qualnames,
+        and call_edges are the parallel edge_callers, edge_callees and edge_counts.
+
+        Strings are only rendered when asked for, through body(), emb_repr() and
+        to_dict(). from_dict converts a parse_code dict.
+
+        max_body_chars is taken over from the extractor and cuts strings as they
+        are rendered. Results converted from a dict keep their truncated flags in
+        truncated_rows instead.
+    """
+
+    def __init__(self, source, symbols):
+        self.source = source
+        self.symbols = symbols
+
+        self.kind = array("b")
+        self.name = array("i")
+        self.parent = array("i")
+        self.depth = array("i")
+        self.start = array("q")
+        self.end = array("q")
+        self.indent = array("i")
+        self.param_ptr = array("q", [0])
+        self.param_ids = array("i")
+
+        self.defs = array("i")
+        self.def_rows = array("i")
+        self.def_calls = array("q")
+        self.emb_start = array("q")
+        self.emb_end = array("q")
+        self.emb_indent = array("i")
+
+        self.call_keys = array("i")
+        self.call_ptr = array("q", [0])
+        self.call_ids = array("i")
+        self.call_counts = array("q")
+
+        self.qualnames = array("i")
+        self.edge_callers = array("i")
+        self.edge_callees = array("i")
+        self.edge_counts = array("q")
+
+        self._run_offsets = array("q")
+        self._run_widths = []
+        self._tag_starts = array("q")
+        self._tag_ends = array("q")
+        self._tag_depths = array("i")
+        self._tag_offsets = array("q")
+        self._tag_closing = array("b")
+        self._tag_text = {}
+        self._def_index = None
+        self.truncated_rows = None
+
+    def __len__(self):
+        return len(self.kind)
+
+    def _symbol(self, symbol_ids, name):
+        if name not in symbol_ids:
+            symbol_ids[name] = len(self.symbols)
+            self.symbols.append(name)
+        return symbol_ids[name]
+
+    def _add_node(self, symbol_ids, kind, name, params, parent, start, end, indent):
+        self.kind.append(kind)
+        self.name.append(-1 if name is None else self._symbol(symbol_ids, name))
+        self.parent.append(parent)
+        self.depth.append(0 if parent < 0 else self.depth[parent] + 1)
+        self.start.append(start)
+        self.end.append(end)
+        self.indent.append(indent)
+        self.param_ids.extend(self._symbol(symbol_ids, param) for param in params)
+        self.param_ptr.append(len(self.param_ids))
+
+    def _add_calls(self, symbol_ids, call_tree):
+        for caller, callees in call_tree.items():
+            self.call_keys.append(self._symbol(symbol_ids, caller))
+            for callee, count in callees.items():
+                self.call_ids.append(self._symbol(symbol_ids, callee))
+                self.call_counts.append(count)
+            self.call_ptr.append(len(self.call_ids))
+
+    def _add_edges(self, symbol_ids, qualnames, call_edges):
+        self.qualnames.extend(self._symbol(symbol_ids, qualname) for qualname in qualnames)
+        for caller, callee, count in call_edges:
+            self.edge_callers.append(caller)
+            self.edge_callees.append(callee)
+            self.edge_counts.append(count)
+
+    @classmethod
+    def from_extractor(cls, extractor):
+        """
+            Builds the compact result from a SpanExtractor after _link(), without
+            rendering any strings.
+        """
+        out = cls(extractor.source, [])
+        out.max_body_chars = extractor.max_body_chars
+        symbol_ids = {}
+
+        rows = {}
+        for record, parent in zip(extractor._nodes, extractor._parents):
+            data = record[-1]
+            rows[id(data)] = len(out)
+            kind = FUNC if data["type"] == "func" else LAMBDA
+            out._add_node(symbol_ids, kind, data.get("name"), data["params"], parent, record[0], record[1], record[2])
+
+        for name, data in extractor.nodeSet.items():
+            start, end, depth = extractor._emb_spans[name]
+            out.defs.append(out._symbol(symbol_ids, name))
+            out.def_rows.append(rows[id(data)])
+            out.def_calls.append(extractor.callSet[name])
+            out.emb_start.append(start)
+            out.emb_end.append(end)
+            out.emb_indent.append(depth)
+
+        out._add_calls(symbol_ids, extractor.callTree)
+        out._add_edges(symbol_ids, extractor.symbols,
+                       [(caller, callee, count) for (caller, callee), count in extractor.callEdges.items()])
+
+        out._run_offsets.extend(extractor._run_offsets)
+        out._run_widths = extractor._run_widths
+        out._tag_starts.extend(extractor._tag_starts)
+        out._tag_ends.extend(extractor._tag_ends)
+        out._tag_depths.extend(extractor._tag_depths)
+        out._tag_offsets.extend(extractor._tag_offsets)
+        out._tag_closing.extend(extractor._tag_closing)
+        return out
+
+    @classmethod
+    def from_dict(cls, result):
+        """
+            Converts a parse_code dict. Its bodies and emb_repr strings are laid out
+            one after another in source, so they are stored once but not shared.
+        """
+        parts = []
+        offset = 0
+
+        def place(text):
+            nonlocal offset
+            parts.append(text)
+            offset += len(text)
+            return offset - len(text), offset
+
+        out = cls("", [])
+        symbol_ids = {}
+        truncated = array("b")
+
+        rows = {}
+        stack = [(child, -1) for child in reversed(result["code"]["__children__"])]
+        while stack:
+            node, parent = stack.pop()
+            data = node["__data__"]
+            row = len(out)
+            rows[id(data)] = row
+            kind = FUNC if data["type"] == "func" else LAMBDA
+            out._add_node(symbol_ids, kind, data.get("name"), data["params"], parent, *place(data["body"]), 0)
+            if "truncated" in data:
+                truncated.append(data["truncated"])
+            stack.extend((child, row) for child in reversed(node["__children__"]))
+
+        for name, data in result["node_set"].items():
+            start, end = place(data["emb_repr"])
+            out.defs.append(out._symbol(symbol_ids, name))
+            out.def_rows.append(rows[id(data)])
+            out.def_calls.append(result["call_set"][name])
+            out.emb_start.append(start)
+            out.emb_end.append(end)
+            out.emb_indent.append(0)
+
+        out._add_calls(symbol_ids, result["call_tree"])
+        out._add_edges(symbol_ids, result["symbols"], result["call_edges"])
+        out.source = "".join(parts)
+        if len(truncated) == len(out) > 0:
+            out.truncated_rows = truncated
+        return out
+
+    # -- lazy accessors -------------------------------------------------------
+
+    def node_name(self, row):
+        name = self.name[row]
+        return None if name < 0 else self.symbols[name]
+
+    def params(self, row):
+        return [self.symbols[i] for i in self.param_ids[self.param_ptr[row]:self.param_ptr[row + 1]]]
+
+    def body(self, row):
+        return self._render(self.start[row], self.end[row], self.indent[row])[0]
+
+    def truncated(self, row):
+        """
+            Whether the body of the row, or the emb_repr of the def it is the
+            node_set entry for, was cut.
+        """
+        if self.truncated_rows is not None:
+            return bool(self.truncated_rows[row])
+        if self.max_body_chars is None:
+            return False
+        if self._render(self.start[row], self.end[row], self.indent[row])[1]:
+            return True
+
+        for i, def_row in enumerate(self.def_rows):
+            if def_row == row:
+                return self._render(self.emb_start[i], self.emb_end[i], self.emb_indent[i], splice=True)[1]
+        return False
+
+    def children(self, row):
+        rows = []
+        for child in range(row + 1, len(self)):
+            if self.depth[child] <= self.depth[row]:
+                break
+            if self.parent[child] == row:
+                rows.append(child)
+        return rows
+
+    def _def(self, name):
+        if self._def_index is None:
+            self._def_index = {self.symbols[symbol]: i for i, symbol in enumerate(self.defs)}
+        return self._def_index[name]
+
+    def emb_repr(self, name):
+        i = self._def(name)
+        return self._render(self.emb_start[i], self.emb_end[i], self.emb_indent[i], splice=True)[0]
+
+    def calls(self, name):
+        for i, symbol in enumerate(self.call_keys):
+            if self.symbols[symbol] == name:
+                return {self.symbols[self.call_ids[j]]: self.call_counts[j]
+                        for j in range(self.call_ptr[i], self.call_ptr[i + 1])}
+        return {}
+
+    def to_dict(self):
+        """
+            The parse_code dict for this result, rendering every string.
+        """
+        root = {"__data__": {"name": "root"}, "__children__": []}
+        nodes = []
+        for row in range(len(self)):
+            body, truncated = self._render(self.start[row], self.end[row], self.indent[row])
+            if self.kind[row] == FUNC:
+                data = {"name": self.node_name(row), "params": self.params(row), "body": body, "type": "func"}
+            else:
+                data = {"params": self.params(row), "body": body, "type": "lambda"}
+
+            if self.truncated_rows is not None:
+                data["truncated"] = bool(self.truncated_rows[row])
+            elif self.max_body_chars is not None:
+                data["truncated"] = truncated
+
+            treeNode = {"__data__": data, "__children__": []}
+            parent = self.parent[row]
+            (root if parent < 0 else nodes[parent])["__children__"].append(treeNode)
+            nodes.append(treeNode)
+
+        node_set = {}
+        call_set = {}
+        for i, symbol in enumerate(self.defs):
+            name = self.symbols[symbol]
+            data = nodes[self.def_rows[i]]["__data__"]
+            data["emb_repr"], truncated = self._render(self.emb_start[i], self.emb_end[i], self.emb_indent[i],
+                                                       splice=True)
+            if truncated:
+                data["truncated"] = True
+            node_set[name] = data
+            call_set[name] = self.def_calls[i]
+
+        call_tree = {}
+        for i, symbol in enumerate(self.call_keys):
+            call_tree[self.symbols[symbol]] = {self.symbols[self.call_ids[j]]: self.call_counts[j]
+                                               for j in range(self.call_ptr[i], self.call_ptr[i + 1])}
+
+        return {"code": root, "call_tree": call_tree, "node_set": node_set, "call_set": call_set,
+                "symbols": [self.symbols[symbol] for symbol in self.qualnames],
+                "call_edges": [[self.edge_callers[i], self.edge_callees[i], self.edge_counts[i]]
+                               for i in range(len(self.edge_counts))]}
+
+
+def parse_code(code, backend="libcst", compact=False, metrics=None, limits=None):
+    """
+        backend="libcst" parses with libcst. backend="ast" produces the same output
+        from the stdlib ast module and tokenize, which is several times faster.
+
+        compact=True returns a CompactParseResult instead of the dict, leaving all
+        strings unrendered until they are asked for.
+
+        When metrics is a dict, the seconds spent in each stage (parse_seconds,
+        extract_seconds, call_pass_seconds) and the number of tree nodes and call
+        sites are stored in it, or cache_hits=1 for a result served from the cache.
+
+        limits bounds the work spent on one file, as a dict with any of
+        max_body_chars, max_nodes and max_depth (see SpanExtractor). Files over
+        max_nodes or max_depth raise ParseLimitExceeded while they are walked.
+
+        Results are served from and stored to the parse cache when one is enabled
+        (set_parse_cache or the CODETREE_PARSE_CACHE environment variable).
+    """
+    if backend not in _BACKENDS:
+        raise ValueError(f"unknown parse backend {backend!r}, expected one of {sorted(_BACKENDS)}")
+    _check_limits(limits)
+
+    # limited results are cached apart from full ones
+    variant = backend
+    if limits:
+        variant += "".join(f"|{key}={limits.get(key)}" for key in _LIMITS)
+
+    cache = _parse_cache
+    if cache is not None:
+        out = cache.get(code, variant)
+        if out is not None:
+            if metrics is not None:
+                metrics["cache_hits"] = 1
+            if isinstance(out, CompactParseResult):
+                return out if compact else out.to_dict()
+            return CompactParseResult.from_dict(out) if compact else out
+
+    start = time.perf_counter()
+    if compact:
+        extractor = _link_extractor(_EXTRACTORS[backend](code, metrics=metrics, limits=limits), render=False,
+                                    metrics=metrics)
+        out = CompactParseResult.from_extractor(extractor)
+    else:
+        out = _result_dict(_link_extractor(_EXTRACTORS[backend](code, metrics=metrics, limits=limits), metrics=metrics))
+
+    if cache is not None:
+        cache.put(code, variant, out, time.perf_counter() - start)
+
+    return out
+
+
+class IncrementalParseResult(dict):
+    """
+        parse_code output that also keeps the per-statement extraction records
+        parse_code_incremental reuses for the next version of the file.
+
+        reused and parsed count the top-level statements taken from the previous
+        result and parsed anew.
+    """
+
+    def __init__(self, out, backend, chunks, reused, parsed):
+        dict.__init__(self, out)
+        self.backend = backend
+        self.chunks = chunks
+        self.reused = reused
+        self.parsed = parsed
+
+
+def parse_code_incremental(code, previous=None, backend="libcst"):
+    """
+        Re-parses a new version of a file, reusing the unchanged parts of previous.
+
+        The source is split into top-level statements by a regex scan of its lines
+        (_top_level_chunks), without tokenizing it. A statement whose text hash is
+        found in previous reuses the traversal events recorded for it; only changed
+        statements are parsed, each on its own. All statements are then replayed
+        into one SpanExtractor, which re-links call edges, tags and emb_repr over
+        the whole file, so the result is identical to parse_code(code, backend).
+
+        previous is an IncrementalParseResult from an earlier call (or None). Plain
+        parse_code dicts carry no records and lead to a full parse.
+    """
+    if backend not in _BACKENDS:
+        raise ValueError(f"unknown parse backend {backend!r}, expected one of {sorted(_BACKENDS)}")
+
+    if isinstance(code, bytes):
+        encoding, _ = tokenize.detect_encoding(io.BytesIO(code).readline)
+        code = code.decode(encoding)
+
+    known = {}
+    if isinstance(previous, IncrementalParseResult) and previous.backend == backend:
+        known = previous.chunks
+
+    starts = _top_level_chunks(code)
+
+    newline = re.search(r"\r\n|\r|\n", code)
+    newline = newline.group(0) if newline is not None else "\n"
+
+    extractor = SpanExtractor()
+    chunks = {}
+    parts = []
+    reused = 0
+    offset = 0
+    for i, start in enumerate(starts):
+        text = code[start:starts[i + 1] if i + 1 < len(starts) else len(code)]
+        first, last = i == 0, i + 1 == len(starts)
+        key = (hashlib.sha256(text.encode("utf-8", errors="surrogatepass")).digest(), first, last)
+
+        chunk = known.get(key)
+        if chunk is None:
+            chunk = _extract_chunk(text, backend, first, last, newline)
+        else:
+            reused += 1
+
+        chunks[key] = chunk
+        extractor._replay(chunk.events, chunk.run_offsets, chunk.run_widths, offset - chunk.base)
+        parts.append(chunk.text)
+        offset += len(chunk.text)
+
+    extractor.source = "".join(parts)
+    extractor.resolve()
+
+    return IncrementalParseResult(_result_dict(extractor), backend, chunks, reused, len(starts) - reused)
+
+# Cheap gates for looks_like_py2, one per Python 2 only construct it checks, each with a substring the
+# construct cannot do without (or None). The patterns start with a literal where they can, so that re
+# skips ahead to it instead of trying every position.
+_PY2_HINTS = (
+    # print x, exec x, raise E, msg and except E, e: at the start of a line
+    (None, re.compile(r"^[ \t]*(?:(?:print|exec)\b[ \t]*(?:[\w\"'\\]|>>|\.\d)"
+                      r"|raise[ \t]+[\w.]+(?:\([^()\n]*\))?[ \t]*,"
+                      r"|except[ \t]*(?:[\w.]+|\([^()\n]*\))[ \t]*,[ \t]*\w+[ \t]*:)", re.M)),
+    # `x` after =, %, +, a call's ( or return and print, not the quoting of docstrings
+    ("`", re.compile(r"`(?:(?<=[=%+]`)|(?<=[=%+] `)|(?<=\w\(`)|(?<=return `)|(?<=print `))[^`\n]+`")),
+    ("<>", re.compile(r"[\w)\]][ \t]*<>[ \t]*[\w(\[\"'-]")),
+    (None, re.compile(r"[uU][rR][\"'](?<!\w[uU][rR][\"'])")),
+    # 0777 after =, (, [, , or |, 0xFFL
+    (None, re.compile(r"0(?:(?<=[=(,\[|]0)|(?<=[=(,\[|] 0))[0-7]*[1-7][0-7]*(?![\w.])|0[xX][0-9a-fA-F]+[lL]\b")),
+    (None, re.compile(r"[lL]\b(?<=\d[lL])")),
+)
+
+
+def looks_like_py2(code):
+    """
+        Whether code uses syntax that only Python 2 accepts: print/exec statements,
+        "except E, e", "raise E, msg", backticks, <>, ur"" strings, 10L and 0777.
+
+        Regexes for the shape of each construct (a print statement has to
+        start a line, a py2 octal follows "=", "(" or ",") rule out most
+        Python 3 files. The rest are confirmed with tokenize, so the same text
+        inside strings and comments does not count.
+    """
+    if isinstance(code, bytes):
+        code = code.decode("utf-8", errors="replace")
+    if not any((needle is None or needle in code) and hint.search(code) for needle, hint in _PY2_HINTS):
+        return False
+
+    first = None
+    first_token = False
+    depth = 0
+    prev = None
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO(code).readline):
+            tok_type, string = tok.type, tok.string
+            if tok_type in (tokenize.NL, tokenize.COMMENT, tokenize.INDENT, tokenize.DEDENT):
+                continue
+            if tok_type == tokenize.NEWLINE:
+                first = prev = None
+                first_token = False
+                depth = 0
+                continue
+
+            adjacent = prev is not None and prev.end == tok.start
+            if tok_type == tokenize.ERRORTOKEN and string == "`":
+                return True
+            if first_token and prev.string in ("print", "exec") \
+                    and (tok_type in (tokenize.NAME, tokenize.NUMBER, tokenize.STRING) or string == ">>"):
+                return True
+            if adjacent and ((prev.string == "<" and string == ">")
+                             or (prev.type == tokenize.NUMBER and (tok_type == tokenize.NUMBER or string in "lL"))
+                             or (prev.string.lower() == "ur" and tok_type == tokenize.STRING)):
+                return True
+
+            if tok_type == tokenize.OP:
+                if string in "([{":
+                    depth += 1
+                elif string in ")]}":
+                    depth -= 1
+                elif depth == 0 and first in ("except", "raise"):
+                    if string == ",":
+                        return True
+                    if string == ":":
+                        first = ""
+
+            first_token = first is None
+            if first_token:
+                first = string
+            prev = tok
+    except (tokenize.TokenError, SyntaxError):
+        pass
+
+    return False
+
+
+def parse_failure(exc, code=None):
+    """
+        Structured reason for a file parse_code could not handle.
+
+        Syntax errors in code that uses Python 2 only syntax are reported as py2.
+    """
+    if isinstance(exc, (SyntaxError, ParserSyntaxError)):
+        reason = "syntax_error"
+        if code is not None and looks_like_py2(code):
+            reason = "py2"
+    elif isinstance(exc, ParseLimitExceeded):
+        reason = exc.reason
+    elif isinstance(exc, RecursionError):
+        reason = "recursion"
+    elif isinstance(exc, MemoryError):
+        reason = "memory"
+    else:
+        reason = "error"
+
+    detail = str(exc).strip().split("\n")[0]
+    return {"reason": reason, "detail": f"{type(exc).__name__}: {detail}"[:200]}
+
+
+class ParseStats:
+    """
+        Aggregates per-file parser metrics of a run into histograms.
+
+        record() takes the metrics dict parse_code fills in and the failure of the
+        file, if any. Every metric goes into a histogram with power of two buckets,
+        failures are counted by reason. merge() adds up stats of several processes
+        and to_dict()/dump() give the JSON report.
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.outcomes = {}
+        self.histograms = {}
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = {"count": 0, "sum": 0, "min": value, "max": value, "buckets": {}}
+
+        histogram["count"] += 1
+        histogram["sum"] += value
+        histogram["min"] = min(histogram["min"], value)
+        histogram["max"] = max(histogram["max"], value)
+
+        # bucket k holds values in (2 ** (k - 1), 2 ** k]
+        bucket = math.ceil(math.log2(value)) if value > 0 else None
+        histogram["buckets"][bucket] = histogram["buckets"].get(bucket, 0) + 1
+
+    def count(self, outcome, n=1):
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + n
+
+    def record(self, metrics=None, failure=None):
+        self.files += 1
+        self.count("ok" if failure is None else failure["reason"])
+        for name, value in (metrics or {}).items():
+            self.observe(name, value)
+
+    def merge(self, other):
+        self.files += other.files
+        for outcome, n in other.outcomes.items():
+            self.count(outcome, n)
+
+        for name, theirs in other.histograms.items():
+            ours = self.histograms.get(name)
+            if ours is None:
+                self.histograms[name] = {**theirs, "buckets": dict(theirs["buckets"])}
+                continue
+
+            ours["count"] += theirs["count"]
+            ours["sum"] += theirs["sum"]
+            ours["min"] = min(ours["min"], theirs["min"])
+            ours["max"] = max(ours["max"], theirs["max"])
+            for bucket, n in theirs["buckets"].items():
+                ours["buckets"][bucket] = ours["buckets"].get(bucket, 0) + n
+        return self
+
+    def to_dict(self):
+        histograms = {}
+        for name, histogram in sorted(self.histograms.items()):
+            buckets = sorted(histogram["buckets"].items(), key=lambda item: -math.inf if item[0] is None else item[0])
+            histograms[name] = {
+                "count": histogram["count"],
+                "sum": histogram["sum"],
+                "mean": histogram["sum"] / histogram["count"],
+                "min": histogram["min"],
+                "max": histogram["max"],
+                # upper bound of each bucket -> number of values
+                "buckets": {("0" if bucket is None else f"{2.0 ** bucket:g}"): n for bucket, n in buckets},
+            }
+
+        return {"files": self.files, "outcomes": dict(sorted(self.outcomes.items())), "histograms": histograms}
+
+    def dump(self, path, **extra):
+        with open(path, "w") as f:
+            json.dump({**self.to_dict(), **extra}, f, indent=2)
+
+    @classmethod
+    def from_dict(cls, report):
+        """
+            Restores stats from to_dict() output, e.g. a checkpoint, so they can
+            go on being recorded into or merged.
+        """
+        stats = cls()
+        stats.files = report["files"]
+        stats.outcomes = dict(report["outcomes"])
+        for name, histogram in report["histograms"].items():
+            stats.histograms[name] = {
+                "count": histogram["count"],
+                "sum": histogram["sum"],
+                "min": histogram["min"],
+                "max": histogram["max"],
+                "buckets": {(None if bound == "0" else round(math.log2(float(bound)))): n
+                            for bound, n in histogram["buckets"].items()},
+            }
+        return stats
+
+
+def _rss_bytes(pid="self"):
+    try:
+        with open(f"/proc/{pid}/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _batch_worker(conn, backend, max_rss, cache, limits):
+    set_parse_cache(cache)
+    try:
+        _batch_worker_loop(conn, backend, max_rss, limits)
+    finally:
+        if cache is not None:
+            cache.flush()
+
+
+def _batch_worker_loop(conn, backend, max_rss, limits):
+    while True:
+        try:
+            chunk = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+
+        if chunk is None:
+            return
+
+        for index, code in chunk:
+            metrics = {}
+            try:
+                result = (parse_code(code, backend=backend, metrics=metrics, limits=limits), None)
+            except Exception as e:
+                result = (None, parse_failure(e, code))
+
+            try:
+                conn.send((index, result, metrics))
+            except Exception as e:
+                conn.send((index, (None, parse_failure(e)), metrics))
+
+            rss = _rss_bytes() if max_rss else None
+            if rss is not None and rss > max_rss:
+                # ask to be replaced, whatever is left of the chunk gets requeued
+                conn.send((None, "recycle"))
+                return
+
+
+class _BatchWorker:
+
+    def __init__(self, ctx, backend, max_rss, limits):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_batch_worker, args=(child_conn, backend, max_rss, get_parse_cache(), limits),
+                                   daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.pending = deque()
+        self.started = 0.0
+
+    def send(self, chunk):
+        self.pending.extend(chunk)
+        self.started = time.monotonic()
+        self.conn.send(chunk)
+
+    def stop(self, kill=False):
+        if kill:
+            self.process.kill()
+        else:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+def parse_code_batch(iterable, workers=None, timeout=None, max_bytes=None, max_rss=None, chunksize=16, backend="libcst",
+                     stats=None, limits=None):
+    """
+        Parses many files in a pool of worker processes.
+
+        Yields one (result, failure) pair per input file, in input order. result is
+        the parse_code output, or None when the file was skipped, in which case
+        failure is a dict with a "reason" (too_large, too_many_nodes, too_deep,
+        syntax_error, py2, recursion, memory, timeout, worker_died, error) and a
+        "detail" string. limits are passed on to parse_code.
+
+        Files go to the workers in chunks of chunksize. A worker that spends more
+        than timeout seconds on one file, or grows past max_rss bytes of resident
+        memory, is killed and replaced, and the rest of its chunk is requeued.
+        Files longer than max_bytes are rejected without being sent. workers=0
+        parses in the calling process, without timeout or memory enforcement.
+
+        The per-file stage timings, counts and failures are recorded into stats
+        when a ParseStats is given.
+    """
+    _check_limits(limits)
+    source = enumerate(iterable)
+
+    def too_large(code):
+        return max_bytes is not None and len(code) > max_bytes
+
+    def finish(result, failure, metrics=None):
+        if stats is not None:
+            stats.record(metrics, failure)
+        return result, failure
+
+    if workers == 0:
+        for _, code in source:
+            if too_large(code):
+                yield finish(None, {"reason": "too_large", "detail": f"{len(code)} > {max_bytes} bytes"})
+                continue
+            metrics = {}
+            try:
+                out = parse_code(code, backend=backend, metrics=metrics, limits=limits)
+            except Exception as e:
+                yield finish(None, parse_failure(e, code), metrics)
+            else:
+                yield finish(out, None, metrics)
+        return
+
+    ctx = multiprocessing.get_context()
+    pool = [_BatchWorker(ctx, backend, max_rss, limits) for _ in range(workers or os.cpu_count() or 1)]
+    backlog = deque()
+    results = {}
+    next_index = 0
+    exhausted = False
+    poll = min(timeout / 4, 0.5) if timeout else 0.5
+
+    def replace(worker, failure=None):
+        if failure is not None and worker.pending:
+            results[worker.pending.popleft()[0]] = finish(None, failure)
+        backlog.extendleft(reversed(worker.pending))
+        worker.pending.clear()
+        worker.stop(kill=True)
+        pool[pool.index(worker)] = _BatchWorker(ctx, backend, max_rss, limits)
+
+    def next_chunk():
+        nonlocal exhausted
+        chunk = []
+        while len(chunk) < chunksize:
+            if backlog:
+                chunk.append(backlog.popleft())
+                continue
+            if exhausted:
+                break
+            try:
+                index, code = next(source)
+            except StopIteration:
+                exhausted = True
+                break
+            if too_large(code):
+                results[index] = finish(None, {"reason": "too_large", "detail": f"{len(code)} > {max_bytes} bytes"})
+            else:
+                chunk.append((index, code))
+        return chunk
+
+    try:
+        while True:
+            for worker in pool:
+                if not worker.pending:
+                    chunk = next_chunk()
+                    if chunk:
+                        worker.send(chunk)
+
+            while next_index in results:
+                yield results.pop(next_index)
+                next_index += 1
+
+            busy = [worker for worker in pool if worker.pending]
+            if not busy:
+                if exhausted and not backlog:
+                    break
+                continue
+
+            by_conn = {worker.conn: worker for worker in busy}
+            for conn in multiprocessing.connection.wait(list(by_conn), timeout=poll):
+                worker = by_conn[conn]
+                try:
+                    while conn.poll():
+                        message = conn.recv()
+                        if message[0] is None:
+                            replace(worker)
+                            break
+                        index, (result, failure), metrics = message
+                        results[index] = finish(result, failure, metrics)
+                        worker.pending.popleft()
+                        worker.started = time.monotonic()
+                except (EOFError, OSError):
+                    replace(worker, {"reason": "worker_died", "detail": f"exit code {worker.process.exitcode}"})
+
+            now = time.monotonic()
+            for worker in pool:
+                if not worker.pending:
+                    continue
+                if timeout and now - worker.started > timeout:
+                    replace(worker, {"reason": "timeout", "detail": f"exceeded {timeout}s"})
+                elif max_rss:
+                    rss = _rss_bytes(worker.process.pid)
+                    if rss is not None and rss > max_rss:
+                        replace(worker, {"reason": "memory", "detail": f"rss {rss} > {max_rss} bytes"})
+    finally:
+        for worker in pool:
+            worker.stop(kill=bool(worker.pending))
 
-    code_elements, callTree, nodes, callSet = extract_code_elements(code)
-    return {"code": code_elements, "call_tree": callTree, "node_set": nodes, "call_set":callSet}
 
 
 def main():
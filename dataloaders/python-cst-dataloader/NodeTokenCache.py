@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import sqlite3
+import struct
+from collections import OrderedDict
+
+import numpy as np
+
+
+def tokenizer_fingerprint(tokenizer):
+    """
+        A hash of everything about a tokenizer that decides its token ids: the
+        tokenizer class, the vocab (added tokens included) and the special
+        tokens. Token ids cached for one fingerprint are valid for any tokenizer
+        with the same fingerprint.
+    """
+    h = hashlib.sha256(type(tokenizer).__name__.encode())
+    for token, token_id in sorted(tokenizer.get_vocab().items(), key=lambda item: item[1]):
+        h.update(struct.pack("<q", token_id))
+        h.update(token.encode("utf-8", errors="surrogatepass"))
+        h.update(b"\0")
+    h.update(json.dumps(sorted(tokenizer.all_special_tokens)).encode())
+    return h.hexdigest()
+
+
+class NodeTokenCache:
+    """
+        Token ids of node strings (short_repr, prediction_repr), tokenized once
+        and then assembled into examples as int arrays.
+
+        ids(text) looks the text up by a hash of its content under the
+        tokenizer fingerprint, so nothing is tokenized twice. The max_entries
+        most recently used arrays are kept in memory (all without a limit) and
+        with a path every array is also stored in a sqlite database there, to
+        share them between DataLoader workers and runs. Each process opens its
+        own connection on first use and only takes the write lock to store
+        flush_rows new arrays at a time, the rest when sync() or close() is
+        called. Arrays are int32 and read-only.
+
+        token(marker) gives the id of a special token like "<node>", or the
+        ids of its text when the tokenizer does not have it as one token.
+        Text is tokenized without special tokens added, so pieces tokenized
+        apart can be joined, as the tokenizer does around special tokens.
+        Markers that are not special tokens stay apart from the text next to
+        them, where tokenizing one joined string can merge them into it.
+    """
+
+    def __init__(self, tokenizer, path=None, max_entries=None, flush_rows=256, fingerprint=None):
+        self.tokenizer = tokenizer
+        self.fingerprint = fingerprint or tokenizer_fingerprint(tokenizer)
+        self.path = path
+        self.max_entries = max_entries
+        self.flush_rows = flush_rows
+        self.hits = 0
+        self.misses = 0
+        self._ids = OrderedDict()
+        self._markers = {}
+        self._pending = {}
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        return {"tokenizer": self.tokenizer, "path": self.path, "max_entries": self.max_entries,
+                "flush_rows": self.flush_rows, "fingerprint": self.fingerprint}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _connect(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._pid = os.getpid()
+            self._pending = {}
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS tokens "
+                               "(fingerprint TEXT, digest BLOB, ids BLOB, PRIMARY KEY (fingerprint, digest))")
+
+        return self._conn
+
+    def _encode(self, text):
+        ids = np.array(self.tokenizer.encode(text, add_special_tokens=False), dtype=np.int32)
+        ids.flags.writeable = False
+        return ids
+
+    def ids(self, text):
+        digest = hashlib.blake2b(text.encode("utf-8", errors="surrogatepass"), digest_size=16).digest()
+        ids = self._ids.get(digest)
+        if ids is not None:
+            self._ids.move_to_end(digest)
+            self.hits += 1
+            return ids
+
+        stored = None
+        if self.path is not None:
+            ids = self._pending.get(digest)
+            if ids is None:
+                stored = self._connect().execute("SELECT ids FROM tokens WHERE fingerprint = ? AND digest = ?",
+                                                 (self.fingerprint, digest)).fetchone()
+        if ids is not None:
+            self.hits += 1
+        elif stored is not None:
+            ids = np.frombuffer(stored[0], dtype=np.int32)
+            self.hits += 1
+        else:
+            ids = self._encode(text)
+            self.misses += 1
+            if self.path is not None:
+                self._pending[digest] = ids
+                if len(self._pending) >= self.flush_rows:
+                    self.sync()
+
+        self._ids[digest] = ids
+        if self.max_entries is not None and len(self._ids) > self.max_entries:
+            self._ids.popitem(last=False)
+        return ids
+
+    def token(self, marker):
+        ids = self._markers.get(marker)
+        if ids is None:
+            token_id = self.tokenizer.convert_tokens_to_ids(marker)
+            if token_id is None or token_id == self.tokenizer.unk_token_id:
+                ids = self._encode(marker)
+            else:
+                ids = np.array([token_id], dtype=np.int32)
+                ids.flags.writeable = False
+            self._markers[marker] = ids
+        return ids
+
+    def artifacts(self, nodes):
+        """
+            The ids of "<artifacts><node>short_repr</node>...</artifacts>" for nodes.
+        """
+        node, end_node = self.token("<node>"), self.token("</node>")
+        parts = [self.token("<artifacts>")]
+        for sub_node in nodes:
+            parts.extend((node, self.ids(sub_node.short_repr()), end_node))
+        parts.append(self.token("</artifacts>"))
+        return np.concatenate(parts)
+
+    def sync(self):
+        if self._pending:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT OR IGNORE INTO tokens VALUES (?, ?, ?)",
+                             [(self.fingerprint, digest, ids.tobytes()) for digest, ids in self._pending.items()])
+            conn.execute("COMMIT")
+            self._pending = {}
+
+    def close(self):
+        self.sync()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._ids)}
@@ -5,7 +5,7 @@ from libcst import ParserSyntaxError
 import libcst
 
 class ShardIterator():
-    def __init__(self, ds, shard_func, batch_size=4, num_examples=0):
+    def __init__(self, ds, shard_func, batch_size=4, num_examples=0, token_cache=None):
         self.shards = []
         self.filtered_shards = []
         self.used_shards = []
@@ -16,6 +16,7 @@ class ShardIterator():
         self.ds = ds
         self.shard_func = shard_func
         self.num_examples = num_examples
+        self.token_cache = token_cache
 
         self.iterator = iter(ds)
         self.init_shards()
@@ -39,7 +40,7 @@ class ShardIterator():
         while len(self.filtered_shards) < self.batch_size:
             item = next(self.iterator)
             try:
-                self.add_shard(TreeShardV2(self.shard_func(item)))
+                self.add_shard(TreeShardV2(self.shard_func(item), token_cache=self.token_cache))
             except (RuntimeError, StopIteration):
                 continue
 
@@ -96,7 +97,7 @@ class ShardIterator():
                     try:
                         item = next(self.iterator)
                         shard = self.shard_func(item)
-                        self.add_shard(TreeShardV2(shard))
+                        self.add_shard(TreeShardV2(shard, token_cache=self.token_cache))
                         break
                     except RuntimeError:
                         continue
@@ -105,7 +106,7 @@ class ShardIterator():
 
 
 class ShardIteratorXL():
-    def __init__(self, ds, shard_func, batch_size=4, num_examples=0, num_emb_tokens=1):
+    def __init__(self, ds, shard_func, batch_size=4, num_examples=0, num_emb_tokens=1, token_cache=None):
         self.shards = []
         self.filtered_shards = []
         self.used_shards = []
@@ -116,6 +117,7 @@ class ShardIteratorXL():
         self.ds = ds
         self.shard_func = shard_func
         self.num_examples = num_examples
+        self.token_cache = token_cache
         self.num_emb_tokens = num_emb_tokens
 
         self.iterator = iter(ds)
@@ -140,7 +142,7 @@ class ShardIteratorXL():
         while len(self.filtered_shards) < self.batch_size:
             item = next(self.iterator)
             try:
-                self.add_shard(TreeShardXL(self.shard_func(item, self.num_emb_tokens)))
+                self.add_shard(TreeShardXL(self.shard_func(item, self.num_emb_tokens), token_cache=self.token_cache))
             except (RuntimeError, StopIteration):
                 continue
 
@@ -198,7 +200,7 @@ class ShardIteratorXL():
                     try:
                         item = next(self.iterator)
                         shard = self.shard_func(item, self.num_emb_tokens)
-                        self.add_shard(TreeShardXL(shard))
+                        self.add_shard(TreeShardXL(shard, token_cache=self.token_cache))
                         break
                     except RuntimeError:
                         continue
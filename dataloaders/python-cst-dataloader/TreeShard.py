@@ -1,6 +1,65 @@
-from .util import _treeBFS
+try:
+    from .util import _treeBFSLayout, _treeBFSWindows, _treeToParents, ParentTree
+except ImportError:
+    # imported as a top level module, as the tests in this directory do
+    from util import _treeBFSLayout, _treeBFSWindows, _treeToParents, ParentTree
+from collections import OrderedDict
 from typing import Dict
 
+import itertools
+import json
+import os
+import struct
+import numpy as np
+
+_SHARD_MAGIC = b"CTTS"
+_SHARD_VERSION = 1
+
+# magic, format version, metadata bytes
+_SHARD_HEADER = struct.Struct("<4sIQ")
+
+
+class _RenderedForm:
+    # one rendered form of every node as UTF-8 strings back to back in one buffer,
+    # appended as nodes are first read, with each node's byte start and end (-1 until rendered)
+    def __init__(self, size, data=None, offsets=None):
+        if data is None:
+            self.data = bytearray()
+            self.starts = np.full(size, -1, dtype=np.int64)
+            self.ends = np.full(size, -1, dtype=np.int64)
+        else:
+            # every node already rendered, as by write_tree_shard
+            self.data = data
+            self.starts = offsets[:-1]
+            self.ends = offsets[1:]
+
+    def get(self, idx, render):
+        start = int(self.starts[idx])
+        if start < 0:
+            text = render(idx)
+            encoded = text.encode("utf-8", errors="surrogatepass")
+            self.starts[idx] = len(self.data)
+            self.data += encoded
+            self.ends[idx] = len(self.data)
+            return text, len(encoded)
+
+        end = int(self.ends[idx])
+        return str(self.data[start:end], "utf-8", "surrogatepass"), end - start
+
+
+class _BlobList:
+    # a read-only list of JSON values stored back to back, decoded on access
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return json.loads(bytes(self.data[self.offsets[idx]:self.offsets[idx + 1]]))
+
+
 class TreeShard():
     def __init__(
             self,
@@ -8,54 +67,146 @@ class TreeShard():
             json_file_path=None,
             embed_dim=None,
             flatten_content=None,
+            window_cache_size=4096,
+            max_seq_len=None,
             ):
-        #should support arbitrary db reads/writes
-        pass
-
-        #If shard type == json
-        #   self.tree = load_json_tree
-        #else if shard type == <arbitrary_shard_type>
-        #   self.tree = load_arbitrary_tree
+        # shard_type "json" loads the tree in json_file_path with max_seq_len,
+        # "memmap" opens a write_tree_shard file at json_file_path (see load_memmap)
 
+        self.tree = None
         self.content = []
-        self.lengths = []
-        self.subtrees = []
-        self.depths = []
+        self.layout = None
+        self.max_seq_len = None
+        # subtree windows are built on first use, the window_cache_size most recent are kept
+        self.window_cache_size = window_cache_size
+        self._windows = OrderedDict()
+        self.depths = np.zeros(0, dtype=np.int32)
+        # nodes are numbered in bfs order, so the nodes at depth d are depth_offsets[d] to depth_offsets[d + 1]
+        self.depth_offsets = np.zeros(1, dtype=np.int64)
         self.filtered = []
         self.filtered_len = 0
         self.max_depth = -1
         self._flatten_content = None
+        # the signature-only and full body forms of the nodes read so far, or of
+        # every node of a memmap shard as rendered by the writer
+        self._rendered = (_RenderedForm(0), _RenderedForm(0))
+        # full body lengths of every node, built on first use
+        self._lengths = None
+        # subtree (offsets, indices) of a memmap shard
+        self._subtrees = None
+
+        if shard_type == "json":
+            with open(json_file_path) as f:
+                self.load_json(json.load(f), max_seq_len)
+        elif shard_type == "memmap":
+            self.load_memmap(json_file_path)
+        elif shard_type is not None:
+            raise ValueError(f"unknown shard type {shard_type!r}")
+        # after loading, so a memmap shard renders with flatten_content rather than as written
+        if flatten_content is not None:
+            self.set_flattener(flatten_content)
 
     def load_json(self, json, max_seq_len):
         tree = json
         if not isinstance(tree, dict):
             tree = json.parse(tree)
 
-        data_list, depth_list, subtrees, max_bfs = _treeBFS(tree, max_seq_len)
-
-        print(subtrees)
-        print(depth_list)
-
-        self.content = data_list
-        self.subtrees = subtrees
-        self.depths = depth_list
-        self.lengths = map(lambda x: len(x),  self.content)
-        self.max_depth = max_bfs
+        self.load_tree(_treeToParents(tree), max_seq_len)
+
+    def load_tree(self, tree: ParentTree, max_seq_len):
+        # the tree is never written to, so one ParentTree can back many shards
+        layout = _treeBFSLayout(tree)
+
+        self.tree = tree
+        self.layout = layout
+        self.max_seq_len = max_seq_len
+        self._windows.clear()
+        self._subtrees = None
+        self.content = [tree.payload[i] for i in layout.order]
+        self._clear_rendered()
+        self.depths = layout.depths
+        self.depth_offsets = np.searchsorted(self.depths, np.arange(layout.max_depth + 2)).astype(np.int64)
+        self.max_depth = layout.max_depth
+
+    @property
+    def lengths(self):
+        # UTF-8 bytes of every node's full body content, with the current flattener
+        if self._lengths is None:
+            full = self._rendered[True]
+            for i in np.flatnonzero(np.asarray(full.starts) < 0).tolist():
+                self._piece(i, True)
+            self._lengths = np.asarray(full.ends, dtype=np.int64) - np.asarray(full.starts, dtype=np.int64)
+            self._lengths.flags.writeable = False
+        return self._lengths
+
+    def node_length(self, idx, full=True):
+        return self._piece(idx, full)[1]
+
+    def nodes_at_depth(self, depth):
+        return np.arange(self.depth_offsets[depth], self.depth_offsets[depth + 1])
+
+    def load_memmap(self, path):
+        """
+            Opens a write_tree_shard file read-only through np.memmap. Only the
+            header is read, the arrays are views of the mapping that the page
+            cache shares between processes, and nodes are decoded when read.
+            The content rendered by the writer is used until set_flattener.
+        """
+        with open(path, "rb") as f:
+            magic, version, meta_size = _SHARD_HEADER.unpack(f.read(_SHARD_HEADER.size))
+            if magic != _SHARD_MAGIC:
+                raise ValueError(f"{path} is not a tree shard")
+            if version > _SHARD_VERSION:
+                raise ValueError(f"tree shard format {version} is newer than {_SHARD_VERSION}")
+            meta = json.loads(f.read(meta_size))
+
+        # plain ndarray views of the mapping, slicing np.memmap itself is slow
+        data = np.memmap(path, dtype=np.uint8, mode="r").view(np.ndarray)
+        arrays = {name: data[start:start + count * np.dtype(dtype).itemsize].view(dtype)
+                  for name, (start, dtype, count) in meta["arrays"].items()}
+
+        def blob(name):
+            # memoryviews index to python ints and slice without copying
+            return memoryview(arrays[name]), memoryview(arrays[name + "_offsets"])
+
+        def rendered(name):
+            data, offsets = blob(name)
+            return _RenderedForm(len(offsets) - 1, data, offsets)
+
+        self.tree = None
+        self.layout = None
+        self.max_seq_len = meta["max_seq_len"]
+        self._windows.clear()
+        self._subtrees = (arrays["subtree_offsets"], arrays["subtree_indices"])
+        self.content = _BlobList(*blob("payload"))
+        self.depths = arrays["depths"]
+        self.depth_offsets = arrays["depth_offsets"]
+        self.max_depth = meta["max_depth"]
+        self._rendered = (rendered("signature"), rendered("full"))
+        self._lengths = None
+
+    def subtree(self, idx):
+        if self._subtrees is not None:
+            offsets, indices = self._subtrees
+            return indices[offsets[idx]:offsets[idx + 1]].tolist()
+
+        window = self._windows.get(idx)
+        if window is None:
+            window = self.layout.window(idx, self.max_seq_len)
+            self._windows[idx] = window
+            if len(self._windows) > self.window_cache_size:
+                self._windows.popitem(last=False)
+        else:
+            self._windows.move_to_end(idx)
+        return list(window)
 
     def __getitem__(self, idx):
-        subtree = self.subtrees[idx]
-        node_content = []
-
-        length = 0
-
-        for i in subtree:
-            sig_flag = i == idx
-            c, l = self.get_content(i, flag=sig_flag)
-            node_content.append(c)
-            length += l
+        subtree = self.subtree(idx)
+        node_content, lengths = self._pieces(subtree, [i == idx for i in subtree])
+        length = sum(lengths)
 
         return {
-            "depth": self.depths[idx],
+            "depth": int(self.depths[idx]),
             "sub_node_content": node_content,
             "local_node_content": self.content[idx],
             "length": length,
@@ -65,11 +216,12 @@ class TreeShard():
 
     def set_flattener(self, func):
         self._flatten_content = func
+        self._clear_rendered()
 
     def init_depth(self, depth):
         has_depth = depth <= self.max_depth
         if has_depth:
-            self.filtered = [i for i in range(len(self.depths)) if self.depths[i] == depth]
+            self.filtered = list(range(self.depth_offsets[depth], self.depth_offsets[depth + 1]))
 
         self.filtered_len = len(self.filtered)
 
@@ -86,11 +238,39 @@ class TreeShard():
 
         return example
 
-    def get_content(self, idx, **kwargs):
+    def _render_node(self, idx, flag):
+        flat_content = self._flatten_content(self.content[idx], flag=flag) if self._flatten_content is not None else self.content[idx]
+        return "<n>" + str(idx) + ":" + str(self.depths[idx]) + ":" + flat_content + "</n>"
+
+    def _clear_rendered(self):
+        self._rendered = (_RenderedForm(len(self.content)), _RenderedForm(len(self.content)))
+        self._lengths = None
 
-        flat_content = self._flatten_content(self.content[idx], flag=kwargs["flag"]) if self._flatten_content is not None else self.content[idx]
-        s = "<n>" + str(idx) + ":" + str(self.depths[idx]) + ":" + flat_content + "</n>"
-        return s, len(s)
+    def _piece(self, idx, full):
+        # a node's rendered content and its UTF-8 bytes, formatted on first read
+        return self._rendered[full].get(idx, lambda i: self._render_node(i, full))
+
+    def _pieces(self, indices, full):
+        pieces = []
+        lengths = []
+        for i, f in zip(indices, itertools.repeat(full) if isinstance(full, bool) else full):
+            piece, length = self._piece(i, f)
+            pieces.append(piece)
+            lengths.append(length)
+        return pieces, lengths
+
+    def get_content(self, idx, **kwargs):
+        (content,), (length,) = self._pieces([idx], bool(kwargs["flag"]))
+        return content, length
+
+    def get_batch(self, indices, full=False):
+        """
+            The rendered content of many nodes joined into one string, and an
+            array of their lengths in UTF-8 bytes. full picks the full body form over the
+            signature-only one, for all nodes or per node as a sequence of bools.
+        """
+        pieces, lengths = self._pieces(indices, full)
+        return "".join(pieces), np.array(lengths, dtype=np.int64)
 
     def _collate(self, data1, data2):
         return data1 + data2
@@ -101,6 +281,78 @@ class TreeShard():
             data_list.append(self._add_node_tokens_to_data(data))
 
         self.content = data_list
+        self._clear_rendered()
+
+def _aligned(offset):
+    return (offset + 7) & ~7
+
+
+def write_tree_shard(path, tree, max_seq_len, flatten_content=None):
+    """
+        Writes a tree (a {__data__, __children__} dict, a ParentTree or the path
+        of a JSON file with one) as a TreeShard file for load_memmap.
+
+        The file is a header (magic, format version, metadata size), JSON
+        metadata with the offset, dtype and length of every array, and the
+        arrays 8-byte aligned: depths and depth_offsets, the capped subtrees of
+        max_seq_len in CSR form (subtree_offsets, subtree_indices), the node
+        payloads as JSON and both rendered forms of every node (signature-only
+        and full body, with flatten_content), each as a UTF-8 blob with int64
+        byte offsets. Nodes are in bfs order, as in a loaded TreeShard.
+    """
+    if isinstance(tree, str):
+        with open(tree) as f:
+            tree = json.load(f)
+    if not isinstance(tree, ParentTree):
+        tree = _treeToParents(tree)
+
+    shard = TreeShard(flatten_content=flatten_content)
+    shard.load_tree(tree, max_seq_len)
+    windows = _treeBFSWindows(tree, max_seq_len)
+
+    def blob(strings):
+        data = [string.encode("utf-8", errors="surrogatepass") for string in strings]
+        offsets = np.zeros(len(data) + 1, dtype=np.int64)
+        np.cumsum([len(item) for item in data], out=offsets[1:])
+        return np.frombuffer(b"".join(data), dtype=np.uint8), offsets
+
+    arrays = {
+        "depths": shard.depths.astype(np.int32),
+        "depth_offsets": shard.depth_offsets.astype(np.int64),
+        "subtree_offsets": windows.offsets.astype(np.int64),
+        "subtree_indices": windows.indices.astype(np.int32),
+    }
+    arrays["payload"], arrays["payload_offsets"] = blob(json.dumps(data) for data in shard.content)
+    for full, form in ((False, "signature"), (True, "full")):
+        arrays[form], arrays[form + "_offsets"] = blob(shard._render_node(i, full) for i in range(len(shard.content)))
+
+    def layout(start):
+        # offsets of the arrays, given where they start
+        placed = {}
+        for name, values in arrays.items():
+            start = _aligned(start)
+            placed[name] = [start, values.dtype.str, len(values)]
+            start += values.nbytes
+        return placed
+
+    # the arrays start after the metadata, which lists where they start
+    meta = {"nodes": len(shard.content), "max_seq_len": max_seq_len, "max_depth": shard.max_depth, "arrays": {}}
+    while True:
+        start = _aligned(_SHARD_HEADER.size + len(json.dumps(meta).encode()))
+        placed = layout(start)
+        if placed == meta["arrays"]:
+            break
+        meta["arrays"] = placed
+    encoded = json.dumps(meta).encode()
+
+    with open(path + ".tmp", "wb") as f:
+        f.write(_SHARD_HEADER.pack(_SHARD_MAGIC, _SHARD_VERSION, len(encoded)))
+        f.write(encoded)
+        for name, values in arrays.items():
+            f.seek(meta["arrays"][name][0])
+            f.write(values.tobytes())
+    os.replace(path + ".tmp", path)
+
 
 def getTreeDepthIterator(shard_iterator, depth):
 
@@ -147,19 +399,39 @@ class TreeShardV2:
     def __init__(
             self,
             nodes,
-            tree_generator=None
+            tree_generator=None,
+            token_cache=None
     ):
 
         self.nodes = nodes
         self.tree_generator = tree_generator
         self.all_nodes = nodes
+        self.token_cache = token_cache
 
 
     def __getitem__(self, idx):
         return self._prep_node(self.all_nodes[idx])
 
     def _prep_node(self, node):
+        """
+            With a token_cache the example holds token ids in place of the
+            strings: target_ids, input_ids and node_content_ids.
+        """
         root = node
+        if self.token_cache is not None:
+            cache = self.token_cache
+            node_content = cache.artifacts(root.get_children())
+            target = cache.ids(root.prediction_repr())
+            return {
+                "target_ids": target,
+                "input": {
+                    "input_ids": np.concatenate((cache.token("<begin_code>"), node_content, target,
+                                                 cache.token("<end_code>"))),
+                    "node_content_ids": node_content
+                },
+                "root": node
+            }
+
         node_content = ""
 
         for child in root.get_children():
@@ -200,19 +472,36 @@ class TreeShardXL:
     def __init__(
             self,
             nodes,
-            tree_generator=None
+            tree_generator=None,
+            token_cache=None
     ):
 
         self.nodes = nodes
         self.tree_generator = tree_generator
         self.all_nodes = nodes
+        self.token_cache = token_cache
 
 
     def __getitem__(self, idx):
         return self._prep_node(self.all_nodes[idx])
 
     def _prep_node(self, node):
+        """
+            With a token_cache the example holds token ids in place of the
+            strings: input_ids, node_ids and contrastive_ids.
+        """
         root = node
+        if self.token_cache is not None:
+            target = self.token_cache.ids(root.prediction_repr())
+            return {
+                "input": {
+                    "input_ids": target,
+                    "node_ids": [self.token_cache.ids(child.short_repr()) for child in root.get_children()],
+                    "contrastive_ids": target
+                },
+                "root": node
+            }
+
         node_content = []
 
         for child in root.get_children():
@@ -1,5 +1,6 @@
-from .TreeShard import TreeShard, TreeShardV2
+from .TreeShard import TreeShard, TreeShardV2, write_tree_shard
 from .RecursiveShardIterator import ShardIterator, ShardIteratorXL
 from .CodeTreeParser import parse_code
+from .NodeTokenCache import NodeTokenCache
 from .recursive import CodeNode
 from .train_recursive import create_code_shard
\ No newline at end of file
@@ -0,0 +1,107 @@
+import argparse
+import functools
+import glob
+import json
+import os
+import time
+
+from CodeTreeParser import extract_code_elements, extract_code_elements_ast, legacy_extract_code_elements
+
+"""
+    Parser benchmark.
+
+    Times the two visitor extraction (legacy_extract_code_elements) against the
+    single pass libcst extractor (extract_code_elements) and the stdlib ast backend
+    (extract_code_elements_ast) on real files.
+
+    With legacy_calls=True both extractors are checked to produce the output of
+    the visitors. Their default output, with call_tree, call_set and the call tags
+    derived from the call edges, differs from it (see SpanExtractor) and is timed
+    in the edges columns, after checking that the two backends agree on it.
+
+    usage: python bench_parser.py <file or dir> [...] --top 20 --repeat 3
+"""
+
+
+def collect_files(paths, top):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += glob.glob(os.path.join(path, "**", "*.py"), recursive=True)
+        else:
+            files.append(path)
+
+    files.sort(key=os.path.getsize, reverse=True)
+    return files[:top] if top > 0 else files
+
+
+def time_call(func, code, repeat):
+    best = None
+    out = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = func(code)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--top", type=int, default=20, help="only benchmark the N largest files (0 for all)")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    total_before = 0.0
+    total_after = 0.0
+    total_ast = 0.0
+    total_edges = 0.0
+    total_ast_edges = 0.0
+    total_bytes = 0
+
+    parity = functools.partial(extract_code_elements, legacy_calls=True)
+    parity_ast = functools.partial(extract_code_elements_ast, legacy_calls=True)
+
+    print(f"{'file':<60} {'KB':>8} {'legacy':>9} {'libcst':>9} {'ast':>9} {'edges':>9} {'ast edges':>10} "
+          f"{'speedup':>8}")
+    for path in collect_files(args.paths, args.top):
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            code = f.read()
+
+        try:
+            before, expected = time_call(legacy_extract_code_elements, code, args.repeat)
+        except Exception:
+            continue
+
+        after, actual = time_call(parity, code, args.repeat)
+        if json.dumps(expected) != json.dumps(actual):
+            raise AssertionError(f"output mismatch for {path}")
+
+        with_ast, actual = time_call(parity_ast, code, args.repeat)
+        if json.dumps(expected) != json.dumps(actual):
+            raise AssertionError(f"ast backend output mismatch for {path}")
+
+        edges, expected = time_call(extract_code_elements, code, args.repeat)
+        ast_edges, actual = time_call(extract_code_elements_ast, code, args.repeat)
+        if json.dumps(expected) != json.dumps(actual):
+            raise AssertionError(f"ast backend call edge output mismatch for {path}")
+
+        total_before += before
+        total_after += after
+        total_ast += with_ast
+        total_edges += edges
+        total_ast_edges += ast_edges
+        total_bytes += len(code)
+
+        print(f"{path[-60:]:<60} {len(code) / 1024:>8.1f} {before:>8.3f}s {after:>8.3f}s {with_ast:>8.3f}s "
+              f"{edges:>8.3f}s {ast_edges:>9.3f}s {before / ast_edges:>7.2f}x")
+
+    if total_after > 0:
+        print(f"{'total':<60} {total_bytes / 1024:>8.1f} {total_before:>8.3f}s {total_after:>8.3f}s {total_ast:>8.3f}s "
+              f"{total_edges:>8.3f}s {total_ast_edges:>9.3f}s {total_before / total_ast_edges:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
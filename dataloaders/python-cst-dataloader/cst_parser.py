@@ -113,7 +113,6 @@ class CodeExtractorVisitor(cst.CSTTransformer):
 
         call = self.module.code_for_node(updated_node).strip()
         check_val = call.split("(")[0].split(".")[-1]
-        print(check_val)
         if check_val in self.callSet:
             final_node = Comment(value=('#<call>' + call.replace("\n", "") + '<emb></call>'))
         else:
@@ -1,40 +1,901 @@
+import argparse
+import functools
+import itertools
+import hashlib
 import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import struct
+import time
+from collections import deque
+from queue import Empty
 
-from datasets import load_dataset, Dataset
-from CodeTreeParser import parse_code
+from CodeTreeParser import parse_code_batch, get_parse_cache, looks_like_py2, dump_parse_result, encode_parse_record, \
+    parse_result_row, read_parse_record, arrow_schema, ParseStats, RESULT_FORMAT_VERSION, PARSER_VERSION
 
-from libcst import ParserSyntaxError
+_DEF_RE = re.compile(r"\b(?:def|lambda)\b")
 
-def py3Filter(batch):
-    files = []
-    for example in batch:
-        try:
-            out = parse_code(example)
-            if len(out["node_set"]) == 0:
-                continue
-            files.append(json.dumps(out))
-        except Exception:
+
+class Prefilter:
+    """
+        Rejects files that would fail to parse or leave node_set empty, before any
+        parsing is paid for.
+
+        Rules run cheapest first: too_large (more than max_bytes in UTF-8),
+        long_lines (a line longer than max_line_length, or lines longer than
+        max_mean_line_length on average, as in minified or generated code),
+        no_defs (no def or lambda anywhere) and py2 (looks_like_py2). A limit of
+        None turns its rule off. counts holds the number of files each rule
+        rejected and the number passed.
+    """
+
+    def __init__(self, max_bytes=1 << 20, max_line_length=2000, max_mean_line_length=200, require_defs=True,
+                 reject_py2=True):
+        self.max_bytes = max_bytes
+        self.max_line_length = max_line_length
+        self.max_mean_line_length = max_mean_line_length
+        self.require_defs = require_defs
+        self.reject_py2 = reject_py2
+        self.counts = {"passed": 0}
+
+    def rule(self, code):
+        # a character is at most 4 bytes, so most files are not encoded to be measured
+        if self.max_bytes is not None and len(code) * 4 > self.max_bytes and \
+                len(code.encode("utf-8", errors="surrogatepass")) > self.max_bytes:
+            return "too_large"
+
+        if self.max_line_length is not None or self.max_mean_line_length is not None:
+            lines = code.splitlines() or [""]
+            if self.max_line_length is not None and max(map(len, lines)) > self.max_line_length:
+                return "long_lines"
+            if self.max_mean_line_length is not None and len(code) / len(lines) > self.max_mean_line_length:
+                return "long_lines"
+
+        if self.require_defs and not _DEF_RE.search(code):
+            return "no_defs"
+
+        if self.reject_py2 and looks_like_py2(code):
+            return "py2"
+
+        return None
+
+    def __call__(self, code):
+        rule = self.rule(code)
+        key = "passed" if rule is None else rule
+        self.counts[key] = self.counts.get(key, 0) + 1
+        return rule is None
+
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+_EMPTY_BIN = 0xFFFFFFFF
+
+
+def minhash(code, num_perm=128, shingle=5):
+    """
+        MinHash signature of the token shingles of code, as num_perm uint32 values.
+
+        Uses one permutation hashing: every shingle is hashed once and the hash
+        picks a bin and the value competing for its minimum. Bins no shingle fell
+        into take the value of the next filled bin, so the fraction of equal values
+        of two signatures estimates the Jaccard similarity of their shingle sets.
+    """
+    tokens = _TOKEN_RE.findall(code)
+    signature = [_EMPTY_BIN] * num_perm
+    for i in range(max(1, len(tokens) - shingle + 1)):
+        text = " ".join(tokens[i:i + shingle]).encode("utf-8", errors="surrogatepass")
+        h = int.from_bytes(hashlib.blake2b(text, digest_size=8).digest(), "little")
+        b, value = h % num_perm, (h // num_perm) & 0xFFFFFFFE
+        if value < signature[b]:
+            signature[b] = value
+
+    filled = [value != _EMPTY_BIN for value in signature]
+    if any(filled) and not all(filled):
+        # densify from right to left, offset by the distance so copies from different bins differ
+        source = filled.index(True) + num_perm
+        for b in range(num_perm - 1, -1, -1):
+            if filled[b]:
+                source = b
+            else:
+                signature[b] = (signature[source % num_perm] + source - b) & 0xFFFFFFFF
+
+    return signature
+
+
+def _lsh_params(threshold, num_perm):
+    # (bands, rows) whose S-curve 1 - (1 - s^rows)^bands has the least false positive
+    # plus false negative area around threshold
+    def area(bands, rows, low, high):
+        steps = 100
+        return sum(1 - (1 - ((low + (high - low) * (i + 0.5) / steps) ** rows)) ** bands for i in range(steps)) \
+            * (high - low) / steps
+
+    best = None
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        error = area(bands, rows, 0.0, threshold) + (1 - threshold) - area(bands, rows, threshold, 1.0)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+class Deduplicator:
+    """
+        Drops exact and near duplicate files from a stream, keeping the first copy.
+
+        Exact copies are found by a hash of the file. Near duplicates are files
+        whose MinHash signature (see minhash) estimates a Jaccard similarity of
+        their token shingles of at least threshold with a file seen before. The
+        candidates are looked up with LSH: the signature is cut into bands, chosen
+        for threshold, and files sharing any band are compared.
+
+        The index lives in a sqlite database at path (in memory when None), so it
+        stays out of the process heap and can be reused by a later run. Changes
+        are committed by sync(). seq numbers the files added and rollback(seq)
+        forgets every file added after it, for resuming from a checkpoint. With
+        max_entries, only the last max_entries files as of the last sync() are
+        matched against, and older ones are deleted on the sync() after.
+
+        counts and removed_bytes give the number of files kept and removed as
+        "exact" or "near" duplicates, and their bytes.
+    """
+
+    def __init__(self, path=None, threshold=0.85, num_perm=128, shingle=5, max_entries=None):
+        self.path = path
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle = shingle
+        self.max_entries = max_entries
+        self.bands, self.rows = _lsh_params(threshold, num_perm)
+        self.counts = {"kept": 0, "exact": 0, "near": 0}
+        self.removed_bytes = {"exact": 0, "near": 0}
+
+        self._conn = sqlite3.connect(path or ":memory:", isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS files (seq INTEGER PRIMARY KEY, digest BLOB UNIQUE, signature BLOB)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS bands (key INTEGER, seq INTEGER)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS bands_key ON bands (key)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS bands_seq ON bands (seq)")
+        self.seq = self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM files").fetchone()[0]
+        self._horizon = self._horizon_at(self.seq)
+        self._conn.execute("BEGIN")
+
+    def _horizon_at(self, seq):
+        # files up to the horizon are no longer matched against
+        return max(seq - self.max_entries, 0) if self.max_entries is not None else 0
+
+    def _band_keys(self, signature):
+        keys = []
+        for band in range(self.bands):
+            values = signature[band * self.rows:(band + 1) * self.rows]
+            digest = hashlib.blake2b(struct.pack(f"<I{self.rows}I", band, *values), digest_size=8).digest()
+            keys.append(int.from_bytes(digest, "little") >> 1)
+        return keys
+
+    def rule(self, code):
+        """
+            None for a file seen for the first time, which is added to the index,
+            otherwise "exact" or "near".
+        """
+        data = code.encode("utf-8", errors="surrogatepass")
+        digest = hashlib.sha256(data).digest()
+        if self._conn.execute("SELECT 1 FROM files WHERE digest = ? AND seq > ?",
+                              (digest, self._horizon)).fetchone() is not None:
+            return "exact"
+
+        signature = minhash(code, self.num_perm, self.shingle)
+        keys = self._band_keys(signature)
+        candidates = set()
+        for key in keys:
+            candidates.update(seq for seq, in self._conn.execute("SELECT seq FROM bands WHERE key = ? AND seq > ?",
+                                                                 (key, self._horizon)))
+
+        for seq in sorted(candidates):
+            other = struct.unpack(f"<{self.num_perm}I", self._conn.execute(
+                "SELECT signature FROM files WHERE seq = ?", (seq,)).fetchone()[0])
+            if sum(a == b for a, b in zip(signature, other)) >= self.threshold * self.num_perm:
+                return "near"
+
+        self.seq += 1
+        self._conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                           (self.seq, digest, struct.pack(f"<{self.num_perm}I", *signature)))
+        self._conn.executemany("INSERT INTO bands VALUES (?, ?)", ((key, self.seq) for key in keys))
+        return None
+
+    def __call__(self, code):
+        rule = self.rule(code)
+        if rule is None:
+            self.counts["kept"] += 1
+        else:
+            self.counts[rule] += 1
+            self.removed_bytes[rule] += len(code.encode("utf-8", errors="surrogatepass"))
+        return rule is None
+
+    def _forget(self, condition, seq):
+        self._conn.execute(f"DELETE FROM files WHERE {condition}", (seq,))
+        self._conn.execute(f"DELETE FROM bands WHERE {condition}", (seq,))
+
+    def sync(self):
+        """
+            Commits the index to disk.
+        """
+        # deleting lags a sync behind, so a rollback to the previous sync still finds its files
+        if self._horizon:
+            self._forget("seq <= ?", self._horizon)
+        self._horizon = self._horizon_at(self.seq)
+        self._conn.execute("COMMIT")
+        self._conn.execute("BEGIN")
+
+    def rollback(self, seq):
+        self._forget("seq > ?", seq)
+        self.seq = seq
+        self._horizon = self._horizon_at(seq)
+        self._conn.execute("COMMIT")
+        self._conn.execute("BEGIN")
+
+    def close(self):
+        self._conn.execute("COMMIT")
+        self._conn.close()
+
+    def report(self):
+        return {"counts": dict(self.counts), "removed_bytes": dict(self.removed_bytes), "seq": self.seq}
+
+
+def iter_records(codes, backend="ast", workers=0, timeout=None, max_bytes=None, stats=None, prefilter=None,
+                 limits=None, encoding="record", chunksize=16, dedup=None):
+    """
+        Streams codes through the prefilter, the Deduplicator dedup and
+        parse_code_batch, yielding the serialized result of every file that parsed
+        and has defs. encoding="record" gives encode_parse_record bytes, "json"
+        dump_parse_result strings and "row" parse_result_row dicts.
+    """
+    if prefilter is not None:
+        codes = (code for code in codes if prefilter(code))
+    if dedup is not None:
+        codes = (code for code in codes if dedup(code))
+
+    for out, failure in parse_code_batch(codes, workers=workers, timeout=timeout, max_bytes=max_bytes, backend=backend,
+                                         stats=stats, limits=limits, chunksize=chunksize):
+        if failure is not None:
             continue
+        if len(out["node_set"]) == 0:
+            if stats is not None:
+                stats.count("no_functions")
+            continue
+
+        start = time.perf_counter()
+        record = encode_parse_record(out) if encoding == "record" else \
+            parse_result_row(out) if encoding == "row" else dump_parse_result(out)
+        if stats is not None:
+            stats.observe("serialize_seconds", time.perf_counter() - start)
+        yield record
+
+
+def py3Filter(batch, backend="ast", workers=0, timeout=None, max_bytes=None, stats=None, prefilter=None, limits=None,
+              encoding="row", dedup=None):
+    """
+        Batched map function for datasets. With encoding="row" every
+        arrow_schema() field is its own column, so the parsed files are stored
+        as nested Arrow structs, otherwise the serialized files are a "files"
+        column.
+    """
+    records = list(iter_records(batch, backend=backend, workers=workers, timeout=timeout, max_bytes=max_bytes,
+                                stats=stats, prefilter=prefilter, limits=limits, encoding=encoding, dedup=dedup))
+    if encoding == "row":
+        return {name: [row[name] for row in records] for name in arrow_schema().names}
+    return {"files": records}
+
+
+class ShardWriter:
+    """
+        Writes encoded parse records to size-bounded shard files prefix-00000.rec,
+        prefix-00001.rec, ... in directory.
+
+        A shard is a sequence of records, each stored as its little-endian uint64
+        length followed by the record bytes (see read_shard). The next shard is
+        started when a record would take the current one past max_bytes, so only
+        a record bigger than max_bytes on its own makes a larger shard.
+
+        Shards are written to a .tmp file that is renamed to its final name once
+        complete, so a shard file is never seen half written. shards lists
+        {"path", "rows", "bytes"} for every committed shard. sync() flushes the
+        open shard to disk and returns its entry, from which a new writer (given
+        the shards committed so far) resumes exactly where it was.
+
+        With format="parquet" the records (which must be encode_parse_record
+        bytes) are spilled the same way and every complete shard is converted to
+        prefix-<n>.parquet, one parse_result_row per file in row groups of
+        row_group_rows. max_bytes still bounds the spill. The spill of a
+        completed shard is kept until cleanup(), which is called once a
+        checkpoint no longer points into it.
+    """
+
+    def __init__(self, directory, prefix, max_bytes=256 << 20, shards=None, current=None, format="records",
+                 row_group_rows=1024):
+        if format not in ("records", "parquet"):
+            raise ValueError(f"unknown shard format {format!r}")
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.format = format
+        self.row_group_rows = row_group_rows
+        self.shards = list(shards or [])
+        # spills of committed shards left by a crash before their cleanup()
+        self._spills = [path for path in (os.path.join(directory, shard["path"][:-len(".parquet")] + ".rec.tmp")
+                                          for shard in self.shards if shard["path"].endswith(".parquet"))
+                        if os.path.exists(path)]
+        self._file = None
+        self._rows = 0
+        self._bytes = 0
+
+        if current is not None:
+            self._path = current["path"]
+            if not os.path.exists(self._temp_path()):
+                # the shard was completed after the checkpoint, it is reopened to redo that
+                os.replace(os.path.join(directory, self._path), self._temp_path())
+            self._file = open(self._temp_path(), "r+b")
+            self._file.truncate(current["bytes"])
+            self._file.seek(current["bytes"])
+            self._rows = current["rows"]
+            self._bytes = current["bytes"]
+
+    def _temp_path(self):
+        return os.path.join(self.directory, self._path + ".tmp")
+
+    def write(self, record):
+        size = _RECORD_LENGTH.size + len(record)
+        if self._file is not None and self._bytes + size > self.max_bytes:
+            self._close_shard()
+        if self._file is None:
+            self._path = f"{self.prefix}-{len(self.shards):05d}.rec"
+            self._file = open(self._temp_path(), "wb")
+
+        self._file.write(_RECORD_LENGTH.pack(len(record)))
+        self._file.write(record)
+        self._rows += 1
+        self._bytes += size
+
+    def sync(self):
+        if self._file is None:
+            return None
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return {"path": self._path, "rows": self._rows, "bytes": self._bytes}
+
+    def _write_parquet(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = arrow_schema()
+        with pq.ParquetWriter(path + ".tmp", schema, compression="zstd") as out:
+            rows = []
+            for record in read_shard(self._temp_path()):
+                rows.append(parse_result_row(read_parse_record(record)))
+                if len(rows) == self.row_group_rows:
+                    out.write_table(pa.Table.from_pylist(rows, schema=schema))
+                    rows = []
+            if rows:
+                out.write_table(pa.Table.from_pylist(rows, schema=schema))
+        os.replace(path + ".tmp", path)
+
+    def _close_shard(self):
+        self.sync()
+        self._file.close()
+        if self.format == "parquet":
+            path = self._path[:-len(".rec")] + ".parquet"
+            self._write_parquet(os.path.join(self.directory, path))
+            self._spills.append(self._temp_path())
+            self.shards.append({"path": path, "rows": self._rows,
+                                "bytes": os.path.getsize(os.path.join(self.directory, path))})
+        else:
+            os.replace(self._temp_path(), os.path.join(self.directory, self._path))
+            self.shards.append({"path": self._path, "rows": self._rows, "bytes": self._bytes})
+        self._file = None
+        self._rows = 0
+        self._bytes = 0
+
+    def close(self):
+        if self._file is not None:
+            self._close_shard()
+        return self.shards
 
-    return {"files": files}
+    def cleanup(self):
+        # the parquet spills of the shards completed so far
+        for path in self._spills:
+            os.remove(path)
+        self._spills = []
 
 
-def main():
-    train_data = load_dataset("codeparrot/github-code", streaming=True, split="train", licenses=["mit", "isc"], languages=["Python"])
-    train_data = train_data.map(lambda batch: py3Filter(batch["code"]), batched=True, remove_columns=train_data.column_names)
-    def gen():
-        i = 0
-        for item in train_data:
-            i += 1
-            if i == 500000:
-                raise StopIteration
+_RECORD_LENGTH = struct.Struct("<Q")
 
-            yield item
 
-    data = Dataset.from_generator(gen)
-    print(data.dataset_size)
-    data.save_to_disk("codeparrot-github_code-python-mit_isc")
+def read_shard(path):
+    """
+        Yields the records of a ShardWriter shard, for read_parse_record.
+    """
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(_RECORD_LENGTH.size)
+            if not header:
+                return
+            yield f.read(_RECORD_LENGTH.unpack(header)[0])
+
+
+def _write_json(path, value):
+    # written to a temp file and renamed over path, so readers see the old or the new version
+    with open(path + ".tmp", "w") as f:
+        json.dump(value, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def _row_group_matches(metadata, row_group, licenses=None, languages=None, max_bytes=None):
+    # False when the statistics of a parquet row group show that no row passes the filters
+    row_group = metadata.row_group(row_group)
+    columns = {}
+    for i in range(row_group.num_columns):
+        column = row_group.column(i)
+        if column.is_stats_set and column.statistics.has_min_max:
+            columns[column.path_in_schema] = column.statistics
+
+    for name, values in (("license", licenses), ("language", languages)):
+        if values is not None and name in columns and \
+                not any(columns[name].min <= value <= columns[name].max for value in values):
+            return False
+    return max_bytes is None or "size" not in columns or columns["size"].min <= max_bytes
+
+
+def input_units(paths, unit_bytes=64 << 20, licenses=None, languages=None, max_bytes=None, stats=None):
+    """
+        Splits the input files into units of work, in a fixed order: byte ranges of
+        about unit_bytes of a .jsonl file as ("jsonl", path, start, end), and row
+        groups of a .parquet file as ("parquet", path, row_group, None). A
+        directory stands for the .parquet and .jsonl files in it.
+
+        Parquet row groups whose column statistics show that none of their rows
+        has a license in licenses, a language in languages or a size of at most
+        max_bytes are left out. stats, a dict, counts the "row_groups" seen and
+        the "pruned_row_groups".
+    """
+    units = []
+    for path in paths:
+        if os.path.isdir(path):
+            units.extend(input_units([os.path.join(path, name) for name in sorted(os.listdir(path))
+                                      if name.endswith((".parquet", ".jsonl"))],
+                                     unit_bytes, licenses, languages, max_bytes, stats))
+        elif path.endswith(".parquet"):
+            import pyarrow.parquet as pq
+
+            metadata = pq.ParquetFile(path).metadata
+            for i in range(metadata.num_row_groups):
+                keep = _row_group_matches(metadata, i, licenses, languages, max_bytes)
+                if stats is not None:
+                    stats["row_groups"] = stats.get("row_groups", 0) + 1
+                    stats["pruned_row_groups"] = stats.get("pruned_row_groups", 0) + (not keep)
+                if keep:
+                    units.append(("parquet", path, i, None))
+        elif path.endswith(".jsonl"):
+            size = os.path.getsize(path)
+            units.extend(("jsonl", path, start, min(start + unit_bytes, size)) for start in range(0, size, unit_bytes))
+        else:
+            raise ValueError(f"unsupported input {path!r}, expected .parquet or .jsonl files or a directory")
+
+    return units
+
+
+def _decode_unit(unit, licenses=None, languages=None, max_bytes=None):
+    # [(position, code, bytes)] of the rows of a unit that pass the filters
+    kind, path, start, end = unit
+
+    if kind == "parquet":
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+
+        parquet = pq.ParquetFile(path)
+        names = parquet.schema_arrow.names
+        table = parquet.read_row_group(start, columns=[name for name in ("code", "license", "language", "size")
+                                                       if name in names])
+        # filtered in Arrow, so only the code of matching rows becomes Python strings
+        conditions = []
+        if licenses is not None and "license" in names:
+            conditions.append(pc.is_in(table["license"], value_set=pa.array(licenses)))
+        if languages is not None and "language" in names:
+            conditions.append(pc.is_in(table["language"], value_set=pa.array(languages)))
+        if max_bytes is not None and "size" in names:
+            conditions.append(pc.fill_null(pc.less_equal(table["size"], max_bytes), False))
+
+        code = table["code"]
+        positions = range(1, table.num_rows + 1)
+        if conditions:
+            indices = pc.indices_nonzero(functools.reduce(pc.and_, conditions))
+            code = code.take(indices)
+            positions = (i + 1 for i in indices.to_pylist())
+        return list(zip(positions, code.to_pylist(), pc.binary_length(code).to_pylist()))
+
+    def keep(row):
+        if licenses is not None and row.get("license", licenses[0]) not in licenses:
+            return False
+        if languages is not None and row.get("language", languages[0]) not in languages:
+            return False
+        return max_bytes is None or row.get("size", 0) <= max_bytes
+
+    # a line belongs to the unit it starts in
+    rows = []
+    with open(path, "rb") as f:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            if line.strip():
+                row = json.loads(line)
+                if keep(row):
+                    rows.append((f.tell(), row["code"], len(line)))
+    return rows
+
+
+def read_unit(unit, licenses=None, languages=None, position=None, max_bytes=None):
+    """
+        Yields (position, code) for every row of an input unit whose license and
+        language (when the rows have them) are in licenses and languages, and
+        whose size column (when there is one) is at most max_bytes.
+
+        position is where reading resumes after the row: the byte offset of the
+        next line in a .jsonl file, the next row in a parquet row group. Passing it
+        back continues with the following rows.
+    """
+    for row_position, code, _ in _decode_unit(unit, licenses, languages, max_bytes):
+        if position is None or row_position > position:
+            yield row_position, code
+
+
+def read_units(units, licenses=None, languages=None, max_bytes=None, threads=4, start=0, position=None, stats=None):
+    """
+        Yields (unit, position, code) for the rows of units[start:] like read_unit,
+        continuing after position in the first one. Up to threads units are read
+        and filtered ahead in a thread pool (parquet decoding runs without the GIL).
+
+        stats, a dict, adds up the "rows" and "bytes" (UTF-8 code bytes, or line
+        bytes of .jsonl) yielded, the "decode_seconds" spent in the threads and
+        the "wait_seconds" the caller was kept waiting for them.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def decode(unit):
+        begin = time.perf_counter()
+        rows = _decode_unit(unit, licenses, languages, max_bytes)
+        return rows, time.perf_counter() - begin
+
+    stats = {} if stats is None else stats
+    for key in ("rows", "bytes", "decode_seconds", "wait_seconds"):
+        stats.setdefault(key, 0)
+
+    with ThreadPoolExecutor(max(1, threads)) as pool:
+        pending = deque()
+        i = start
+        while pending or i < len(units):
+            while i < len(units) and len(pending) < max(1, threads):
+                pending.append((i, pool.submit(decode, units[i])))
+                i += 1
+
+            unit, future = pending.popleft()
+            begin = time.perf_counter()
+            rows, seconds = future.result()
+            stats["wait_seconds"] += time.perf_counter() - begin
+            stats["decode_seconds"] += seconds
+
+            for row_position, code, size in rows:
+                if unit == start and position is not None and row_position <= position:
+                    continue
+                stats["rows"] += 1
+                stats["bytes"] += size
+                yield unit, row_position, code
+
+
+def read_mirror(inputs, licenses=None, languages=None, max_bytes=None, threads=4, batch_rows=1024,
+                unit_bytes=64 << 20, stats=None):
+    """
+        Yields lists of up to batch_rows codes from a local mirror (.parquet and
+        .jsonl files or directories of them), for parse_code_batch or
+        iter_records. Row groups are pruned and filtered as in input_units and
+        decoded by read_units, whose counts go to stats along with the
+        input_units ones and the total "seconds".
+    """
+    stats = {} if stats is None else stats
+    begin = time.perf_counter()
+    batch = []
+    for _, _, code in read_units(input_units(inputs, unit_bytes, licenses, languages, max_bytes, stats), licenses,
+                                 languages, max_bytes, threads, stats=stats):
+        batch.append(code)
+        if len(batch) == batch_rows:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+    stats["seconds"] = time.perf_counter() - begin
+
+
+def _prep_worker(worker, units, options, queue):
+    try:
+        checkpoint_path = os.path.join(options["output"], f"part-{worker:05d}.checkpoint.json")
+        state = None
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                state = json.load(f)
+            if state["key"] != options["key"]:
+                raise ValueError(f"{checkpoint_path} was written with other inputs or options")
+        if state is None:
+            state = {"key": options["key"], "done": False, "unit": 0, "position": None, "rows": 0, "shards": [],
+                     "current": None, "stats": ParseStats().to_dict(), "prefilter": {"passed": 0}, "read": {}}
+
+        if not state["done"]:
+            stats = ParseStats.from_dict(state["stats"])
+            prefilter = Prefilter(max_bytes=options["max_bytes"], **(options["prefilter"] or {}))
+            prefilter.counts = state["prefilter"]
+
+            dedup = None
+            if options["dedup_threshold"] is not None:
+                dedup = Deduplicator(os.path.join(options["output"], f"part-{worker:05d}.dedup.sqlite"),
+                                     options["dedup_threshold"], max_entries=options["dedup_entries"])
+                dedup.rollback(state["dedup"]["seq"] if "dedup" in state else 0)
+                if "dedup" in state:
+                    dedup.counts, dedup.removed_bytes = state["dedup"]["counts"], state["dedup"]["removed_bytes"]
+            writer = ShardWriter(options["output"], f"part-{worker:05d}", options["shard_bytes"], state["shards"],
+                                 state["current"], options["format"], options["row_group_rows"])
+
+            read = dict(state["read"])
+            rows = read_units(units, options["licenses"], options["languages"], options["max_bytes"],
+                              options["read_threads"], state["unit"], state["position"], read)
+            if options["max_rows"] is not None:
+                rows = itertools.islice(rows, max(0, options["max_rows"] - state["rows"]))
+
+            def process(block, done=False, unit=None, position=None):
+                # the pipeline is drained after each block, so the checkpoint is exact
+                total = state["rows"] + len(block)
+                for record in iter_records(block, backend=options["backend"], workers=1 if options["timeout"] else 0,
+                                           timeout=options["timeout"], stats=stats, prefilter=prefilter,
+                                           limits=options["limits"], chunksize=options["chunksize"], dedup=dedup):
+                    writer.write(record)
+                block.clear()
+
+                if done:
+                    writer.close()
+                if dedup is not None:
+                    # committed before the checkpoint, a crash in between is undone by the rollback on resume
+                    dedup.sync()
+                    state["dedup"] = dedup.report()
+                state.update(done=done, rows=total, shards=writer.shards, current=writer.sync(),
+                             stats=stats.to_dict(), prefilter=prefilter.counts, read=dict(read))
+                if not done:
+                    state.update(unit=unit, position=position)
+                _write_json(checkpoint_path, state)
+                writer.cleanup()
+
+            codes = []
+            last = (state["unit"], state["position"])
+            for unit, position, code in rows:
+                codes.append(code)
+                last = (unit, position)
+                if len(codes) >= options["checkpoint_rows"]:
+                    process(codes, unit=last[0], position=last[1])
+            process(codes, done=True)
+            if dedup is not None:
+                dedup.close()
+
+        queue.put((worker, None))
+    except BaseException as e:
+        queue.put((worker, f"{type(e).__name__}: {e}"))
+        raise
+
+
+def prep(inputs, output, workers=None, shard_bytes=256 << 20, max_rows=None, chunksize=64, backend="ast",
+         timeout=60, limits=None, licenses=None, languages=None, unit_bytes=64 << 20, checkpoint_rows=1000,
+         dedup_threshold=None, dedup_entries=None, format="parquet", row_group_rows=1024, max_bytes=1 << 20,
+         read_threads=2, prefilter=None):
+    """
+        Parses the code of local .jsonl/.parquet files (or directories of them)
+        into shards in output, in parallel worker processes.
+
+        The inputs are split into units of unit_bytes (see input_units), leaving
+        out parquet row groups without rows of licenses and languages or of at
+        most max_bytes, and worker w takes every workers-th unit starting at w, so
+        the assignment does not depend on timing. Each worker reads its units
+        read_threads at a time (see read_units) and streams the rows through a
+        Prefilter of max_bytes and the prefilter dict of its other arguments, and
+        iter_records, in
+        parse_code_batch chunks of chunksize, and writes its own part-<w>-<n>
+        shards of about shard_bytes of parse records (see ShardWriter). With
+        format="parquet" these are .parquet files of parse_result_row rows, for
+        read_parse_table, with format="records" .rec files for read_shard. When
+        all are done manifest.json lists every shard with its row count and byte
+        size, along with the merged ParseStats and Prefilter counts and the
+        read counts and times.
+
+        Every checkpoint_rows input rows a worker saves its input position, the
+        shards it committed, the length of its open shard and its stats to
+        part-<w>.checkpoint.json. Running prep again on the same output with the
+        same arguments skips finished workers and resumes the others from their
+        last checkpoint, writing the same shards as an uninterrupted run (as long
+        as no file hits the timeout, which depends on the machine).
+
+        With a dedup_threshold, each worker drops exact and near duplicates of
+        files it has already seen (see Deduplicator) before parsing, keeping its
+        index in part-<w>.dedup.sqlite. Duplicates across workers are not
+        detected, since which copy survives would then depend on timing.
+
+        max_rows caps the input rows of the whole run, split evenly over workers.
+        With a timeout, every worker parses in a parse_code_batch subprocess that
+        is replaced when a file takes longer.
+    """
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(output, exist_ok=True)
+    read = {}
+    units = input_units(inputs, unit_bytes, licenses, languages, max_bytes, read)
+    max_rows = None if max_rows is None else -(-max_rows // workers)
+
+    # everything that decides the contents of the shards
+    key = hashlib.sha256(json.dumps([RESULT_FORMAT_VERSION, PARSER_VERSION, units, workers, shard_bytes, max_rows, backend, limits,
+                                     licenses, languages, dedup_threshold, dedup_entries, format, row_group_rows,
+                                     max_bytes, prefilter]).encode()).hexdigest()
+    options = {"output": output, "key": key, "shard_bytes": shard_bytes, "chunksize": chunksize, "backend": backend,
+               "timeout": timeout, "limits": limits, "licenses": licenses, "languages": languages,
+               "max_rows": max_rows, "checkpoint_rows": checkpoint_rows, "dedup_threshold": dedup_threshold,
+               "dedup_entries": dedup_entries, "format": format, "row_group_rows": row_group_rows,
+               "max_bytes": max_bytes, "read_threads": read_threads, "prefilter": prefilter}
+
+    ctx = multiprocessing.get_context()
+    queue = ctx.Queue()
+    processes = [ctx.Process(target=_prep_worker, args=(worker, units[worker::workers], options, queue))
+                 for worker in range(workers)]
+    for process in processes:
+        process.start()
+
+    errors = {}
+    try:
+        while len(errors) < workers:
+            try:
+                worker, error = queue.get(timeout=1)
+            except Empty:
+                # a worker that reported and exited since the get timed out is not a failure
+                exitcodes = [process.exitcode for process in processes]
+                while True:
+                    try:
+                        worker, error = queue.get_nowait()
+                    except Empty:
+                        break
+                    errors[worker] = error
+                for worker, exitcode in enumerate(exitcodes):
+                    if worker not in errors and exitcode:
+                        errors[worker] = f"exit code {exitcode}"
+                continue
+            errors[worker] = error
+    finally:
+        for process in processes:
+            process.join()
+
+    failed = {worker: error for worker, error in errors.items() if error is not None}
+    if failed:
+        raise RuntimeError(f"prep workers failed: {failed}")
+
+    stats = ParseStats()
+    prefilter = {}
+    dedup = {"counts": {}, "removed_bytes": {}}
+    shards = []
+    rows = 0
+    for worker in range(workers):
+        with open(os.path.join(output, f"part-{worker:05d}.checkpoint.json")) as f:
+            state = json.load(f)
+        rows += state["rows"]
+        stats.merge(ParseStats.from_dict(state["stats"]))
+        for rule, n in state["prefilter"].items():
+            prefilter[rule] = prefilter.get(rule, 0) + n
+        for key in ("counts", "removed_bytes"):
+            for rule, n in state.get("dedup", {}).get(key, {}).items():
+                dedup[key][rule] = dedup[key].get(rule, 0) + n
+        for key, n in state["read"].items():
+            read[key] = read.get(key, 0) + n
+        shards.extend({**shard, "worker": worker} for shard in state["shards"])
+
+    cache = get_parse_cache()
+    manifest = {
+        "format": "parse-parquet" if format == "parquet" else "parse-records",
+        "version": RESULT_FORMAT_VERSION,
+        "input_rows": rows,
+        "rows": sum(shard["rows"] for shard in shards),
+        "bytes": sum(shard["bytes"] for shard in shards),
+        "shards": shards,
+        "prefilter": dict(sorted(prefilter.items())),
+        "read": read,
+        **({"dedup": dedup} if dedup_threshold is not None else {}),
+        "stats": stats.to_dict(),
+        **({"cache": cache.stats()} if cache is not None else {}),
+    }
+    _write_json(os.path.join(output, "manifest.json"), manifest)
+
+    return manifest
+
+
+def _throughput(read, seconds):
+    return f"{read.get('rows', 0) / seconds:.0f} rows/s, {read.get('bytes', 0) / seconds / 1e6:.1f} MB/s"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parse a local codeparrot mirror into shards of parse results.")
+    parser.add_argument("inputs", nargs="+", help=".parquet or .jsonl files with a code column, or directories of them")
+    parser.add_argument("--output", default="codeparrot-github_code-python-mit_isc")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, all cores by default")
+    parser.add_argument("--shard-bytes", type=int, default=256 << 20)
+    parser.add_argument("--format", default="parquet", choices=["parquet", "records"],
+                        help="nested Arrow columns in parquet, or binary parse records")
+    parser.add_argument("--row-group-rows", type=int, default=1024, help="files per parquet row group")
+    parser.add_argument("--max-rows", type=int, default=None, help="input rows to read in total")
+    parser.add_argument("--chunksize", type=int, default=64, help="files sent to a parse subprocess at once")
+    parser.add_argument("--backend", default="ast", choices=["ast", "libcst"])
+    parser.add_argument("--timeout", type=float, default=60, help="seconds per file, 0 parses without a subprocess")
+    parser.add_argument("--licenses", default="mit,isc", help="comma separated, empty for all")
+    parser.add_argument("--languages", default="Python", help="comma separated, empty for all")
+    parser.add_argument("--checkpoint-rows", type=int, default=1000, help="input rows between worker checkpoints")
+    parser.add_argument("--dedup-threshold", type=float, default=0.85,
+                        help="drop files this similar to an earlier one, 0 keeps duplicates")
+    parser.add_argument("--dedup-entries", type=int, default=None, help="files each worker's dedup index keeps")
+    parser.add_argument("--max-bytes", type=int, default=1 << 20, help="skip files of more UTF-8 bytes")
+    parser.add_argument("--max-line-length", type=int, default=2000,
+                        help="skip files with a longer line, 0 for no limit")
+    parser.add_argument("--max-mean-line-length", type=int, default=200,
+                        help="skip files with longer lines on average, 0 for no limit")
+    parser.add_argument("--keep-no-defs", action="store_true", help="parse files without a def or lambda too")
+    parser.add_argument("--keep-py2", action="store_true", help="parse files that look like Python 2 too")
+    parser.add_argument("--unit-bytes", type=int, default=64 << 20,
+                        help="bytes of a .jsonl file a worker reads as one unit")
+    parser.add_argument("--read-threads", type=int, default=2, help="threads decoding input per worker")
+    parser.add_argument("--read-only", action="store_true", help="only read and filter the inputs, to time the reader")
+    args = parser.parse_args(argv)
+    licenses = args.licenses.split(",") if args.licenses else None
+    languages = args.languages.split(",") if args.languages else None
+
+    if args.read_only:
+        read = {}
+        for _ in read_mirror(sorted(args.inputs), licenses, languages, args.max_bytes, args.read_threads,
+                             unit_bytes=args.unit_bytes, stats=read):
+            pass
+        print(f"{read.get('rows', 0)} rows ({read.get('bytes', 0)} bytes) from {read.get('row_groups', 0)} row groups, "
+              f"{read.get('pruned_row_groups', 0)} pruned, in {read['seconds']:.1f}s, "
+              f"{_throughput(read, read['seconds'])}")
+        return
+
+    start = time.perf_counter()
+    manifest = prep(sorted(args.inputs), args.output, workers=args.workers, shard_bytes=args.shard_bytes,
+                    max_rows=args.max_rows, chunksize=args.chunksize, backend=args.backend, timeout=args.timeout or None,
+                    limits={"max_body_chars": 20000, "max_nodes": 50000, "max_depth": 64},
+                    licenses=licenses, languages=languages, unit_bytes=args.unit_bytes,
+                    checkpoint_rows=args.checkpoint_rows,
+                    dedup_threshold=args.dedup_threshold or None, dedup_entries=args.dedup_entries, format=args.format,
+                    row_group_rows=args.row_group_rows, max_bytes=args.max_bytes, read_threads=args.read_threads,
+                    prefilter={"max_line_length": args.max_line_length or None,
+                               "max_mean_line_length": args.max_mean_line_length or None,
+                               "require_defs": not args.keep_no_defs, "reject_py2": not args.keep_py2})
+    seconds = time.perf_counter() - start
+
+    print(f"{manifest['input_rows']} rows in, {manifest['rows']} parsed files in {len(manifest['shards'])} shards "
+          f"({manifest['bytes']} bytes) in {seconds:.1f}s, {manifest['input_rows'] / seconds:.0f} rows/s")
+    read = manifest["read"]
+    if read.get("decode_seconds"):
+        print(f"read {read['rows']} rows ({read['bytes']} bytes), {read.get('pruned_row_groups', 0)} of "
+              f"{read.get('row_groups', 0)} row groups pruned, decoding at {_throughput(read, read['decode_seconds'])} "
+              f"per thread, workers waited {read['wait_seconds']:.1f}s for input")
+    if "dedup" in manifest:
+        removed = manifest["dedup"]
+        print(f"dedup removed {removed['counts'].get('exact', 0)} exact ({removed['removed_bytes'].get('exact', 0)} "
+              f"bytes) and {removed['counts'].get('near', 0)} near duplicates "
+              f"({removed['removed_bytes'].get('near', 0)} bytes)")
+
 
 if __name__ == "__main__":
     main()
-
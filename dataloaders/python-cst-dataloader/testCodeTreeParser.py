@@ -0,0 +1,380 @@
+import ast
+import glob
+import json
+import os
+import sqlite3
+import tempfile
+import tokenize
+import unittest
+
+from CodeTreeParser import parse_code, parse_code_batch, parse_code_incremental, extract_code_elements, \
+    legacy_extract_code_elements, looks_like_py2, parse_failure, dump_parse_result, load_parse_result, \
+    encode_parse_record, read_parse_record, ParseCache, ParseLimitExceeded, ParseRecord, ParseStats, set_parse_cache, \
+    CompactParseResult, FUNC, LAMBDA
+
+samples = [
+    """
+def func1(a, b):
+
+    def nested_func1(b, c):
+        return func2(c, b)
+
+    return nested_func1(a, b) + func2(a, b)
+
+def func2(x, y):
+    return x * y
+
+class MyClass:
+    # comment above a method
+    @decorator(
+        func2(1, 2))
+    def method1(self, p):
+        return func1(p, lambda q: func2(q,
+                                        p))
+""",
+    """
+def outer():
+    def outer():
+        return outer()
+    s = '''multi
+  line'''
+    return [outer(x) for x in items(
+        1,
+        2)]
+""",
+    """
+def a(x):
+    return b(c(a(x)))(x).d(
+        x)
+
+def b(y):
+    return (a(y))
+
+def c(z):
+    return obj.c(z)[0].b(z)""",
+    "def f(x):\r\n    return g((lambda y: (f(y))))\r\n\r\ndef g(z):\r\n    return z",
+    """
+def f(x):
+    s = '\u00e9' + f(x)  # \u00fc
+    return (f)(x) \\
+        + g(x)
+
+def g(y):
+\tif y:
+\t\treturn f(y)
+\t# tab comment
+
+  # odd
+# top
+def h(): return f'{f(1)} {g(2)!r}'
+""",
+    """
+class A:
+    @staticmethod
+    # between
+    @dec(f(1))
+    async def f(a, /, b, *c, d=g(1), **e):
+        await (f(b))
+        return [f(i) for i in (g(a),)]
+    def g(self):
+        x = (
+  f(1),
+            g(2))
+        return x
+""",
+]
+
+
+def corpus_files():
+    paths = glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "**", "*.py"), recursive=True)
+    paths += [ast.__file__, tokenize.__file__] + glob.glob(os.path.join(os.path.dirname(json.__file__), "*.py"))
+
+    # PARSER_PARITY_CORPUS=<dir> runs the backend parity tests on a larger corpus
+    if os.environ.get("PARSER_PARITY_CORPUS"):
+        paths += glob.glob(os.path.join(os.environ["PARSER_PARITY_CORPUS"], "**", "*.py"), recursive=True)
+
+    return paths
+
+
+class TestCodeTreeParser(unittest.TestCase):
+
+    def assertSameOutput(self, code):
+        expected = legacy_extract_code_elements(code)
+        actual = extract_code_elements(code, legacy_calls=True)
+        self.assertEqual(json.dumps(expected), json.dumps(actual))
+
+    def test_matches_visitors_on_samples(self):
+        for code in samples:
+            self.assertSameOutput(code)
+
+    def test_matches_visitors_on_repo(self):
+        for path in glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "**", "*.py"), recursive=True):
+            with open(path, "r") as f:
+                self.assertSameOutput(f.read())
+
+    def test_ast_backend_matches_libcst_on_samples(self):
+        for code in samples + ["", "x = 1", "def f(): return print((f()))"]:
+            self.assertEqual(json.dumps(parse_code(code)), json.dumps(parse_code(code, backend="ast")))
+
+    def test_ast_backend_matches_libcst_on_corpus(self):
+        for path in corpus_files():
+            with open(path, "r", encoding="utf-8") as f:
+                code = f.read()
+
+            with self.subTest(path=path):
+                self.assertEqual(json.dumps(parse_code(code)), json.dumps(parse_code(code, backend="ast")))
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            parse_code("x = 1", backend="parso")
+
+    def test_parse_code(self):
+        out = parse_code(samples[0])
+        self.assertEqual(set(out["node_set"].keys()), {"func1", "nested_func1", "func2", "method1"})
+        self.assertEqual(out["call_tree"]["func1"], {"func2": 1, "nested_func1": 1})
+        self.assertEqual(out["node_set"]["nested_func1"]["body"], "\ndef nested_func1(b, c):\n    return func2(c, b)\n")
+        self.assertIn("#<call>func2(c, b)</call>", out["node_set"]["nested_func1"]["emb_repr"])
+
+    def test_symbols_and_call_edges(self):
+        out = parse_code(samples[0])
+        self.assertEqual(out["symbols"], ["func1", "func1.nested_func1", "func2", "MyClass.method1"])
+        self.assertEqual(out["call_edges"], [[1, 2, 1], [0, 1, 1], [0, 2, 1], [3, 2, 2], [3, 0, 1]])
+
+        # callees come from the func node: obj.c(z)[0].b(z) calls c and b, b(...)(x) only b
+        out = parse_code(samples[2])
+        edges = {(out["symbols"][caller], out["symbols"][callee]): count for caller, callee, count in out["call_edges"]}
+        self.assertEqual(edges, {("a", "b"): 1, ("a", "c"): 1, ("a", "a"): 1, ("b", "a"): 1, ("c", "c"): 1, ("c", "b"): 1})
+
+        # call_tree is the edges by name, the visitors' rule counts the name before the first "(" twice
+        self.assertEqual(out["call_tree"]["c"], {"c": 1, "b": 1})
+        self.assertEqual(extract_code_elements(samples[2], legacy_calls=True)[1]["c"], {"c": 2})
+
+    def test_compact_result(self):
+        for backend in ("libcst", "ast"):
+            for code in samples:
+                expected = parse_code(code, backend=backend)
+                compact = parse_code(code, backend=backend, compact=True)
+                self.assertEqual(json.dumps(compact.to_dict()), json.dumps(expected))
+                self.assertEqual(json.dumps(CompactParseResult.from_dict(expected).to_dict()), json.dumps(expected))
+
+        compact = parse_code(samples[0], compact=True)
+        self.assertEqual([compact.node_name(row) for row in range(len(compact))],
+                         ["func1", "nested_func1", "func2", "method1", None])
+        self.assertEqual(list(compact.kind), [FUNC, FUNC, FUNC, FUNC, LAMBDA])
+        self.assertEqual(list(compact.parent), [-1, 0, -1, -1, 3])
+        self.assertEqual(compact.children(0), [1])
+        self.assertEqual(compact.params(4), ["q"])
+        self.assertEqual(compact.body(1), "\ndef nested_func1(b, c):\n    return func2(c, b)\n")
+        self.assertIn("#<call>func2(c, b)</call>", compact.emb_repr("nested_func1"))
+        self.assertEqual(compact.calls("func1"), {"func2": 1, "nested_func1": 1})
+
+    def test_limits(self):
+        for backend in ("libcst", "ast"):
+            full = parse_code(samples[0], backend=backend)
+            out = parse_code(samples[0], backend=backend, limits={"max_body_chars": 40})
+            for name, data in out["node_set"].items():
+                expected = full["node_set"][name]
+                self.assertEqual(data["body"], expected["body"][:40])
+                self.assertEqual(data["emb_repr"], expected["emb_repr"][:40])
+                self.assertEqual(data["truncated"], len(expected["body"]) > 40 or len(expected["emb_repr"]) > 40)
+            self.assertEqual(out["node_set"]["func2"]["truncated"], False)
+            self.assertEqual(out["node_set"]["func1"]["truncated"], True)
+
+            compact = parse_code(samples[0], backend=backend, compact=True, limits={"max_body_chars": 40})
+            self.assertEqual(json.dumps(compact.to_dict()), json.dumps(out))
+            self.assertEqual(json.dumps(CompactParseResult.from_dict(out).to_dict()), json.dumps(out))
+
+            with self.assertRaises(ParseLimitExceeded) as raised:
+                parse_code(samples[0], backend=backend, limits={"max_nodes": 5})
+            self.assertEqual(parse_failure(raised.exception)["reason"], "too_many_nodes")
+            with self.assertRaises(ParseLimitExceeded) as raised:
+                parse_code(samples[0], backend=backend, limits={"max_depth": 1})
+            self.assertEqual(parse_failure(raised.exception)["reason"], "too_deep")
+            self.assertEqual(parse_code(samples[0], backend=backend, limits={"max_depth": 2}), full)
+
+        with self.assertRaises(ValueError):
+            parse_code(samples[0], limits={"max_lines": 10})
+
+    def test_dump_and_load(self):
+        for limits in (None, {"max_body_chars": 40}):
+            for code in samples:
+                out = parse_code(code, limits=limits)
+                text = dump_parse_result(out)
+                self.assertLess(len(text), len(json.dumps(out)))
+                loaded = load_parse_result(text)
+                self.assertEqual(json.dumps(loaded), json.dumps(out))
+
+                # node_set shares the data dicts of the tree again
+                tree_data = set()
+                stack = [loaded["code"]]
+                while stack:
+                    tree_data.add(id(stack[-1]["__data__"]))
+                    stack.extend(stack.pop()["__children__"])
+                self.assertTrue(all(id(data) in tree_data for data in loaded["node_set"].values()))
+
+                # plain json.dumps output from before the format existed
+                self.assertEqual(json.dumps(load_parse_result(json.dumps(out))), json.dumps(out))
+
+    def test_parse_record(self):
+        for code in samples:
+            out = parse_code(code, limits={"max_body_chars": 60})
+            record = read_parse_record(encode_parse_record(out))
+            self.assertIsInstance(record, ParseRecord)
+            self.assertEqual(json.dumps(record.to_dict()), json.dumps(out))
+            self.assertEqual(record.call_tree, out["call_tree"])
+            self.assertEqual(record.call_set, out["call_set"])
+            for name, row in record.node_set.items():
+                self.assertEqual(record.node_name(row), name)
+                self.assertEqual(record.params(row), out["node_set"][name]["params"])
+                self.assertEqual(record.body(row), out["node_set"][name]["body"])
+                self.assertEqual(record.emb_repr(name), out["node_set"][name]["emb_repr"])
+                self.assertEqual(record.truncated(row), out["node_set"][name]["truncated"])
+
+            self.assertEqual(read_parse_record(dump_parse_result(out)), out)
+            self.assertEqual(read_parse_record(json.dumps(out)), out)
+
+    def test_looks_like_py2(self):
+        for code in ["print 'a'\n", "print >>f, x\n", "try:\n    pass\nexcept E, e:\n    pass\n", "raise E, 'm'\n",
+                     "exec 'x'\n", "x = `a`\n", "a <> b\n", "x = 0777\n", "x = 10L\n", "s = ur'x'\n",
+                     "if x:\n    print x, y\n", "os.chmod(p, 0755)\n", "x = 0xFFL\n", "except (A, B), e:\n    pass\n"]:
+            self.assertTrue(looks_like_py2(code), code)
+
+        for code in samples + ["print('a')\n", "print\n", "s = 'print x'  # print y\n", "raise E(1, 2)\n",
+                               "try:\n    pass\nexcept (A, B): a, b = 1, 2\n", "x = 0 if a < b > c else 0o7\n"]:
+            self.assertFalse(looks_like_py2(code), code)
+
+
+class TestParseCodeIncremental(unittest.TestCase):
+
+    def test_matches_full_parse(self):
+        for backend in ("libcst", "ast"):
+            for code in samples + ["", "x = 1", "if x:\n    pass\n# c\nelse:\n    y = f()\n"]:
+                with self.subTest(backend=backend, code=code):
+                    out = parse_code_incremental(code, backend=backend)
+                    self.assertEqual(json.dumps(out), json.dumps(parse_code(code, backend=backend)))
+
+    def test_reuses_unchanged_definitions(self):
+        code = samples[0]
+        edited = code.replace("return x * y", "return func1(x, y)\n\n  # moved\n\ndef func3(): pass")
+
+        for backend in ("libcst", "ast"):
+            previous = parse_code_incremental(code, backend=backend)
+            out = parse_code_incremental(edited, previous, backend=backend)
+            self.assertEqual(json.dumps(out), json.dumps(parse_code(edited, backend=backend)))
+            self.assertEqual((out.reused, out.parsed), (2, 2))
+            self.assertEqual(out["call_tree"]["func2"], {"func1": 1})
+
+    def test_syntax_error(self):
+        previous = parse_code_incremental(samples[0])
+        with self.assertRaises(Exception):
+            parse_code_incremental(samples[0] + "\nprint 'py2'\n", previous)
+
+
+class TestParseCodeBatch(unittest.TestCase):
+
+    def test_results_in_order(self):
+        codes = samples + ["def f(:\n    pass", "print 'py2'", "x" * 5000]
+        expected = [json.dumps(parse_code(code)) for code in samples]
+
+        for workers in (0, 2):
+            stats = ParseStats()
+            results = list(parse_code_batch(codes, workers=workers, max_bytes=4000, chunksize=2, stats=stats))
+            self.assertEqual([json.dumps(out) for out, _ in results[:len(samples)]], expected)
+            self.assertEqual([failure["reason"] for _, failure in results[-3:]], ["syntax_error", "py2", "too_large"])
+
+            report = stats.to_dict()
+            self.assertEqual(report["files"], len(codes))
+            self.assertEqual(report["outcomes"], {"ok": len(samples), "py2": 1, "syntax_error": 1, "too_large": 1})
+            self.assertEqual(report["histograms"]["nodes"]["count"], len(samples))
+            self.assertEqual(set(report["histograms"]), {"parse_seconds", "extract_seconds", "call_pass_seconds",
+                                                          "nodes", "calls"})
+            self.assertEqual(ParseStats.from_dict(report).to_dict(), report)
+
+    def test_timeout_recycles_worker(self):
+        slow = "".join(f"def f{i}(x):\n    return f{i}(x) + g(x)\n" for i in range(3000))
+        codes = ["def f(): f()", slow, "def g(): g()"]
+
+        results = list(parse_code_batch(codes, workers=1, timeout=0.1, chunksize=3))
+        self.assertEqual(results[1], (None, {"reason": "timeout", "detail": "exceeded 0.1s"}))
+        self.assertEqual(results[0][0]["call_tree"], {"f": {"f": 1}})
+        self.assertEqual(results[2][0]["call_tree"], {"g": {"g": 1}})
+
+
+class TestParseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache = ParseCache(os.path.join(self.dir.name, "parse_cache.db"), max_bytes=1 << 20)
+        set_parse_cache(self.cache)
+
+    def tearDown(self):
+        set_parse_cache(None)
+        self.dir.cleanup()
+
+    def test_hit_returns_same_result(self):
+        expected = [json.dumps(parse_code(code)) for code in samples]
+        cached = [parse_code(code) for code in samples]
+
+        self.assertEqual([json.dumps(out) for out in cached], expected)
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["entries"]), (len(samples), len(samples), len(samples)))
+
+        # node_set still points into the tree
+        tree_data = [child["__data__"] for child in cached[0]["code"]["__children__"]]
+        self.assertTrue(any(data is cached[0]["node_set"]["func1"] for data in tree_data))
+
+    def test_compact_entries(self):
+        limits = {"max_body_chars": 40}
+        set_parse_cache(None)
+        expected = [json.dumps(parse_code(code, limits=limits)) for code in samples]
+        set_parse_cache(self.cache)
+
+        # stored without rendering, and served to both forms
+        for code, out in zip(samples, expected):
+            self.assertIsInstance(parse_code(code, compact=True, limits=limits), CompactParseResult)
+            cached = parse_code(code, compact=True, limits=limits)
+            self.assertIsInstance(cached, CompactParseResult)
+            self.assertEqual(json.dumps(cached.to_dict()), out)
+            self.assertEqual(json.dumps(parse_code(code, limits=limits)), out)
+
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2 * len(samples), len(samples)))
+
+    def test_hits_are_read_only(self):
+        path = os.path.join(self.dir.name, "parse_cache.db")
+        expected = json.dumps(parse_code(samples[0]))
+        self.cache.flush_hits = 2
+
+        # hits are served while another process holds the write lock, their counters are written in batches
+        other = sqlite3.connect(path, isolation_level=None)
+        other.execute("BEGIN IMMEDIATE")
+        self.assertEqual(json.dumps(parse_code(samples[0])), expected)
+        other.execute("COMMIT")
+        self.assertEqual(ParseCache(path).stats()["hits"], 0)
+
+        parse_code(samples[0])
+        self.assertEqual(ParseCache(path).stats()["hits"], 2)
+        parse_code(samples[0])
+        self.cache.close()
+        self.assertEqual(ParseCache(path).stats()["hits"], 3)
+
+    def test_backend_is_part_of_the_key(self):
+        parse_code(samples[0])
+        parse_code(samples[0], backend="ast")
+        self.assertEqual(self.cache.stats()["misses"], 2)
+
+    def test_lru_eviction(self):
+        self.cache.max_bytes = 1500
+        for code in samples:
+            parse_code(code)
+
+        stats = self.cache.stats()
+        self.assertGreater(stats["evictions"], 0)
+        self.assertLessEqual(stats["bytes"], 1500)
+
+        parse_code(samples[-1])
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import json
+import random
+import unittest
+
+from util.json_bfs_loader import bfs_traversal, bfs_windows, bfs_layout, tree_to_parents
+
+
+def random_tree(n, recent):
+    # parents are picked among the last recent nodes, small values make deep trees
+    nodes = [{"__data__": 0, "__children__": []}]
+    for i in range(1, n):
+        node = {"__data__": i, "__children__": []}
+        nodes[random.randrange(max(0, i - recent), i)]["__children__"].append(node)
+        nodes.append(node)
+    return nodes[0]
+
+
+class TestJsonBfsLoader(unittest.TestCase):
+
+    def test_bfs_windows_match_bfs_traversal(self):
+        random.seed(0)
+        for n in (1, 2, 7, 300):
+            for recent in (1, 3, n):
+                tree = random_tree(n, recent)
+                before = json.dumps(tree)
+                for node_limit in (1, 3, 16, n + 1):
+                    windows = bfs_windows(tree, node_limit)
+                    self.assertEqual(json.dumps(tree), before)
+
+                    data, depths, subtrees, max_depth = bfs_traversal(json.loads(before), node_limit)
+                    self.assertEqual(windows.data, data)
+                    self.assertEqual(windows.depths.tolist(), depths)
+                    self.assertEqual(windows.max_depth, max_depth)
+                    self.assertEqual([windows.subtree(i).tolist() for i in range(n)], subtrees)
+                    self.assertEqual(windows.offsets[-1], len(windows.indices))
+
+                    # windows built one at a time on demand
+                    layout = bfs_layout(tree)
+                    self.assertEqual([layout.window(i, node_limit) for i in range(n)], subtrees)
+                    self.assertEqual(layout.depths.tolist(), depths)
+
+    def test_parent_tree(self):
+        tree = {"__data__": "A", "__children__": [
+            {"__data__": "B", "__children__": [{"__data__": "D", "__children__": []}]},
+            {"__data__": "C", "__children__": [{"__data__": "E", "__children__": []},
+                                               {"__data__": "F", "__children__": []}]}]}
+        parents = tree_to_parents(tree)
+        self.assertEqual(parents.parents.tolist(), [-1, 0, 1, 0, 3, 3])
+        self.assertEqual(parents.payload, ("A", "B", "D", "C", "E", "F"))
+        self.assertEqual(parents.depths().tolist(), [0, 1, 2, 1, 2, 2])
+        self.assertEqual([parents.payload[i] for i in parents.bfs_order()], ["A", "B", "C", "D", "E", "F"])
+        with self.assertRaises(ValueError):
+            parents.parents[1] = 2
+
+        # one ParentTree serves any node_limit
+        self.assertEqual(bfs_windows(parents, 2).subtree(2).tolist(), [2, 4])
+        self.assertEqual(bfs_windows(parents, 3).subtree(2).tolist(), [2, 4, 5])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from NodeTokenCache import NodeTokenCache
+
+
+class WordTokenizer:
+    # splits on spaces around special tokens, new words are added to the vocab
+    def __init__(self, special_tokens):
+        self.all_special_tokens = ["<unk>"] + special_tokens
+        self.vocab = {token: i for i, token in enumerate(self.all_special_tokens)}
+        self.unk_token_id = 0
+        self.calls = 0
+
+    def get_vocab(self):
+        return dict(self.vocab)
+
+    def convert_tokens_to_ids(self, token):
+        return self.vocab.get(token, self.unk_token_id)
+
+    def encode(self, text, add_special_tokens=True):
+        self.calls += 1
+        for token in self.all_special_tokens:
+            text = text.replace(token, " " + token + " ")
+        return [self.vocab.setdefault(word, len(self.vocab)) for word in text.split()]
+
+
+class Node:
+    def __init__(self, short, children=()):
+        self.short = short
+        self.children = list(children)
+
+    def short_repr(self):
+        return self.short
+
+    def get_children(self):
+        return self.children
+
+
+class TestNodeTokenCache(unittest.TestCase):
+
+    def test_artifacts_match_tokenized_string(self):
+        tokenizer = WordTokenizer(["<node>", "</node>"])
+        cache = NodeTokenCache(tokenizer)
+        nodes = [Node("f | a, b"), Node("g"), Node("f | a, b")]
+
+        ids = cache.artifacts(nodes)
+        text = "<artifacts>" + "".join("<node>" + node.short_repr() + "</node>" for node in nodes) + "</artifacts>"
+        self.assertEqual(ids.tolist(), tokenizer.encode(text))
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 2, "entries": 2})
+
+        # special tokens are single ids, other markers are tokenized once
+        self.assertEqual(cache.token("<node>").tolist(), [1])
+        self.assertEqual(cache.token("<artifacts>").tolist(), tokenizer.encode("<artifacts>"))
+        with self.assertRaises(ValueError):
+            cache.ids("g")[0] = 1
+
+    def test_persisted_per_fingerprint(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "tokens.sqlite")
+            cache = NodeTokenCache(WordTokenizer(["<node>"]), path)
+            expected = cache.ids("def f ( a ) : return a")
+            cache.close()
+
+            tokenizer = WordTokenizer(["<node>"])
+            cache = NodeTokenCache(tokenizer, path, max_entries=1)
+            np.testing.assert_array_equal(cache.ids("def f ( a ) : return a"), expected)
+            self.assertEqual(tokenizer.calls, 0)
+            cache.ids("g")
+            self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "entries": 1})
+            cache.close()
+
+            # another set of special tokens is another fingerprint
+            tokenizer = WordTokenizer(["<node>", "</node>"])
+            cache = NodeTokenCache(tokenizer, path)
+            cache.ids("def f ( a ) : return a")
+            self.assertEqual(tokenizer.calls, 1)
+            cache.close()
+
+    def test_shared_path(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "tokens.sqlite")
+            first = NodeTokenCache(WordTokenizer(["<node>"]), path, flush_rows=2)
+            second = NodeTokenCache(WordTokenizer(["<node>"]), path, flush_rows=2)
+
+            # misses in one cache do not hold the write lock from the other
+            first.ids("a b")
+            second.ids("c d")
+            first.ids("e f")
+            second.ids("a b")
+            self.assertEqual(second.stats(), {"hits": 1, "misses": 1, "entries": 2})
+            second.sync()
+
+            tokenizer = WordTokenizer(["<node>"])
+            third = NodeTokenCache(tokenizer, path)
+            third.ids("c d")
+            self.assertEqual(tokenizer.calls, 0)
+            for cache in (first, second, third):
+                cache.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,217 @@
+import glob
+import json
+import os
+import tempfile
+import unittest
+
+import prep_github_code
+from CodeTreeParser import parse_code, read_parse_record, read_parse_table, parse_result_from_row
+from prep_github_code import Deduplicator, ShardWriter, Prefilter, read_shard, input_units, read_unit, read_units, \
+    read_mirror, prep
+
+codes = [f"def f{i}(a):\n    return g{i}(a)\n\ndef g{i}(b):\n    return f{i}(b) + {i}\n" for i in range(40)]
+
+module = "".join(f"def handler_{name}(request, *args):\n    response = dispatch(request, {name!r}, args)\n"
+                 f"    log.info('handled %s', response.status)\n    return response\n\n"
+                 for name in ["get", "post", "put", "delete", "patch", "head", "options", "trace", "connect", "list"])
+
+
+class TestPrepGithubCode(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.mirror = os.path.join(self.tmp.name, "mirror.jsonl")
+        with open(self.mirror, "w") as f:
+            for i, code in enumerate(codes):
+                f.write(json.dumps({"code": code, "license": "gpl-3.0" if i % 4 == 3 else "mit", "language": "Python"}))
+                f.write("\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_units_cover_every_row_once(self):
+        units = input_units([self.mirror], unit_bytes=100)
+        self.assertGreater(len(units), 10)
+        self.assertEqual([code for unit in units for _, code in read_unit(unit)], codes)
+        self.assertEqual([code for unit in units for _, code in read_unit(unit, licenses=["mit"])],
+                         [code for i, code in enumerate(codes) if i % 4 != 3])
+
+    def test_read_unit_resumes_at_position(self):
+        unit = input_units([self.mirror])[0]
+        rows = list(read_unit(unit))
+        self.assertEqual(list(read_unit(unit, position=rows[16][0])), rows[17:])
+
+    def test_parquet_mirror(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # row groups of 5 rows, licenses sorted so that statistics can rule out whole row groups
+        rows = sorted(({"code": code, "license": "gpl-3.0" if i % 4 == 3 else "mit", "language": "Python",
+                        "size": len(code) + (10000 if i % 10 == 9 else 0)} for i, code in enumerate(codes)),
+                      key=lambda row: row["license"])
+        mirror = os.path.join(self.tmp.name, "mirror")
+        os.makedirs(mirror)
+        pq.write_table(pa.Table.from_pylist(rows), os.path.join(mirror, "data-00000.parquet"), row_group_size=5)
+
+        expected = [row["code"] for row in rows if row["license"] == "mit" and row["size"] <= 1000]
+        stats = {}
+        units = input_units([mirror], licenses=["mit"], max_bytes=1000, stats=stats)
+        self.assertEqual(stats, {"row_groups": 8, "pruned_row_groups": 2})
+        self.assertEqual(len(units), 6)
+        self.assertEqual([code for unit in units for _, code in read_unit(unit, ["mit"], max_bytes=1000)], expected)
+
+        read = list(read_units(units, ["mit"], max_bytes=1000, threads=3))
+        self.assertEqual([code for _, _, code in read], expected)
+        unit, position, _ = read[7]
+        self.assertEqual(list(read_units(units, ["mit"], max_bytes=1000, start=unit, position=position)), read[8:])
+
+        stats = {}
+        batches = list(read_mirror([mirror], ["mit"], max_bytes=1000, batch_rows=4, stats=stats))
+        self.assertEqual([len(batch) for batch in batches], [4] * 7)
+        self.assertEqual(sum(batches, []), expected)
+        self.assertEqual(stats["rows"], len(expected))
+        self.assertEqual(stats["bytes"], sum(len(code) for code in expected))
+
+    def test_prefilter(self):
+        code = "def f():\n    return '\u00e9\u00e9'\n"
+        prefilter = Prefilter(max_bytes=len(code) + 2)
+        self.assertTrue(prefilter(code))
+        # max_bytes counts UTF-8 bytes: as many characters as that, but two bytes each for the accented ones
+        self.assertFalse(prefilter(code.replace("\u00e9", "\u00e9\u00e9")))
+        self.assertFalse(prefilter("x = 1\n"))
+        self.assertFalse(prefilter("def f():\n    print 'a'\n"))
+        self.assertEqual(prefilter.counts, {"passed": 1, "too_large": 1, "no_defs": 1, "py2": 1})
+
+        lenient = Prefilter(max_line_length=None, max_mean_line_length=None, require_defs=False, reject_py2=False)
+        self.assertTrue(lenient("x = 1 " + "+ 1 " * 1000 + "\n"))
+        self.assertTrue(lenient("print 'a'\n"))
+
+    def test_deduplicator(self):
+        near = module.replace("handler_trace", "handler_tracing")
+        other = "".join(f"class Model{i}:\n    field_{i} = Column(Integer, default={i})\n\n" for i in range(30))
+
+        for path in (None, os.path.join(self.tmp.name, "dedup.sqlite")):
+            dedup = Deduplicator(path, threshold=0.8)
+            self.assertEqual([dedup(code) for code in [module, module, near, other, codes[0]]],
+                             [True, False, False, True, True])
+            self.assertEqual(dedup.counts, {"kept": 3, "exact": 1, "near": 1})
+            self.assertEqual(dedup.removed_bytes, {"exact": len(module), "near": len(near)})
+            dedup.sync()
+            dedup.close()
+
+        # the index is persisted, rolling back forgets files added after a point
+        dedup = Deduplicator(os.path.join(self.tmp.name, "dedup.sqlite"), threshold=0.8)
+        self.assertEqual(dedup.seq, 3)
+        self.assertEqual(dedup.rule(other), "exact")
+        dedup.rollback(1)
+        self.assertEqual([dedup.rule(near), dedup.rule(other)], ["near", None])
+
+        dedup = Deduplicator(threshold=0.8, max_entries=1)
+        self.assertTrue(dedup(module))
+        dedup.sync()
+        self.assertTrue(dedup(other))
+        self.assertFalse(dedup(module))
+        dedup.sync()
+        self.assertTrue(dedup(module))
+
+    def test_shard_writer(self):
+        records = [str(i).encode() * (i + 1) for i in range(10)]
+        writer = ShardWriter(self.tmp.name, "part", max_bytes=40)
+        for record in records:
+            writer.write(record)
+        shards = writer.close()
+
+        self.assertEqual(sum(shard["rows"] for shard in shards), 10)
+        self.assertTrue(all(shard["bytes"] <= 40 or shard["rows"] == 1 for shard in shards))
+        self.assertEqual([record for shard in shards for record in read_shard(os.path.join(self.tmp.name, shard["path"]))],
+                         records)
+
+    def test_prep(self):
+        expected = [json.dumps(parse_code(code, backend="ast")) for i, code in enumerate(codes) if i % 4 != 3]
+
+        for format in ("records", "parquet"):
+            output = os.path.join(self.tmp.name, format)
+            manifest = prep([self.mirror], output, workers=2, shard_bytes=2000, timeout=None, licenses=["mit"],
+                            unit_bytes=500, format=format, row_group_rows=2)
+
+            self.assertEqual(manifest["input_rows"], 30)
+            self.assertEqual(manifest["rows"], 30)
+            self.assertEqual({shard["worker"] for shard in manifest["shards"]}, {0, 1})
+            with open(os.path.join(output, "manifest.json")) as f:
+                self.assertEqual(json.load(f)["shards"], manifest["shards"])
+            self.assertEqual(glob.glob(os.path.join(output, "*.tmp")), [])
+
+            parsed = []
+            for shard in manifest["shards"]:
+                path = os.path.join(output, shard["path"])
+                self.assertEqual(os.path.getsize(path), shard["bytes"])
+                if format == "records":
+                    rows = [read_parse_record(record).to_dict() for record in read_shard(path)]
+                else:
+                    rows = [parse_result_from_row(row) for row in read_parse_table(path).to_pylist()]
+                self.assertEqual(len(rows), shard["rows"])
+                parsed.extend(json.dumps(row) for row in rows)
+            self.assertEqual(sorted(parsed), sorted(expected))
+
+        # only the projected columns and the row groups that can match are read
+        table = read_parse_table(output, columns=["node_count", "max_depth", "symbols"],
+                                 filters=[("node_count", ">=", 2), ("max_depth", "=", 1)])
+        self.assertEqual(table.column_names, ["node_count", "max_depth", "symbols"])
+        self.assertEqual(table.num_rows, 30)
+        self.assertEqual(read_parse_table(output, columns=["node_count"], filters=[("node_count", ">", 2)]).num_rows, 0)
+
+    def test_resume_after_crash(self):
+        # with duplicates for the workers' dedup indexes, which are rolled back to the checkpoint as well
+        with open(self.mirror, "a") as f:
+            for code in [module, module.replace("'get'", "'fetch'"), module] + codes[:8]:
+                f.write(json.dumps({"code": code}) + "\n")
+
+        def run(output, **kwargs):
+            return prep([self.mirror], os.path.join(self.tmp.name, output), workers=2, shard_bytes=1500, timeout=None,
+                        unit_bytes=500, checkpoint_rows=3, dedup_threshold=0.8, **kwargs)
+
+        def shards(output):
+            contents = {}
+            for path in sorted(glob.glob(os.path.join(self.tmp.name, output, "*.parquet"))):
+                with open(path, "rb") as f:
+                    contents[os.path.basename(path)] = f.read()
+            return contents
+
+        expected = run("full")
+
+        # workers are forked with the patched module and die after writing a few records, with shards
+        # closed since their last checkpoint
+        iter_records = prep_github_code.iter_records
+        written = []
+
+        def crashing(*args, **kwargs):
+            for record in iter_records(*args, **kwargs):
+                written.append(None)
+                if len(written) == 8:
+                    raise RuntimeError("crash")
+                yield record
+
+        prep_github_code.iter_records = crashing
+        try:
+            with self.assertRaises(RuntimeError):
+                run("resumed")
+        finally:
+            prep_github_code.iter_records = iter_records
+        self.assertLess(len(shards("resumed")), len(shards("full")))
+
+        resumed = run("resumed")
+        self.assertEqual(shards("resumed"), shards("full"))
+        self.assertEqual(resumed["shards"], expected["shards"])
+        self.assertEqual(resumed["input_rows"], expected["input_rows"])
+        self.assertEqual(resumed["prefilter"], expected["prefilter"])
+        self.assertEqual(resumed["stats"]["outcomes"], expected["stats"]["outcomes"])
+        self.assertEqual(resumed["dedup"], expected["dedup"])
+        self.assertGreater(expected["dedup"]["counts"]["exact"], 0)
+        self.assertEqual(glob.glob(os.path.join(self.tmp.name, "resumed", "*.tmp")), [])
+
+        with self.assertRaises(RuntimeError):
+            run("resumed", max_rows=10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,65 +8,7 @@ from datasets import IterableDataset
 
 from RecursiveShardIterator import ShardIterator
 from TreeShard import TreeShard
-
-treeA = {
-    "__data__": "A",
-    "__children__": [
-        {
-            "__data__": "B",
-            "__children__": [
-                {"__data__": "D", "__children__": []},
-                {"__data__": "E", "__children__": []}
-            ]
-        },
-        {
-            "__data__": "C",
-            "__children__": [
-                {"__data__": "F", "__children__": []},
-                {"__data__": "G", "__children__": []}
-            ]
-        }
-    ]
-}
-
-treeB = {
-    "__data__": "A",
-    "__children__": [
-        {
-            "__data__": "B",
-            "__children__": [
-                {"__data__": "D", "__children__": []},
-                {"__data__": "E", "__children__": [
-                    {"__data__": "F", "__children__": []},
-                    {"__data__": "G", "__children__": []}
-                ]}
-            ]
-        },
-        {
-            "__data__": "C",
-            "__children__": []
-        }
-    ]
-}
-
-treeC = {
-    "__data__": "A",
-    "__children__": [
-        {
-            "__data__": "B",
-            "__children__": [
-                {"__data__": "D", "__children__": []},
-                {"__data__": "E", "__children__": []},
-                {"__data__": "F", "__children__": []},
-                {"__data__": "G", "__children__": []}
-            ]
-        },
-        {
-            "__data__": "C",
-            "__children__": []
-        }
-    ]
-}
+from testTreeShard import treeA, treeB, treeC, load_shards
 
 def getTreeDepthIterator(shard_iterator, depth):
 
@@ -79,16 +21,6 @@ def getTreeDepthIterator(shard_iterator, depth):
 
     return shard_iterator
 
-def load_shards(tree_list):
-    shards = []
-    for tree in tree_list:
-        shard = TreeShard()
-        shard.load_json(tree, 3)
-        shards.append(shard)
-
-    return shards
-
-
 def flatten_content(content: Dict, embedding=None, flag=True):
 
     signature = content["name"] + ("|" + ", ".join(content["params"]) if "params" in content else "")
@@ -114,16 +46,6 @@ class TestMethods(unittest.TestCase):
         self.trees = [treeA, treeB, treeC]
         self.shards = load_shards(self.trees)
 
-    def test_LoadShards_depth(self):
-        self.begin()
-        self.assertEqual(self.shards[0].depths, [0, 1, 1, 2, 2, 2, 2])
-        self.assertEqual(self.shards[1].depths, [0, 1, 1, 2, 2, 3, 3])
-        self.assertEqual(self.shards[2].depths, [0, 1, 1, 2, 2, 2, 2])
-
-        self.assertEqual(self.shards[0].subtrees, [[0, 1, 2], [1, 3, 4], [2, 5, 6], [3], [4], [5], [6]])
-        self.assertEqual(self.shards[1].subtrees, [[0, 1, 2], [1, 3, 4], [2], [3], [4, 5, 6], [5], [6]])
-        self.assertEqual(self.shards[2].subtrees, [[0, 1, 2], [1, 3, 4], [2], [3], [4], [5], [6]])
-
     def test_shard_generator(self):
         self.begin()
         def gen(shards, d):
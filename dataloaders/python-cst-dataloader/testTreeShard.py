@@ -0,0 +1,151 @@
+import json
+import os
+import tempfile
+import unittest
+
+from TreeShard import TreeShard, write_tree_shard
+
+treeA = {
+    "__data__": "A",
+    "__children__": [
+        {
+            "__data__": "B",
+            "__children__": [
+                {"__data__": "D", "__children__": []},
+                {"__data__": "E", "__children__": []}
+            ]
+        },
+        {
+            "__data__": "C",
+            "__children__": [
+                {"__data__": "F", "__children__": []},
+                {"__data__": "G", "__children__": []}
+            ]
+        }
+    ]
+}
+
+treeB = {
+    "__data__": "A",
+    "__children__": [
+        {
+            "__data__": "B",
+            "__children__": [
+                {"__data__": "D", "__children__": []},
+                {"__data__": "E", "__children__": [
+                    {"__data__": "F", "__children__": []},
+                    {"__data__": "G", "__children__": []}
+                ]}
+            ]
+        },
+        {
+            "__data__": "C",
+            "__children__": []
+        }
+    ]
+}
+
+treeC = {
+    "__data__": "A",
+    "__children__": [
+        {
+            "__data__": "B",
+            "__children__": [
+                {"__data__": "D", "__children__": []},
+                {"__data__": "E", "__children__": []},
+                {"__data__": "F", "__children__": []},
+                {"__data__": "G", "__children__": []}
+            ]
+        },
+        {
+            "__data__": "C",
+            "__children__": []
+        }
+    ]
+}
+
+def load_shards(tree_list):
+    shards = []
+    for tree in tree_list:
+        shard = TreeShard()
+        shard.load_json(tree, 3)
+        shards.append(shard)
+
+    return shards
+
+
+class TestTreeShard(unittest.TestCase):
+
+    def setUp(self):
+        self.trees = [treeA, treeB, treeC]
+        self.shards = load_shards(self.trees)
+
+    def test_LoadShards_depth(self):
+        self.assertEqual(self.shards[0].depths.tolist(), [0, 1, 1, 2, 2, 2, 2])
+        self.assertEqual(self.shards[1].depths.tolist(), [0, 1, 1, 2, 2, 3, 3])
+        self.assertEqual(self.shards[2].depths.tolist(), [0, 1, 1, 2, 2, 2, 2])
+
+        def subtrees(shard):
+            return [shard.subtree(i) for i in range(len(shard.depths))]
+
+        self.assertEqual(subtrees(self.shards[0]), [[0, 1, 2], [1, 3, 4], [2, 5, 6], [3], [4], [5], [6]])
+        self.assertEqual(subtrees(self.shards[1]), [[0, 1, 2], [1, 3, 4], [2], [3], [4, 5, 6], [5], [6]])
+        self.assertEqual(subtrees(self.shards[2]), [[0, 1, 2], [1, 3, 4], [2], [3], [4], [5], [6]])
+
+    def test_get_batch(self):
+        shard = self.shards[1]
+        shard.set_flattener(lambda content, flag=True: content + ("!" if flag else ""))
+
+        self.assertEqual(shard[4]["sub_node_content"], ["<n>4:2:E!</n>", "<n>5:3:F</n>", "<n>6:3:G</n>"])
+        self.assertEqual(shard[4]["length"], 37)
+        content, lengths = shard.get_batch([0, 2, 5], full=[True, False, False])
+        self.assertEqual(content, "<n>0:0:A!</n><n>2:1:C</n><n>5:3:F</n>")
+        self.assertEqual(lengths.tolist(), [13, 12, 12])
+
+    def test_depth_and_length_index(self):
+        shard = self.shards[1]
+        self.assertEqual(shard.depth_offsets.tolist(), [0, 1, 3, 5, 7])
+        self.assertEqual(shard.nodes_at_depth(2).tolist(), [3, 4])
+        self.assertTrue(shard.init_depth(3))
+        self.assertEqual(shard.filtered, [5, 6])
+
+        self.assertEqual(shard.lengths.tolist(), [12, 12, 12, 12, 12, 12, 12])
+        shard.set_flattener(lambda content, flag=True: content + ("\u00e9" if flag else ""))
+        self.assertEqual(shard.lengths.tolist(), [14, 14, 14, 14, 14, 14, 14])
+        self.assertIs(shard.lengths, shard.lengths)
+        self.assertEqual(shard.node_length(4, full=False), 12)
+
+        # examples count UTF-8 bytes like the length index
+        example = shard[4]
+        self.assertEqual(example["length"], sum(shard.node_length(i, full=i == 4) for i in example["node_seq"]))
+        self.assertEqual(example["length"], 38)
+        self.assertEqual(shard.get_batch([4, 5], full=True)[1].tolist(), [14, 14])
+
+    def test_memmap_shard(self):
+        def flatten(content, flag=True):
+            return content + ("\u00e9" if flag else "")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "treeB.shard")
+            write_tree_shard(path, treeB, 3, flatten)
+            shard = TreeShard(shard_type="memmap", json_file_path=path)
+            expected = TreeShard(flatten_content=flatten)
+            expected.load_json(treeB, 3)
+
+            self.assertEqual(shard.depths.tolist(), expected.depths.tolist())
+            self.assertEqual([shard.subtree(i) for i in range(7)], [expected.subtree(i) for i in range(7)])
+            self.assertEqual([shard[i] for i in range(7)], [expected[i] for i in range(7)])
+            self.assertEqual(shard.lengths.tolist(), expected.lengths.tolist())
+            self.assertEqual(shard.get_batch([1, 4], full=True)[0], expected.get_batch([1, 4], full=True)[0])
+            self.assertTrue(shard.init_depth(2))
+            self.assertEqual(shard.filtered, [3, 4])
+
+            # a flattener given for a memmap shard replaces the written rendering
+            shard = TreeShard(shard_type="memmap", json_file_path=path, flatten_content=lambda content, flag=True: content * 2)
+            expected.set_flattener(lambda content, flag=True: content * 2)
+            self.assertEqual([shard[i] for i in range(7)], [expected[i] for i in range(7)])
+            self.assertEqual(shard.lengths.tolist(), expected.lengths.tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()
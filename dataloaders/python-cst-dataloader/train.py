@@ -2,14 +2,13 @@ import functools
 
 from transformers import LlamaConfig, LlamaTokenizer, LlamaForCausalLM
 from datasets import load_dataset, IterableDataset
-from .CodeTreeParser import parse_code
+from .CodeTreeParser import parse_code, parse_code_batch, read_parse_record, parse_result_from_row, ParseRecord
 from .RecursiveShardIterator import ShardIterator
 from .recursive import CodeNode
 from .TreeShard import TreeShardV2
 from typing import Dict
 from libcst import ParserSyntaxError
 import pprint
-import json
 
 def house():
     config = LlamaConfig(vocab_size=32008)
@@ -83,6 +82,20 @@ def convert_nodeSet(nodeSet, callTree, num_emb_tokens):
     return nodemap
 
 
+def convert_record(record, num_emb_tokens):
+    # like convert_nodeSet, bodies and emb_repr are only decoded when a node asks for them,
+    # and a body is decoded once for both body and prediction_repr
+    nodemap = {}
+
+    for k, row in record.node_set.items():
+        if k in record.call_tree:
+            body = functools.cache(functools.partial(record.body, row))
+            nodemap[k] = CodeNode(k, record.params(row), body, record.node_type(row),
+                                  embedding_repr=functools.partial(record.emb_repr, k), prediction_repr=body)
+
+    return nodemap
+
+
 def buildTree(func, nodes, callTree, bfslist, root, depth, ancestors):
     tree = {}
 
@@ -104,11 +117,17 @@ def buildTree(func, nodes, callTree, bfslist, root, depth, ancestors):
 def compare_nodes(item_a, item_b):
     return len(item_b.get_children()) - len(item_a.get_children())
 
+def read_parsed(item):
+    # a prep row: nested Arrow columns (see parse_result_row) or a stored record in "files"
+    if "nodes" in item:
+        return parse_result_from_row(item)
+    return read_parse_record(item["files"])
+
 def create_code_shard(item:Dict, num_emb_tokens=1):
     #Parse nodes to component tree
     try:
-        if "files" in item:
-            parsed = json.loads(item["files"])
+        if "files" in item or "nodes" in item:
+            parsed = read_parsed(item)
         elif "code" in item:
             parsed = parse_code(item["code"])
         elif "text" in item:
@@ -116,8 +135,39 @@ def create_code_shard(item:Dict, num_emb_tokens=1):
     except:
         raise RuntimeError
 
+    return code_shard_from_parsed(parsed, num_emb_tokens)
+
+
+def create_code_shards(items, num_emb_tokens=1, **batch_args):
+    """
+        Batch version of create_code_shard. Raw code is parsed through parse_code_batch
+        (workers, timeout, max_bytes, ... are passed along) and files that fail to
+        parse are skipped instead of raising.
+    """
+    items = list(items)
+    raw = [i for i, item in enumerate(items) if "files" not in item and "nodes" not in item]
+    codes = (items[i]["code"] if "code" in items[i] else items[i]["text"] for i in raw)
+    parsed = dict(zip(raw, parse_code_batch(codes, **batch_args)))
+
+    for i, item in enumerate(items):
+        if i in parsed:
+            out, failure = parsed[i]
+            if failure is not None:
+                continue
+        else:
+            out = read_parsed(item)
+
+        yield code_shard_from_parsed(out, num_emb_tokens)
+
+
+def code_shard_from_parsed(parsed, num_emb_tokens=1):
     #Convert Real Nodes to node classes
-    nodeset = convert_nodeSet(parsed["node_set"], parsed["call_tree"], num_emb_tokens)
+    if isinstance(parsed, ParseRecord):
+        nodeset = convert_record(parsed, num_emb_tokens)
+        call_tree = parsed.call_tree
+    else:
+        nodeset = convert_nodeSet(parsed["node_set"], parsed["call_tree"], num_emb_tokens)
+        call_tree = parsed["call_tree"]
 
     #Convert set to iterable list
     dictlist = []
@@ -127,7 +177,7 @@ def create_code_shard(item:Dict, num_emb_tokens=1):
     #Build trees with each node as root
     for i, func in enumerate(dictlist):
         bfslist = []
-        tree = buildTree(func.name, nodeset, parsed["call_tree"], bfslist, func, 0, [])
+        tree = buildTree(func.name, nodeset, call_tree, bfslist, func, 0, [])
         dictlist[i].set_children(bfslist)
 
     dictlist.sort(key=functools.cmp_to_key(compare_nodes))
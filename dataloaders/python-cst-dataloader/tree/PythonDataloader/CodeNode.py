@@ -2,6 +2,11 @@ from ..TreeNode import TreeNode
 
 
 class CodeNode(TreeNode):
+    """
+        body, embedding_repr and prediction_repr may be given as zero argument
+        callables (e.g. reading a ParseRecord), which are only called the first
+        time the string is asked for.
+    """
 
     def __init__(self,
                  name,
@@ -9,17 +14,29 @@ class CodeNode(TreeNode):
                  body,
                  def_type,
                  short_repr=None,
-                 prediction_repr=None
+                 prediction_repr=None,
+                 embedding_repr=None
     ):
         super().__init__()
-        self.body = body
+        self._body = body
         self.name = name
         self.params = params
         self.type = def_type
         self._short_repr = short_repr
         self._pred_repr = prediction_repr
+        self._emb_repr = embedding_repr
         self.depth = 0
 
+    @property
+    def body(self):
+        if callable(self._body):
+            self._body = self._body()
+        return self._body
+
+    @body.setter
+    def body(self, body):
+        self._body = body
+
     def short_repr(self):
         if self._short_repr == None:
             self._short_repr = self.name + (" | " + ", ".join(self.params) if self.params is not None and len(self.params) > 0 else "")
@@ -27,5 +44,12 @@ class CodeNode(TreeNode):
         return self._short_repr
 
     def prediction_repr(self):
+        if callable(self._pred_repr):
+            self._pred_repr = self._pred_repr()
         return self._pred_repr
 
+    def embedding_repr(self):
+        if callable(self._emb_repr):
+            self._emb_repr = self._emb_repr()
+        return self._emb_repr
+
@@ -1 +1,2 @@
-from .json_bfs_loader import bfs_traversal as _treeBFS
\ No newline at end of file
+from .json_bfs_loader import bfs_traversal as _treeBFS, bfs_windows as _treeBFSWindows, bfs_layout as _treeBFSLayout, \
+    tree_to_parents as _treeToParents, ParentTree
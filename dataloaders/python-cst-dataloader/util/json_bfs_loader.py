@@ -1,4 +1,6 @@
-from collections import deque
+from collections import deque, namedtuple
+
+import numpy as np
 
 # Sample JSON tree structure. This is a Dict with nodes specified as follows
 # a node is defined by
@@ -72,4 +74,162 @@ def capped_bfs(tree, node_limit):
         for child in current_node["__children__"]:
             queue.append(child)
 
-    return bfs_list
\ No newline at end of file
+    return bfs_list
+
+
+class ParentTree(namedtuple("ParentTree", ["parents", "payload"])):
+    """
+        A tree as a read-only parent-index array plus payload tuple, so it can be
+        shared and reused without copying. Nodes are numbered in pre-order:
+        parents[0] is -1 for the root, parents[i] < i for the others and
+        payload[i] is the __data__ of node i. Made by tree_to_parents.
+    """
+
+    __slots__ = ()
+
+    def depths(self):
+        # pointer jumping: depths[i] counts the levels up to ancestor[i], which
+        # doubles every round until it is -1 past the root
+        ancestor = self.parents.copy()
+        depths = (ancestor >= 0).astype(np.int32)
+        up = np.flatnonzero(ancestor >= 0)
+        while len(up):
+            depths[up] += depths[ancestor[up]]
+            ancestor[up] = ancestor[ancestor[up]]
+            up = up[ancestor[up] >= 0]
+        return depths
+
+    def bfs_order(self, depths=None):
+        # nodes of one level are in the same order in bfs and in pre-order, as both
+        # follow the first ancestors that differ
+        return np.argsort(self.depths() if depths is None else depths, kind="stable")
+
+
+def tree_to_parents(tree):
+    """
+        The ParentTree of a {__data__, __children__} dict tree, which is only read.
+    """
+    parents = []
+    payload = []
+    stack = [(tree, -1)]
+    while stack:
+        node, parent = stack.pop()
+        parents.append(parent)
+        payload.append(node["__data__"])
+        stack.extend((child, len(payload) - 1) for child in reversed(node["__children__"]))
+
+    parents = np.array(parents, dtype=np.int64)
+    parents.flags.writeable = False
+    return ParentTree(parents, tuple(payload))
+
+
+class BFSLayout(namedtuple("BFSLayout", ["order", "depths", "child_start", "max_depth"])):
+    """
+        The bfs numbering of a ParentTree, from bfs_layout:
+        - order: the pre-order (ParentTree) number of every node, in bfs order
+        - depths: int32 array of the depth of every node, in bfs order
+        - child_start: the children of bfs node i are the bfs nodes
+          child_start[i] to child_start[i + 1]
+        - max_depth: the max depth in the tree
+
+        In bfs order the descendants of a node at any one depth are contiguous,
+        and the children of consecutive nodes follow each other. So the capped
+        subtree of a node is a run of nodes per level, and the run below
+        [lo, hi) is [child_start[lo], child_start[hi]).
+    """
+
+    __slots__ = ()
+
+    def window(self, i, node_limit):
+        """
+            The capped subtree of bfs node i as a list, what capped_bfs gives.
+        """
+        window = []
+        lo, hi = i, i + 1
+        while lo < hi and len(window) < node_limit:
+            window.extend(range(lo, min(hi, lo + node_limit - len(window))))
+            lo, hi = int(self.child_start[lo]), int(self.child_start[hi])
+        return window
+
+
+def bfs_layout(tree):
+    """
+        The BFSLayout of a ParentTree (or a dict tree, converted first), in O(n)
+        numpy work and without touching the tree.
+    """
+    if not isinstance(tree, ParentTree):
+        tree = tree_to_parents(tree)
+
+    pre_depths = tree.depths()
+    order = tree.bfs_order(pre_depths)
+    n = len(order)
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+    child_counts = np.bincount(rank[tree.parents[order[1:]]], minlength=n)
+
+    child_start = np.ones(n + 1, dtype=np.int64)
+    np.cumsum(child_counts, out=child_start[1:])
+    child_start[1:] += 1
+
+    depths = pre_depths[order]
+    return BFSLayout(order, depths, child_start, int(depths.max()))
+
+
+class BFSWindows(namedtuple("BFSWindows", ["data", "order", "depths", "offsets", "indices", "max_depth"])):
+    """
+        The result of bfs_windows:
+        - data: a list in bfs order of the data elements in the tree
+        - order: the pre-order (ParentTree) number of every node, in bfs order
+        - depths: int32 array of the depth of every node, in bfs order
+        - offsets, indices: the capped subtrees in CSR form, the subtree of node
+          i is indices[offsets[i]:offsets[i + 1]], global bfs numbers like
+          capped_bfs gives
+        - max_depth: the max depth in the tree
+    """
+
+    __slots__ = ()
+
+    def subtree(self, i):
+        return self.indices[self.offsets[i]:self.offsets[i + 1]]
+
+
+def bfs_windows(tree, node_limit):
+    """
+        bfs_traversal for a ParentTree (or a dict tree, converted first) without
+        a python level traversal, and without touching the tree. The windows of
+        the BFSLayout are grown one level at a time for all nodes together.
+    """
+    if not isinstance(tree, ParentTree):
+        tree = tree_to_parents(tree)
+
+    layout = bfs_layout(tree)
+    child_start = layout.child_start
+    n = len(layout.order)
+
+    lo = np.arange(n, dtype=np.int64)
+    hi = lo + 1
+    remaining = np.full(n, node_limit, dtype=np.int64)
+    levels = []
+    while True:
+        take = np.minimum(hi - lo, remaining)
+        if not take.any():
+            break
+        levels.append((lo, take))
+        remaining -= take
+        lo, hi = child_start[lo], child_start[hi]
+
+    lengths = node_limit - remaining
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    indices = np.empty(offsets[-1], dtype=np.int64)
+
+    filled = offsets[:-1].copy()
+    for lo, take in levels:
+        rows = np.flatnonzero(take)
+        count = take[rows]
+        step = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        indices[np.repeat(filled[rows], count) + step] = np.repeat(lo[rows], count) + step
+        filled += take
+
+    return BFSWindows([tree.payload[i] for i in layout.order], layout.order, layout.depths, offsets, indices,
+                      layout.max_depth)